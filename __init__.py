@@ -7,9 +7,20 @@ from frame import Frame, ControlFrame, OPCODE_CONTINUATION, OPCODE_TEXT, \
         CLOSE_MISSING_EXTENSIONS, CLOSE_UNABLE, read_frame, pop_frame, \
         contains_frame
 from connection import Connection
-from message import Message, TextMessage, BinaryMessage
-from errors import SocketClosed, HandshakeError, PingError, SSLError
+from message import Message, TextMessage, BinaryMessage, EncodedMessage
+from errors import SocketClosed, HandshakeError, PingError, SSLError, \
+        NonUpgradeRequest, MessageTooBig, RpcError, RpcTimeout
 from extension import Extension
 from deflate_frame import DeflateFrame
 from deflate_message import DeflateMessage
-from async import AsyncConnection, AsyncServer
+from compression import CompressionPolicy
+from mux import Multiplex, Channel, multiplexer
+from rpc import Rpc
+from codec import Codec, JsonCodec, MsgpackCodec, StructCodec
+from timer import TimerThread
+from async import AsyncConnection, AsyncServer, AsyncOutboundConnection
+from stats import Stats
+from profiling import Profiler, HandlerProfiler
+from capture import Capture, read_capture
+from loadgen import LoadGenerator
+from pool import ThreadPool
@@ -0,0 +1,403 @@
+import os
+import socket
+import logging
+from traceback import format_exc
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+from websocket import websocket
+from connection import Connection
+from handshake import ServerHandshake, ClientHandshake, MAX_HDR_LEN
+from frame import ControlFrame
+from errors import HandshakeError, SocketClosed, NonUpgradeRequest
+from stats import Stats
+
+
+__all__ = ['AioConnection', 'serve', 'connect']
+
+
+def coroutine(func):
+    if asyncio is None:
+        return func
+
+    return asyncio.coroutine(func)
+
+
+class TransportSocket(object):
+    """
+    Socket-like wrapper around an asyncio transport, used as the `sock`
+    attribute of a websocket so that the websocket and handshake code can
+    write to the transport. Writes never block, flow control is done by
+    `AioConnection.drain`.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendall(self, data):
+        # Handshake headers may be unicode, like regular sockets the
+        # transport should accept them if they are ASCII-only
+        if isinstance(data, unicode):
+            data = data.encode('ascii')
+
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+    def shutdown(self, how):
+        if self.transport.can_write_eof():
+            self.transport.write_eof()
+
+    def fileno(self):
+        sock = self.transport.get_extra_info('socket')
+        return sock.fileno() if sock else -1
+
+    def getpeername(self):
+        return self.transport.get_extra_info('peername')
+
+    def getsockname(self):
+        return self.transport.get_extra_info('sockname')
+
+
+class AioConnection(Connection):
+    """
+    Connection driven by an asyncio (trollius) event loop. Received messages
+    are queued and returned by the recv() coroutine, and send() and close()
+    are coroutines as well. Connections are created by `serve` and `connect`,
+    and the on*() event handlers may be implemented by an extending class
+    (passed as `conn_class`) as usual.
+
+    Example of an echo server:
+    >>> import trollius as asyncio
+    >>> from trollius import From
+    >>> from wspy import aio
+
+    >>> @asyncio.coroutine
+    >>> def echo(conn):
+    >>>     while True:
+    >>>         message = yield From(conn.recv())
+    >>>         yield From(conn.send(message))
+
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(aio.serve(echo, '', 8000))
+    >>> loop.run_forever()
+    """
+    def __init__(self, sock, protocol):
+        self.protocol = protocol
+        self.messages = asyncio.Queue(loop=protocol.loop)
+        Connection.__init__(self, sock)
+
+    def feed_frame(self, frame):
+        if isinstance(frame, ControlFrame):
+            self.handle_control_frame(frame)
+            return
+
+        message = self.add_fragment(frame)
+
+        if message is None:
+            return
+
+        self.protocol.incr('messages_received')
+        self.onmessage(message)
+        self.messages.put_nowait(message)
+
+    @coroutine
+    def recv(self):
+        """
+        Wait for the next message. Raises SocketClosed when the connection
+        has been closed and all received messages have been returned.
+        """
+        message = yield From(self.messages.get())
+
+        if message is None:
+            # Wake up other waiting coroutines as well
+            self.messages.put_nowait(None)
+            raise SocketClosed(True)
+
+        raise Return(message)
+
+    @coroutine
+    def send(self, message, fragment_size=None, mask=None):
+        """
+        Send a message, and wait until the transport's write buffer has
+        drained below its high-water mark. Frames are masked by default for
+        client connections (see `Connection.send` for the other arguments).
+        """
+        if mask is None:
+            mask = self.sock.mask_frames
+
+        if self.protocol.lost:
+            raise SocketClosed(self.close_frame_received)
+
+        # The fragments are passed to the extensions at once
+        self.sock.send(*self.message_to_frames(message, fragment_size, mask))
+
+        self.protocol.incr('messages_sent')
+        yield From(self.drain())
+
+    def send_frame(self, frame, callback=None):
+        if self.protocol.lost:
+            raise SocketClosed(self.close_frame_received)
+
+        if self.sock.mask_frames and not frame.masking_key:
+            frame.masking_key = os.urandom(4)
+
+        Connection.send_frame(self, frame, callback)
+
+    @coroutine
+    def drain(self):
+        """
+        Wait until the transport has resumed writing, if it was paused
+        because its write buffer exceeded the high-water mark.
+        """
+        if self.protocol.lost:
+            raise SocketClosed(self.close_frame_received)
+
+        if self.protocol.write_waiter:
+            yield From(asyncio.shield(self.protocol.write_waiter))
+
+    @coroutine
+    def close(self, code=None, reason='', timeout=2.0):
+        """
+        Send a CLOSE frame (unless one has been sent already), and wait at
+        most `timeout` seconds for the closing handshake to complete, after
+        which the transport is aborted.
+        """
+        if not self.close_frame_sent and not self.protocol.lost:
+            try:
+                self.send_close_frame(code, reason)
+            except SocketClosed:
+                self.protocol.closed_cleanly = True
+
+        try:
+            yield From(asyncio.wait_for(asyncio.shield(self.protocol.closed),
+                                        timeout, loop=self.protocol.loop))
+        except asyncio.TimeoutError:
+            self.protocol.transport.abort()
+
+
+class WebSocketProtocol(asyncio.Protocol if asyncio else object):
+    """
+    Protocol that parses the handshake and the frames of a single connection
+    and passes them to a websocket instance. `ssock` is the websocket with
+    the server configuration for server connections, `wsock` is the
+    connecting websocket for client connections.
+    """
+    def __init__(self, loop, conn_class, handler=None, ssock=None, wsock=None):
+        self.loop = loop
+        self.conn_class = conn_class
+        self.handler = handler
+        self.ssock = ssock
+        self.sock = wsock
+        self.conn = None
+        self.recvbuf = ''
+        self.lost = False
+        self.closed_cleanly = False
+        self.write_waiter = None
+        self.opened = asyncio.Future(loop=loop)
+        self.closed = asyncio.Future(loop=loop)
+
+    def incr(self, name):
+        if self.ssock and self.ssock.stats:
+            self.ssock.stats.incr(name)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+        if self.ssock:
+            self.sock = websocket(TransportSocket(transport))
+            self.sock.capture = self.ssock.capture
+            self.sock.secure = \
+                transport.get_extra_info('sslcontext') is not None
+        else:
+            # The transport owns the connected socket from now on
+            self.sock.sock = TransportSocket(transport)
+            self.sock.client_handshake = ClientHandshake(self.sock)
+            self.sock.handshake_callback = self.onhandshake
+            self.sock.mask_frames = True
+            transport.write(self.sock.client_handshake.request())
+
+    def data_received(self, data):
+        try:
+            if self.ssock and not self.sock.handshake_sent:
+                self.handle_request(data)
+            elif self.conn or self.sock.client_handshake:
+                self.sock.feed(data)
+        except SocketClosed:
+            self.closed_cleanly = True
+        except HandshakeError as e:
+            logging.error('Handshake failed: %s', e.message)
+            self.fail_handshake(e)
+        except Exception as e:
+            logging.error(format_exc(e).rstrip())
+
+            if self.conn:
+                self.conn.onerror(e)
+                self.conn.fail(e)
+            else:
+                self.transport.close()
+
+    def handle_request(self, data):
+        self.recvbuf += data
+        end = self.recvbuf.find('\r\n\r\n')
+
+        if end == -1:
+            if len(self.recvbuf) > MAX_HDR_LEN:
+                self.incr('handshake_errors')
+                logging.error('Invalid request: request exceeds maximum '
+                              'header length of %d', MAX_HDR_LEN)
+                self.transport.close()
+
+            return
+
+        raw = self.recvbuf[:end + 4]
+        data = self.recvbuf[end + 4:]
+        self.recvbuf = ''
+
+        try:
+            ServerHandshake(self.sock).handle_raw_request(raw, self.ssock)
+        except HandshakeError as e:
+            self.incr('handshake_errors')
+            logging.error('Invalid request: %s', e.message)
+            self.fail_handshake(e)
+            return
+        except NonUpgradeRequest as e:
+            self.transport.write(e.response)
+            self.transport.close()
+            return
+
+        self.sock.handshake_sent = True
+        self.incr('connections_accepted')
+        self.onhandshake()
+
+        if data:
+            self.sock.feed(data)
+
+    def fail_handshake(self, e):
+        # Not all handshake errors close the socket (e.g. an unserved
+        # location), so the transport is closed here
+        if not self.opened.done():
+            self.opened.set_exception(e)
+
+            # Only connect() waits for the handshake, the error has already
+            # been logged for server connections
+            if self.ssock:
+                self.opened.exception()
+
+        self.transport.close()
+
+    def onhandshake(self):
+        self.conn = self.conn_class(self.sock, self)
+        self.sock.recv_callback = self.conn.feed_frame
+
+        if self.handler:
+            asyncio.ensure_future(self.run_handler(), loop=self.loop)
+
+        self.opened.set_result(self.conn)
+
+    @coroutine
+    def run_handler(self):
+        try:
+            yield From(self.handler(self.conn))
+        except SocketClosed:
+            pass
+        except Exception as e:
+            logging.error(format_exc(e).rstrip())
+            self.conn.onerror(e)
+
+        if not self.lost:
+            yield From(self.conn.close())
+
+    def pause_writing(self):
+        self.write_waiter = asyncio.Future(loop=self.loop)
+
+    def resume_writing(self):
+        waiter, self.write_waiter = self.write_waiter, None
+
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    def connection_lost(self, exc):
+        self.lost = True
+        self.resume_writing()
+
+        if self.sock:
+            self.sock.close()
+
+        if self.conn:
+            self.incr('connections_closed')
+
+            if not self.closed_cleanly:
+                self.conn.onclose(None, 'connection lost')
+
+            self.conn.messages.put_nowait(None)
+        elif not self.ssock and not self.opened.done():
+            self.opened.set_exception(exc or
+                                      HandshakeError('connection closed '
+                                                     'during handshake'))
+
+        self.closed.set_result(None)
+
+
+@coroutine
+def serve(handler, host, port, loop=None, conn_class=AioConnection,
+          backlog_size=32, ssl=None, **kwargs):
+    """
+    Start a websocket server on the asyncio event loop `loop` (the default
+    event loop if omitted), and return the asyncio `Server` object.
+
+    `handler` is a coroutine function that is called with an `AioConnection`
+    (or an instance of `conn_class`) for each client connection. The
+    connection is closed when the coroutine returns.
+
+    `ssl` is an optional SSL context. Any additional keyword arguments (such
+    as `extensions` and `stats_location`) are passed to the constructor of
+    the listening websocket. The server's statistics (see `Stats`) are in the
+    `stats` attribute of the returned server.
+    """
+    if asyncio is None:
+        raise ImportError('trollius is required for the asyncio server')
+
+    loop = loop or asyncio.get_event_loop()
+
+    ssock = websocket(**kwargs)
+    ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ssock.bind((host, port))
+    ssock.listen(backlog_size)
+    ssock.setblocking(0)
+    ssock.stats = Stats()
+
+    server = yield From(loop.create_server(
+        lambda: WebSocketProtocol(loop, conn_class, handler, ssock=ssock),
+        sock=ssock.sock, ssl=ssl))
+    server.stats = ssock.stats
+    raise Return(server)
+
+
+@coroutine
+def connect(address, loop=None, conn_class=AioConnection, ssl=None,
+            **kwargs):
+    """
+    Connect to the websocket server at `address` (a (host, port) tuple) on the
+    asyncio event loop `loop`, and return the connection after the handshake
+    has completed. Any additional keyword arguments (such as `location` and
+    `extensions`) are passed to the websocket constructor.
+    """
+    if asyncio is None:
+        raise ImportError('trollius is required for asyncio connections')
+
+    loop = loop or asyncio.get_event_loop()
+
+    sock = websocket(**kwargs)
+    sock.setblocking(0)
+    yield From(loop.sock_connect(sock.sock, address))
+
+    transport, protocol = yield From(loop.create_connection(
+        lambda: WebSocketProtocol(loop, conn_class, wsock=sock),
+        sock=sock.sock, ssl=ssl, server_hostname=address[0] if ssl else None))
+    conn = yield From(protocol.opened)
+    raise Return(conn)
@@ -1,46 +1,63 @@
+import os
+import errno
+import fcntl
 import socket
+import time
+from collections import deque
 from select import epoll, EPOLLIN, EPOLLOUT, EPOLLHUP
+from threading import current_thread
 from traceback import format_exc
 import logging
 
+from websocket import websocket
 from connection import Connection
-from frame import ControlFrame, OPCODE_PING, OPCODE_CONTINUATION, \
-                  create_close_frame
+from frame import ControlFrame, OPCODE_PING, CLOSE_GOING_AWAY, \
+                  CLOSE_MESSAGE_TOOBIG, create_close_frame
 from server import Server, Client
-from errors import HandshakeError, SocketClosed
+from pool import ThreadPool
+from timer import TimerQueue
+from errors import HandshakeError, SocketClosed, NonUpgradeRequest, \
+                   MessageTooBig
+from upgrade import listen_upgrade, receive_handoff, send_state, \
+                    client_state, is_transferable, restore_socket, \
+                    restore_connection
+
+
+# Assumed compression ratio of received messages, used to estimate the time
+# needed to decompress them from their received size
+INFLATE_RATIO = 8
+
+# Interval in seconds at which idle compression contexts are released
+IDLE_SWEEP_INTERVAL = 10
 
 
 class AsyncConnection(Connection):
     def __init__(self, sock):
-        sock.recv_callback = self.contruct_message
+        sock.recv_callback = self.feed_frame
         sock.recv_close_callback = self.onclose
-        self.recvbuf = []
         Connection.__init__(self, sock)
 
-    def contruct_message(self, frame):
-        if isinstance(frame, ControlFrame):
-            self.handle_control_frame(frame)
-            return
+    def send(self, message, fragment_size=None, mask=False):
+        frames = list(self.message_to_frames(message, fragment_size, mask))
+        callback = lambda: self.onsent(message)
 
-        self.recvbuf.append(frame)
+        # Frames queued during a client handshake are processed by the
+        # extensions afterwards
+        if self.sock.client_handshake:
+            for frame in frames[:-1]:
+                self.send_frame(frame)
 
-        if frame.final:
-            message = self.concat_fragments(self.recvbuf)
-            self.recvbuf = []
-            self.onmessage(message)
-        elif len(self.recvbuf) > 1 and frame.opcode != OPCODE_CONTINUATION:
-            raise ValueError('expected continuation/control frame, got %s '
-                             'instead' % frame)
+            self.send_frame(frames[-1], callback)
+            return
 
-    def send(self, message, fragment_size=None, mask=False):
-        frames = list(self.message_to_frames(message, fragment_size, mask))
+        frames = self.sock.send_batch_hook(frames)
 
         for frame in frames[:-1]:
-            self.sock.queue_send(frame)
+            self.sock.queue_frame(frame)
 
-        self.sock.queue_send(frames[-1], lambda: self.onsent(message))
+        self.sock.queue_frame(frames[-1], callback)
 
-    def send_frame(self, frame, callback):
+    def send_frame(self, frame, callback=None):
         self.sock.queue_send(frame, callback)
 
     def do_async_send(self):
@@ -57,25 +74,35 @@ class AsyncConnection(Connection):
         except Exception as e:
             self.onerror(e)
             self.onclose(None, 'error: %s' % e)
+            self.fail(e)
+            raise e
+
+    def fail(self, e):
+        if isinstance(e, MessageTooBig) and not self.sock.sendbuf:
+            # Write the CLOSE frame right away if the socket is writable
+            self.sock.queue_frame(create_close_frame(CLOSE_MESSAGE_TOOBIG,
+                                                     str(e)))
 
             try:
-                self.sock.close()
+                self.sock.do_async_send()
             except socket.error:
                 pass
 
-            raise e
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
 
     def send_close_frame(self, code, reason):
-        self.sock.queue_send(create_close_frame(code, reason),
-                             self.shutdown_write)
+        self.send_frame(create_close_frame(code, reason), self.shutdown_write)
         self.close_frame_sent = True
 
     def close(self, code=None, reason=''):
         self.send_close_frame(code, reason)
 
     def send_ping(self, payload=''):
-        self.sock.queue_send(ControlFrame(OPCODE_PING, payload),
-                             lambda: self.onping(payload))
+        self.send_frame(ControlFrame(OPCODE_PING, payload),
+                        lambda: self.onping(payload))
         self.ping_payload = payload
         self.ping_sent = True
 
@@ -88,32 +115,203 @@ class AsyncConnection(Connection):
 
 class AsyncServer(Server):
     def __init__(self, *args, **kwargs):
-        Server.__init__(self, *args, **kwargs)
+        """
+        Same as `Server.__init__`, with the following additional arguments:
+
+        `recvbuf_size` is the maximum number of bytes received from a client
+        socket at once, it defaults to 2048.
+
+        `profiler` is an optional `Profiler` instance, to which the event loop
+        lag and the time spent in event handlers is reported.
+
+        If an `executor` is specified (see `Server.__init__`), the handlers
+        are run in its worker threads so that blocking handlers do not stall
+        the event loop. Sending and closing from a handler is safe, since
+        these calls are passed to the event loop thread.
+
+        `offload_size` is the payload size (in bytes) from which messages are
+        compressed and decompressed by a worker thread, so that compressing
+        large messages does not stall the other connections. It defaults to
+        1 MiB, None disables offloading. The worker threads are those of the
+        `executor`, or of a `ThreadPool` of 4 threads that is created when
+        the first message is offloaded.
+
+        `upgrade_path` is an optional path of a Unix socket used to restart
+        the server without downtime. When a new server process is started
+        with the same path, it takes over the listening socket and the
+        established connections of the running process, which closes the
+        connections that cannot be transferred (see `hand_off`) and exits.
+        """
+        self.recvbuf_size = kwargs.pop('recvbuf_size', 2048)
+        self.profiler = kwargs.pop('profiler', None)
+        self.offload_size = kwargs.pop('offload_size', 1 << 20)
+        self.upgrade_path = kwargs.pop('upgrade_path', None)
+        self.inherited = []
 
-        self.recvbuf_size = kwargs.get('recvbuf_size', 2048)
+        if self.upgrade_path:
+            handoff = receive_handoff(self.upgrade_path)
+
+            if handoff:
+                kwargs['sock'], self.inherited = handoff
+
+        Server.__init__(self, *args, **kwargs)
 
         self.epoll = epoll()
-        self.epoll.register(self.sock.fileno(), EPOLLIN)
+        self.sock_fno = self.sock.fileno()
+        self.epoll.register(self.sock_fno, EPOLLIN)
+        self.accepting = True
         self.conns = {}
+        self.responses = {}
+        self.handed_off = False
+        self.upgrade_sock = self.upgrade_fno = None
+        self.timers = TimerQueue()
+
+        if self.upgrade_path:
+            self.upgrade_sock = listen_upgrade(self.upgrade_path)
+            self.upgrade_fno = self.upgrade_sock.fileno()
+            self.epoll.register(self.upgrade_fno, EPOLLIN)
+
+        # Compression policies that adapt to the event loop lag, or release
+        # the contexts of idle connections
+        policies = set(ext.policy for ext in self.sock.extensions
+                       if getattr(ext, 'policy', None))
+        self.lag_policies = [p for p in policies if p.max_lag is not None]
+        self.last_poll = None
+        self.sweep_idle = any(p.idle_time is not None for p in policies)
+        self.next_sweep = time.time() + IDLE_SWEEP_INTERVAL
+
+        if self.profiler:
+            for name in ('onopen', 'onmessage', 'onclose'):
+                handler = getattr(self, name)
+                setattr(self, name, self.profiler.timed(name, handler))
+
+        self.workers = self.executor
+        self.loop_thread = None
+        self.calls = deque()
+
+        # Worker threads wake up the event loop by writing to a pipe, as do
+        # other threads that schedule calls
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.epoll.register(self.wakeup_r, EPOLLIN)
+
+        if self.executor:
+            for name in ('onopen', 'onmessage', 'onclose'):
+                setattr(self, name, self.offload(getattr(self, name)))
 
     @property
     def clients(self):
-        return self.conns.values()
+        return [c for c in self.conns.itervalues()
+                if not isinstance(c, AsyncOutboundConnection)]
+
+    def connect(self, conn_class, address, **kwargs):
+        """
+        Open an outbound connection to `address` without blocking, and
+        register it in the event loop of this server. `conn_class` is a
+        subclass of `AsyncOutboundConnection` which implements the event
+        handlers of the connection. Any additional keyword arguments (such as
+        `location` and `extensions`) are passed to the websocket constructor.
+        Returns the created connection.
+        """
+        sock = websocket(**kwargs)
+        sock.connect_async(address)
+        conn = conn_class(self, sock)
+        conn.fno = sock.fileno()
+        self.conns[conn.fno] = conn
+        self.epoll.register(conn.fno, EPOLLOUT)
+        logging.debug('Connecting %s', conn)
+        return conn
+
+    def discard(self, conn):
+        """
+        Unregister a closed outbound connection (clients are removed in
+        remove_client() instead).
+        """
+        if self.conns.get(conn.fno) is not conn:
+            return
+
+        del self.conns[conn.fno]
+
+        try:
+            self.epoll.unregister(conn.fno)
+        except IOError:
+            # Closing the socket has already unregistered it
+            pass
 
     def remove_client(self, client, code, reason):
         self.epoll.unregister(client.fno)
         del self.conns[client.fno]
+        self.stats.incr('connections_closed')
         self.onclose(client, code, reason)
 
-    def handle_events(self):
-        for fileno, event in self.epoll.poll(1):
-            if fileno == self.sock.fileno():
+    def poll(self, timeout):
+        if not self.profiler and not self.lag_policies:
+            return self.epoll.poll(timeout)
+
+        start = time.time()
+        events = self.epoll.poll(timeout)
+        end = time.time()
+
+        # The time spent on the previous events delays the current events
+        lag = start - self.last_poll if self.last_poll else 0.0
+
+        if not events and timeout >= 0:
+            lag += max(0.0, end - start - timeout)
+
+        self.last_poll = end
+
+        if self.profiler:
+            self.profiler.onloop(lag, len(events))
+
+        for policy in self.lag_policies:
+            policy.onloop(lag, len(events))
+
+        return events
+
+    def call_later(self, delay, func, *args):
+        """
+        Call `func` with `args` in the event loop thread after `delay`
+        seconds. Returns a timer object whose cancel() method cancels the
+        call (see `TimerQueue`).
+        """
+        timer = self.timers.call_later(delay, func, *args)
+
+        # The event loop may be waiting for a later deadline (the loop thread
+        # is not known if the loop is driven by handle_events() directly)
+        if current_thread() is not self.loop_thread and \
+                self.timers.first() is timer:
+            self.wakeup()
+
+        return timer
+
+    def handle_events(self, timeout=1):
+        """
+        Wait at most `timeout` seconds for events and handle them, and make
+        the scheduled calls that are due. A timeout of None or a negative
+        timeout waits until there are events or a call is due.
+        """
+        timeout = self.timers.timeout(timeout)
+
+        if timeout is None:
+            timeout = -1
+
+        for fileno, event in self.poll(timeout):
+            if fileno == self.sock_fno and self.accepting:
                 try:
                     sock, addr = self.sock.accept()
                 except HandshakeError as e:
+                    self.stats.incr('handshake_errors')
                     logging.error('Invalid request: %s', e.message)
                     continue
+                except NonUpgradeRequest as e:
+                    self.respond(e.sock, e.response)
+                    continue
 
+                self.stats.incr('connections_accepted')
                 client = AsyncClient(self, sock)
                 client.fno = sock.fileno()
                 sock.setblocking(0)
@@ -121,39 +319,308 @@ class AsyncServer(Server):
                 self.conns[client.fno] = client
                 logging.debug('Registered client %s', client)
 
-            elif event & EPOLLHUP:
-                self.epoll.unregister(fileno)
-                del self.conns[fileno]
+                if self.profiler:
+                    self.profile_extensions(client)
+
+            elif fileno in self.responses:
+                self.do_respond(fileno)
+
+            elif fileno == self.wakeup_r:
+                self.run_calls()
+
+            elif fileno == self.upgrade_fno:
+                # The remaining events may be for transferred connections
+                self.hand_off()
+                break
+
+            elif event & EPOLLHUP and not event & EPOLLIN:
+                conn = self.conns[fileno]
+
+                if isinstance(conn, AsyncOutboundConnection):
+                    conn.onclose(None, 'connection hung up')
+                    conn.sock.close()
+                    self.discard(conn)
+                else:
+                    self.epoll.unregister(fileno)
+                    del self.conns[fileno]
 
             else:
                 conn = self.conns[fileno]
 
+                # A hung up socket may still have data to read (e.g. a CLOSE
+                # frame), which is read before handling the hangup
                 try:
-                    if event & EPOLLOUT:
+                    if event & EPOLLOUT and not event & EPOLLHUP:
                         conn.do_async_send()
                     elif event & EPOLLIN:
                         conn.do_async_recv(self.recvbuf_size)
                 except (KeyboardInterrupt, SystemExit):
                     raise
                 except SocketClosed:
+                    self.discard(conn)
                     continue
                 except Exception as e:
                     logging.error(format_exc(e).rstrip())
+                    self.discard(conn)
                     continue
 
                 self.update_mask(conn)
 
+        self.timers.run_due()
+
     def run(self):
+        self.loop_thread = current_thread()
+
+        if self.inherited:
+            logging.info('Inherited %d connections', len(self.inherited))
+
+            for state, sock in self.inherited:
+                self.restore_client(state, sock)
+
+            self.inherited = []
+
         try:
-            while True:
+            while not self.handed_off:
                 self.handle_events()
+
+                if self.sweep_idle:
+                    self.release_idle()
+
+            self.quit_gracefully()
         except (KeyboardInterrupt, SystemExit):
             logging.info('Received interrupt, stopping server...')
+            self.quit_gracefully()
         finally:
-            self.epoll.unregister(self.sock.fileno())
+            self.stop_accepting()
             self.epoll.close()
+
+            if self.upgrade_fno is not None:
+                self.upgrade_sock.close()
+
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+
+    def release_idle(self):
+        """
+        Let the extension instances of all clients release resources that
+        have not been used for a while (see `CompressionPolicy`).
+        """
+        now = time.time()
+
+        if now < self.next_sweep:
+            return
+
+        self.next_sweep = now + IDLE_SWEEP_INTERVAL
+
+        for client in self.clients:
+            # Contexts may be in use by a worker thread
+            if client.send_pipeline.steps or client.recv_pipeline.steps:
+                continue
+
+            for inst in client.sock.extension_instances:
+                inst.release_idle(now)
+
+    def stop_accepting(self):
+        if self.accepting:
+            self.accepting = False
+            self.epoll.unregister(self.sock_fno)
             self.sock.close()
 
+    def send_close(self, client, deadline):
+        client.close(CLOSE_GOING_AWAY, 'server shutting down')
+        self.update_mask(client)
+
+    def close_batch_sent(self):
+        # Write the CLOSE frames and handle responses before the next batch
+        self.handle_events(0)
+
+    def wait_closed(self, deadline):
+        while self.clients:
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                break
+
+            self.handle_events(min(remaining, 1))
+
+    def abort(self, client):
+        client.onclose(None, 'connection aborted')
+
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def hand_off(self):
+        """
+        Pass the listening socket and the established connections to the new
+        server process that has connected to the upgrade socket, after which
+        run() closes the remaining connections and returns. SSL connections,
+        closing connections, connections with running handlers and
+        connections with extensions that keep compression contexts between
+        messages cannot be transferred, and are closed gracefully instead.
+        """
+        conn, addr = self.upgrade_sock.accept()
+        self.epoll.unregister(self.upgrade_fno)
+        self.upgrade_sock.close()
+        self.upgrade_fno = None
+
+        # Calls made by handlers that have finished are written first
+        self.run_calls()
+
+        ntransferred = 0
+
+        try:
+            send_state(conn, {'type': 'listener', 'family': self.sock.family},
+                       self.sock.fileno())
+            self.stop_accepting()
+
+            for client in self.clients:
+                if not is_transferable(client):
+                    continue
+
+                send_state(conn, client_state(client), client.fno)
+                self.epoll.unregister(client.fno)
+                del self.conns[client.fno]
+                client.sock.close()
+                ntransferred += 1
+
+            send_state(conn, {'type': 'done'})
+        except socket.error as e:
+            logging.error('Handoff failed: %s', e)
+        finally:
+            conn.close()
+
+        # Without the listening socket, the remaining clients are closed
+        self.handed_off = not self.accepting
+        logging.info('Handed off %d connections to new process', ntransferred)
+
+    def restore_client(self, state, sock):
+        """
+        Register a connection that has been transferred by the previous
+        server process. The onopen() handler is called for the client, whose
+        `inherited` attribute is set to True.
+        """
+        wsock = websocket(sock, capture=self.sock.capture)
+
+        try:
+            restore_socket(wsock, state, self.sock.extensions)
+        except KeyError as e:
+            logging.error('Could not restore connection: %s', e.message)
+            sock.close()
+            return
+
+        sock.setblocking(0)
+        client = AsyncClient(self, wsock, inherited=True)
+        restore_connection(client, state)
+        client.fno = sock.fileno()
+        self.epoll.register(client.fno, EPOLLIN)
+        self.conns[client.fno] = client
+        self.update_mask(client)
+        logging.debug('Restored client %s', client)
+
+        if self.profiler:
+            self.profile_extensions(client)
+
+    def from_worker(self, conn, func, *args):
+        """
+        If the calling thread is not the event loop thread, enqueue a call of
+        `func` with `args` to be made by the event loop thread, and return
+        True. Otherwise, return False so that the caller proceeds.
+        """
+        if self.loop_thread is None or current_thread() is self.loop_thread:
+            return False
+
+        self.call_soon(conn, func, *args)
+        return True
+
+    def call_soon(self, conn, func, *args):
+        """
+        Enqueue a call of `func` with `args` for connection `conn`, to be made
+        by the event loop thread, also when the event loop is driven by
+        handle_events() instead of run().
+        """
+        self.calls.append((conn, func, args))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, '\0')
+        except OSError as e:
+            # A full pipe will wake up the event loop anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run_calls(self):
+        try:
+            os.read(self.wakeup_r, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        while self.calls:
+            conn, func, args = self.calls.popleft()
+
+            if self.conns.get(conn.fno) is not conn:
+                logging.debug('Dropped call for closed %s', conn)
+                continue
+
+            try:
+                func(*args)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except SocketClosed:
+                continue
+            except Exception as e:
+                logging.error(format_exc(e).rstrip())
+                continue
+
+            self.update_mask(conn)
+
+    def submit(self, func, *args):
+        """
+        Call `func` with `args` in a worker thread.
+        """
+        if not self.workers:
+            self.workers = ThreadPool(4)
+
+        self.workers.submit(func, *args)
+
+    def profile_extensions(self, client):
+        for inst in client.sock.extension_instances:
+            for name in ('onsend', 'onrecv'):
+                hook = self.profiler.timed('%s.%s' % (inst.name, name),
+                                           getattr(inst, name), client)
+                setattr(inst, name, hook)
+
+        # The compiled hooks refer to the methods that were replaced
+        client.sock.compile_hooks()
+
+    def respond(self, sock, response):
+        """
+        Enqueue the response to a non-upgrade request, which is written in
+        do_respond() when the socket is ready for writing.
+        """
+        sock.setblocking(0)
+        sock.sendbuf = response
+        self.responses[sock.fileno()] = sock
+        self.epoll.register(sock.fileno(), EPOLLOUT)
+
+    def do_respond(self, fileno):
+        sock = self.responses[fileno]
+
+        try:
+            sock.do_async_send()
+
+            if sock.can_send():
+                return
+        except socket.error as e:
+            logging.error('Could not respond to %s: %s', sock.location, e)
+
+        self.epoll.unregister(fileno)
+        del self.responses[fileno]
+        sock.close()
+
     def update_mask(self, conn):
         mask = 0
 
@@ -170,20 +637,204 @@ class AsyncServer(Server):
 
 
 class AsyncClient(Client, AsyncConnection):
-    def __init__(self, server, sock):
+    def __init__(self, server, sock, inherited=False):
         self.server = server
+        self.inherited = inherited
+        self.init_tasks()
+
+        if server.codec:
+            self.codec = server.codec
+
+        # Compression is only offloaded if an extension is negotiated
+        self.offload_size = server.offload_size \
+                            if sock.extension_instances else None
+        self.send_pipeline = Pipeline(server, self)
+        self.recv_pipeline = Pipeline(server, self)
+        sock.defer_recv_hooks = bool(self.offload_size)
+
         AsyncConnection.__init__(self, sock)
 
     def send(self, message, fragment_size=None, mask=False):
+        if self.server.from_worker(self, self.send, message, fragment_size,
+                                   mask):
+            return
+
+        if self.close_frame_sent:
+            logging.debug('Dropped %s to closing %s', message, self)
+            return
+
         logging.debug('Enqueueing %s to %s', message, self)
-        AsyncConnection.send(self, message, fragment_size, mask)
+        self.server.stats.incr('messages_sent')
+
+        if self.offload_size:
+            offload = len(message.payload) >= self.offload_size
+            enqueue = lambda frames: self.enqueue(message, frames)
+            self.send_pipeline.add(self.encode, (message, fragment_size, mask),
+                                   enqueue, offload)
+        else:
+            AsyncConnection.send(self, message, fragment_size, mask)
+
         self.server.update_mask(self)
 
+    def encode(self, message, fragment_size, mask):
+        return self.sock.send_batch_hook(list(self.message_to_frames(
+            message, fragment_size, mask)))
+
+    def enqueue(self, message, frames):
+        for frame in frames[:-1]:
+            self.sock.queue_frame(frame)
+
+        self.sock.queue_frame(frames[-1], lambda: self.onsent(message))
+
+    def send_frame(self, frame, callback=None):
+        # Control frames must not overtake messages that are being compressed
+        if self.send_pipeline.steps:
+            enqueue = lambda frame: self.sock.queue_frame(frame, callback)
+            self.send_pipeline.add(self.sock.send_hook, (frame,),
+                                   enqueue, False)
+        else:
+            AsyncConnection.send_frame(self, frame, callback)
+
+    def feed_frame(self, frame):
+        if not self.sock.defer_recv_hooks:
+            AsyncConnection.feed_frame(self, frame)
+        elif isinstance(frame, ControlFrame):
+            self.recv_pipeline.add(self.sock.recv_hook, (frame,),
+                                   self.handle_control_frame, False)
+        else:
+            # Fragments are inflated one by one, in time proportional to
+            # their size
+            offload = len(frame.payload) * INFLATE_RATIO >= self.offload_size
+            self.recv_pipeline.add(self.decode, (frame,), self.deliver,
+                                   offload)
+
+    def decode(self, frame):
+        return self.add_fragment(self.sock.recv_hook(frame))
+
+    def deliver(self, message):
+        if message is not None:
+            self.onmessage(message)
+
+    def send_ping(self, payload=''):
+        if not self.server.from_worker(self, self.send_ping, payload):
+            AsyncConnection.send_ping(self, payload)
+
+    def close(self, code=None, reason=''):
+        if not self.server.from_worker(self, self.close, code, reason):
+            AsyncConnection.close(self, code, reason)
+
     def onsent(self, message):
         logging.debug('Finished sending %s to %s', message, self)
         self.server.onsent(self, message)
 
 
+class Pipeline(object):
+    """
+    Ordered steps of a single connection, in one direction. A step is a
+    function whose result is passed to a callback in the event loop thread.
+    Steps for large payloads are run in a worker thread, the others are run
+    in the event loop thread, but a step never starts before the previous
+    step has finished. This keeps the messages of a connection in order, and
+    makes sure that a compression context is used by one thread at a time.
+    """
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.steps = deque()
+
+    def add(self, func, args, callback, offload):
+        if not self.steps and not offload:
+            callback(func(*args))
+            return
+
+        self.steps.append((func, args, callback, offload))
+
+        if len(self.steps) == 1:
+            self.run()
+
+    def run(self):
+        while self.steps:
+            func, args, callback, offload = self.steps[0]
+
+            if offload:
+                self.server.submit(self.work, func, args)
+                return
+
+            self.steps.popleft()
+            callback(func(*args))
+
+    def work(self, func, args):
+        # Called in a worker thread, while the event loop thread may close the
+        # connection
+        try:
+            with self.conn.sock.using_extensions():
+                result, error = func(*args), None
+        except Exception as e:
+            result, error = None, e
+
+        self.server.call_soon(self.conn, self.conn.execute_controlled,
+                              self.finish, result, error)
+
+    def finish(self, result, error):
+        func, args, callback, offload = self.steps.popleft()
+
+        if error:
+            raise error
+
+        callback(result)
+        self.run()
+
+
+class AsyncOutboundConnection(AsyncConnection):
+    """
+    An outbound (client side) connection that is driven by the event loop of
+    an `AsyncServer`, so that a single thread can handle both incoming and
+    outgoing connections (e.g. to proxy messages between them). Like a
+    `Connection`, the extending class should implement the on*() event
+    handlers. The connection is opened using `AsyncServer.connect`, and the
+    onopen() handler is called after the handshake has completed. Messages
+    may be sent before that, they are queued until the handshake completes.
+    All sent frames are masked.
+
+    Example of a server that forwards messages of its clients to an upstream
+    server:
+    >>> import wspy
+
+    >>> class Upstream(wspy.AsyncOutboundConnection):
+    >>>     def onmessage(self, message):
+    >>>         print 'Upstream replied "%s"' % message.payload
+
+    >>> class Proxy(wspy.AsyncServer):
+    >>>     def onmessage(self, client, message):
+    >>>         self.upstream.send(message)
+
+    >>> proxy = Proxy(('', 8000))
+    >>> proxy.upstream = proxy.connect(Upstream, ('upstream', 8000))
+    >>> proxy.run()
+    """
+    def __init__(self, server, sock):
+        self.server = server
+        AsyncConnection.__init__(self, sock)
+
+    def __str__(self):
+        try:
+            return '<Outbound connection to %s:%d>' % self.sock.getpeername()
+        except socket.error:
+            return '<Outbound connection on unconnected socket>'
+
+    def send(self, message, fragment_size=None, mask=True):
+        AsyncConnection.send(self, message, fragment_size, mask)
+        self.server.update_mask(self)
+
+    def send_ping(self, payload=''):
+        AsyncConnection.send_ping(self, payload)
+        self.server.update_mask(self)
+
+    def close(self, code=None, reason=''):
+        AsyncConnection.close(self, code, reason)
+        self.server.update_mask(self)
+
+
 if __name__ == '__main__':
     import sys
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
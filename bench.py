@@ -0,0 +1,444 @@
+import os
+import zlib
+import sys
+import time
+import json
+import socket
+import logging
+from threading import Thread
+from multiprocessing import Process
+
+from websocket import websocket
+from connection import Connection
+from frame import Frame, OPCODE_TEXT, read_frame, mask
+from message import TextMessage, BinaryMessage, create_message
+from errors import SocketClosed
+from deflate_frame import DeflateFrame
+from deflate_message import DeflateMessage
+from compression import CompressionPolicy
+from codec import JsonCodec
+from stats import percentiles
+from server import Server
+from async import AsyncServer
+from loadgen import LoadGenerator
+import aio
+
+if aio.asyncio:
+    from aio import asyncio, From
+
+
+PAYLOAD_SIZES = [16, 1024, 65536]
+COMPRESSIBLE = ('{"id": %d, "name": "item", "tags": ["a", "b", "c"], '
+                '"value": 3.14159}, ' * 1000)[:65536]
+
+
+def measure(func, min_time):
+    """
+    Call `func` repeatedly during at least `min_time` seconds. Returns the
+    number of calls per second.
+    """
+    ncalls = 0
+    start = time.time()
+
+    while True:
+        func()
+        ncalls += 1
+        elapsed = time.time() - start
+
+        if elapsed >= min_time:
+            return ncalls / elapsed
+
+
+def bench_codec(min_time):
+    for size in PAYLOAD_SIZES:
+        payload = os.urandom(size)
+        key = os.urandom(4)
+
+        for masked in (False, True):
+            frame = Frame(OPCODE_TEXT, payload, masking_key=key if masked
+                          else '')
+            packed = str(frame.pack())
+            name = 'masked' if masked else 'unmasked'
+
+            ops = measure(frame.pack, min_time)
+            yield 'frame.pack', dict(size=size, mask=name), \
+                  dict(ops_per_sec=ops, bytes_per_sec=ops * size)
+
+            ops = measure(lambda: read_frame(packed), min_time)
+            yield 'frame.decode', dict(size=size, mask=name), \
+                  dict(ops_per_sec=ops, bytes_per_sec=ops * size)
+
+        ops = measure(lambda: mask(key, payload), min_time)
+        yield 'frame.mask', dict(size=size), \
+              dict(ops_per_sec=ops, bytes_per_sec=ops * size)
+
+        # Send and receive frames through a pair of connected websockets
+        a, b = socket.socketpair()
+        sender = websocket(a)
+        receiver = websocket(b)
+        frame = Frame(OPCODE_TEXT, payload)
+
+        def roundtrip():
+            sender.send(frame)
+            receiver.recv()
+
+        ops = measure(roundtrip, min_time)
+        yield 'frame.socketpair', dict(size=size), \
+              dict(ops_per_sec=ops, bytes_per_sec=ops * size)
+        a.close()
+        b.close()
+
+    # Objects encoded to and decoded from JSON through a TextMessage, versus
+    # a codec (with an encode cache for an object sent to many clients)
+    for nitems in (1, 100):
+        obj = {'items': [{'id': i, 'name': u'item \xe9', 'value': 3.14}
+                         for i in xrange(nitems)]}
+        payload = json.dumps(obj, separators=(',', ':'))
+        size = len(payload)
+        codecs = (('text', None), ('codec', JsonCodec()),
+                  ('cached', JsonCodec(cache_size=16)))
+
+        for codec_name, codec in codecs:
+            if codec:
+                encode = lambda: codec.message(obj).frame().pack()
+            else:
+                encode = lambda: TextMessage(json.dumps(obj)).frame().pack()
+
+            ops = measure(encode, min_time)
+            yield 'message.encode', dict(items=nitems, codec=codec_name), \
+                  dict(ops_per_sec=ops, bytes_per_sec=ops * size)
+
+            if codec_name == 'cached':
+                continue
+
+            if codec:
+                decode = lambda: codec.decode_message(payload).obj
+            else:
+                decode = lambda: json.loads(
+                        create_message(OPCODE_TEXT, payload).payload)
+
+            ops = measure(decode, min_time)
+            yield 'message.decode', dict(items=nitems, codec=codec_name), \
+                  dict(ops_per_sec=ops, bytes_per_sec=ops * size)
+
+
+def deflate_instance(ext, name, params={}):
+    return ext.Instance(ext, name, params)
+
+
+def bench_deflate(min_time):
+    extensions = [
+        (DeflateFrame(), 'deflate-frame', {}),
+        (DeflateFrame(), 'deflate-frame', {'no_context_takeover': True}),
+        (DeflateMessage(), 'permessage-deflate', {}),
+        (DeflateMessage(), 'permessage-deflate',
+         {'server_no_context_takeover': True,
+          'client_no_context_takeover': True}),
+    ]
+
+    for ext, name, params in extensions:
+        for data_name, data in (('json', COMPRESSIBLE),
+                                ('random', os.urandom(len(COMPRESSIBLE)))):
+            for size in PAYLOAD_SIZES:
+                payload = data[:size]
+                sender = deflate_instance(ext, name, params)
+                compressed = sender.deflate(payload)
+                config = dict(extension=name, data=data_name, size=size,
+                              no_context_takeover=bool(params))
+
+                ops = measure(lambda: sender.deflate(payload), min_time)
+                yield 'deflate.compress', config, \
+                      dict(ops_per_sec=ops, bytes_per_sec=ops * size,
+                           ratio=float(len(compressed)) / size)
+
+                # Use a fresh context for each inflate, since the compressed
+                # data may refer to the context of the deflate call
+                receiver_params = dict(params)
+
+                def inflate():
+                    receiver = deflate_instance(ext, name, receiver_params)
+                    receiver.inflate(compressed)
+
+                ops = measure(inflate, min_time)
+                yield 'deflate.inflate', config, \
+                      dict(ops_per_sec=ops, bytes_per_sec=ops * size)
+
+    # Per-message cost without context takeover, with a new compression
+    # context for each message versus a pooled context
+    policy = CompressionPolicy()
+
+    def compress_new(payload):
+        defl = zlib.compressobj(policy.level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                policy.mem_level, policy.strategy)
+        defl.compress(payload)
+        defl.flush(zlib.Z_SYNC_FLUSH)
+
+    def compress_pooled(payload):
+        defl = policy.acquire_compressor(policy.level, zlib.MAX_WBITS)
+        defl.compress(payload)
+        defl.flush(zlib.Z_FULL_FLUSH)
+        policy.recycle_compressor(defl, policy.level, zlib.MAX_WBITS)
+
+    for size in PAYLOAD_SIZES:
+        payload = COMPRESSIBLE[:size]
+
+        for context, func in (('new', compress_new),
+                              ('pooled', compress_pooled)):
+            ops = measure(lambda: func(payload), min_time)
+            yield 'deflate.context', dict(size=size, context=context), \
+                  dict(ops_per_sec=ops, usec_per_message=1e6 / ops)
+
+    # Fragmented messages passed to the extension frame by frame, versus as
+    # a batch that is compressed with a single flush
+    ext = DeflateMessage()
+    sender = deflate_instance(ext, ext.name)
+    hooks = (('frame', lambda frames: map(sender.handle_send, frames)),
+             ('batch', sender.send_batch_hook()))
+
+    for fragment_size in (512, 4096):
+        fragments = lambda: Frame(OPCODE_TEXT, COMPRESSIBLE).fragment(
+                fragment_size)
+
+        for hook_name, hook in hooks:
+            size = sum(len(frame.payload) for frame in hook(fragments()))
+            ops = measure(lambda: hook(fragments()), min_time)
+            yield 'deflate.fragments', \
+                  dict(fragment_size=fragment_size, hook=hook_name), \
+                  dict(ops_per_sec=ops, bytes_per_sec=ops * len(COMPRESSIBLE),
+                       ratio=float(size) / len(COMPRESSIBLE))
+
+
+def echo_server(server_class, **kwargs):
+    def serve_forever(port):
+        class EchoServer(server_class):
+            def onmessage(self, client, message):
+                client.send(message)
+
+        EchoServer(('127.0.0.1', port), loglevel=logging.CRITICAL,
+                   **kwargs).run()
+
+    return serve_forever
+
+
+def serve_asyncio(port):
+    @asyncio.coroutine
+    def echo(conn):
+        while True:
+            message = yield From(conn.recv())
+            yield From(conn.send(message))
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(aio.serve(echo, '127.0.0.1', port, loop=loop))
+    loop.run_forever()
+
+
+SERVERS = [('threaded', echo_server(Server)),
+           ('io-threads', echo_server(Server, io_threads=2)),
+           ('async', echo_server(AsyncServer))]
+
+if aio.asyncio:
+    SERVERS.append(('asyncio', serve_asyncio))
+
+
+def start_server(serve_forever, port):
+    process = Process(target=serve_forever, args=(port,))
+    process.daemon = True
+    process.start()
+
+    # Wait for the server to listen, using a complete handshake because the
+    # server blocks on incomplete handshakes
+    for i in xrange(100):
+        try:
+            close(connect(port))
+            break
+        except socket.error:
+            time.sleep(0.050)
+
+    return process
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def connect(port):
+    sock = websocket()
+    sock.connect(('127.0.0.1', port))
+    return Connection(sock)
+
+
+def close(conn):
+    try:
+        conn.close()
+    except SocketClosed:
+        pass
+
+
+def bench_handshake(min_time):
+    for name, serve_forever in SERVERS:
+        port = free_port()
+        process = start_server(serve_forever, port)
+
+        try:
+            ops = measure(lambda: close(connect(port)), min_time)
+        finally:
+            process.terminate()
+
+        yield 'handshake', dict(server=name), dict(ops_per_sec=ops)
+
+
+def echo_client(port, payload, min_time, latencies):
+    conn = connect(port)
+    message = BinaryMessage(payload)
+    start = time.time()
+
+    while time.time() - start < min_time:
+        sent = time.time()
+        conn.send(message, mask=True)
+        conn.recv()
+        latencies.append(time.time() - sent)
+
+    close(conn)
+
+
+def bench_echo(min_time, nclients=(1, 10), sizes=(16, 1024)):
+    for name, serve_forever in SERVERS:
+        port = free_port()
+        process = start_server(serve_forever, port)
+
+        try:
+            for n in nclients:
+                for size in sizes:
+                    latencies = []
+                    payload = os.urandom(size)
+                    threads = [Thread(target=echo_client,
+                                      args=(port, payload, min_time,
+                                            latencies))
+                               for i in xrange(n)]
+                    start = time.time()
+
+                    for thread in threads:
+                        thread.start()
+
+                    for thread in threads:
+                        thread.join()
+
+                    elapsed = time.time() - start
+                    yield 'echo', dict(server=name, clients=n, size=size), \
+                          dict(messages_per_sec=len(latencies) / elapsed,
+                               latency=percentiles(latencies))
+        finally:
+            process.terminate()
+
+
+def process_status(pid):
+    """
+    Return the resident memory (in bytes) and number of threads of process
+    `pid`, read from /proc (Linux only).
+    """
+    status = {}
+
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            status[name] = value.split()
+
+    return int(status['VmRSS'][0]) * 1024, int(status['Threads'][0])
+
+
+def bench_connections(min_time, nidle=1000, nactive=100, rate=10.0):
+    for name, serve_forever in SERVERS:
+        port = free_port()
+        process = start_server(serve_forever, port)
+
+        try:
+            base_rss, base_threads = process_status(process.pid)
+            conns = [connect(port) for i in xrange(nidle)]
+            time.sleep(0.5)
+            rss, threads = process_status(process.pid)
+            yield 'connections.idle', dict(server=name, connections=nidle), \
+                  dict(rss_bytes=rss,
+                       rss_bytes_per_conn=(rss - base_rss) / nidle,
+                       threads=threads)
+
+            # Active connections send messages on top of the idle ones
+            gen = LoadGenerator(('127.0.0.1', port), nconns=nactive,
+                                rate=rate, size=64, ramp_up=0.5,
+                                duration=max(min_time, 1.0))
+            results = gen.run()
+            rss, threads = process_status(process.pid)
+            yield 'connections.active', \
+                  dict(server=name, idle=nidle, active=nactive, rate=rate), \
+                  dict(messages_per_sec=results['receive_rate'],
+                       latency=results.get('latency', {}),
+                       failed=results['connections_failed'],
+                       rss_bytes=rss, threads=threads)
+
+            for conn in conns:
+                close(conn)
+        finally:
+            process.terminate()
+
+
+SUITES = [
+    ('codec', bench_codec),
+    ('deflate', bench_deflate),
+    ('handshake', bench_handshake),
+    ('echo', bench_echo),
+    ('connections', bench_connections),
+]
+
+
+def run(suites=None, min_time=0.5, log=None):
+    """
+    Run the benchmark suites with the given names (all by default), and
+    return a list of results. Each result is a dictionary with the benchmark
+    name, its configuration and the measured values.
+    """
+    results = []
+
+    for suite, func in SUITES:
+        if suites and suite not in suites:
+            continue
+
+        for name, config, values in func(min_time):
+            result = dict(name=name, config=config, values=values)
+            results.append(result)
+
+            if log:
+                print >> log, json.dumps(result, sort_keys=True)
+
+    return results
+
+
+if __name__ == '__main__':
+    import platform
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Run wspy benchmarks.')
+    parser.add_argument('-s', '--suite', action='append',
+                        choices=[name for name, func in SUITES],
+                        help='only run this suite (can be repeated)')
+    parser.add_argument('-t', '--time', type=float, default=0.5,
+                        help='minimum time per benchmark in seconds')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='shorthand for --time 0.1')
+    parser.add_argument('-o', '--output', help='write JSON results to a file')
+    args = parser.parse_args()
+
+    results = run(args.suite, 0.1 if args.quick else args.time,
+                  log=sys.stderr)
+    report = dict(python=platform.python_version(),
+                  platform=platform.platform(), time=time.time(),
+                  results=results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+    else:
+        print json.dumps(report, indent=4, sort_keys=True)
@@ -0,0 +1,255 @@
+import struct
+import time
+import random
+from collections import deque, namedtuple
+from threading import Thread, Event
+
+from frame import printstr
+
+
+__all__ = ['Capture', 'read_capture']
+
+
+MAGIC = 'WSPYCAP1'
+
+# Each record consists of a header, followed by the captured part of the
+# payload: timestamp, connection (file descriptor), flags, first frame header
+# byte (FIN, RSV1-3, opcode), payload length, captured payload length
+RECORD = struct.Struct('!dIBBQI')
+
+FLAG_OUTGOING = 0x1
+FLAG_MASKED = 0x2
+
+# Frames may be missing before the record, because frames are sampled or
+# because records were dropped from a full buffer
+FLAG_GAP = 0x4
+
+OPCODE_NAMES = {0x0: 'CONT', 0x1: 'TEXT', 0x2: 'BINARY', 0x8: 'CLOSE',
+                0x9: 'PING', 0xA: 'PONG'}
+
+
+class Capture(object):
+    """
+    Sampled frame tracing for websockets. Frames are recorded (at the wire
+    level, so after send hooks and before receive hooks of extensions) in a
+    bounded in-memory ring buffer, which is written to a compact binary file
+    by a background thread. When the buffer is full, the oldest records are
+    dropped and counted in `dropped`.
+
+    Assign a capture to the `capture` attribute of a websocket, or pass it to
+    a server using the `capture` argument, which is then inherited by all
+    accepted client sockets:
+    >>> import wspy
+    >>> capture = wspy.Capture('frames.cap', sample_rate=0.01)
+    >>> wspy.AsyncServer(('', 8000), capture=capture).run()
+
+    Use `python -m wspy.capture frames.cap` to inspect the capture file.
+    """
+    def __init__(self, filename, sample_rate=1.0, payloads=False,
+                 max_payload=64, bufsize=10000, flush_interval=1.0):
+        """
+        `filename` is the capture file, which is overwritten.
+
+        `sample_rate` is the fraction of frames that is recorded.
+
+        `payloads` indicates whether (the first `max_payload` bytes of)
+        payloads are recorded as well.
+
+        `bufsize` is the maximum number of records in the ring buffer.
+
+        `flush_interval` is the time (in seconds) between writes of the ring
+        buffer to the file.
+        """
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload if payloads else 0
+        self.flush_interval = flush_interval
+
+        self.buf = deque(maxlen=bufsize)
+        self.dropped = 0
+        self.flushed_dropped = 0
+
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+
+        self.stopped = Event()
+        self.thread = Thread(target=self.flush_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, sock, frame, outgoing):
+        """
+        Record `frame`, sent or received by websocket `sock`, if it is
+        sampled. Packing is deferred to the flushing thread.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+
+        if len(self.buf) == self.buf.maxlen:
+            self.dropped += 1
+
+        # Only the captured part of the payload is kept, so that the buffer
+        # does not hold on to entire messages until the next flush
+        payload = frame.payload
+        self.buf.append((time.time(), sock.fileno(), outgoing, frame.final,
+                         frame.rsv1, frame.rsv2, frame.rsv3, frame.opcode,
+                         frame.masking_key, len(payload),
+                         payload[:self.max_payload]))
+
+    def flush(self):
+        """
+        Write all buffered records to the capture file.
+        """
+        records = []
+
+        while self.buf:
+            records.append(self.buf.popleft())
+
+        # Dropped records are the oldest ones, so they precede the first
+        # record that is written
+        sampled = self.sample_rate < 1.0
+        gap = sampled or self.dropped != self.flushed_dropped
+        self.flushed_dropped = self.dropped
+
+        for timestamp, fileno, outgoing, final, rsv1, rsv2, rsv3, opcode, \
+                masking_key, length, captured in records:
+            flags = outgoing * FLAG_OUTGOING | bool(masking_key) * FLAG_MASKED
+            flags |= gap * FLAG_GAP
+            gap = sampled
+            b1 = final << 7 | rsv1 << 6 | rsv2 << 5 | rsv3 << 4 | opcode
+            captured = str(captured)
+            self.file.write(RECORD.pack(timestamp, fileno & 0xffffffff, flags,
+                                        b1, length, len(captured)))
+            self.file.write(captured)
+
+        self.file.flush()
+
+    def flush_forever(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """
+        Stop the flushing thread, write the remaining records and close the
+        capture file.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+Record = namedtuple('Record', 'time conn outgoing masked gap final rsv1 rsv2 '
+                              'rsv3 opcode length payload')
+
+
+def read_capture(f):
+    """
+    Generate `Record` tuples from an opened capture file `f`.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a wspy capture file')
+
+    while True:
+        header = f.read(RECORD.size)
+
+        if len(header) < RECORD.size:
+            break
+
+        timestamp, conn, flags, b1, length, captured = RECORD.unpack(header)
+        yield Record(timestamp, conn, bool(flags & FLAG_OUTGOING),
+                     bool(flags & FLAG_MASKED), bool(flags & FLAG_GAP),
+                     bool(b1 & 0x80), bool(b1 & 0x40), bool(b1 & 0x20),
+                     bool(b1 & 0x10), b1 & 0x0F, length, f.read(captured))
+
+
+def format_record(record, start):
+    flags = ''.join(c if on else '-' for c, on in
+                    zip('FRRRM', (record.final, record.rsv1, record.rsv2,
+                                  record.rsv3, record.masked)))
+    s = '%10.6f %5d %s %-6s %s %8d' \
+        % (record.time - start, record.conn, '>' if record.outgoing else '<',
+           OPCODE_NAMES.get(record.opcode, '0x%X' % record.opcode), flags,
+           record.length)
+
+    if record.payload:
+        s += ' ' + printstr(record.payload)
+
+    return s
+
+
+def statistics(records):
+    """
+    Compute frame counts and payload sizes per (direction, opcode) pair.
+    Returns a list of formatted lines.
+    """
+    groups = {}
+    first = last = None
+
+    for record in records:
+        if first is None:
+            first = record.time
+
+        last = record.time
+        key = 'out' if record.outgoing else 'in', record.opcode
+
+        if key in groups:
+            count, total, minimum, maximum = groups[key]
+            groups[key] = count + 1, total + record.length, \
+                          min(minimum, record.length), \
+                          max(maximum, record.length)
+        else:
+            groups[key] = 1, record.length, record.length, record.length
+
+    if first is None:
+        return ['no records']
+
+    duration = last - first
+    lines = ['%.3f seconds' % duration]
+
+    for (direction, opcode), (count, total, minimum, maximum) \
+            in sorted(groups.items()):
+        rate = ', %.1f frames/s' % (count / duration) if duration else ''
+        lines.append('%-3s %-6s %d frames%s, %d bytes, size min/avg/max '
+                     '%d/%d/%d'
+                     % (direction, OPCODE_NAMES.get(opcode, '0x%X' % opcode),
+                        count, rate, total, minimum, total / count, maximum))
+
+    return lines
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Print, filter and summarize wspy '
+                                        'frame capture files.')
+    parser.add_argument('file', help='capture file')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='print statistics instead of frames')
+    parser.add_argument('-c', '--conn', type=int,
+                        help='only show frames of this connection')
+    parser.add_argument('-o', '--opcode', type=lambda x: int(x, 0),
+                        help='only show frames with this opcode')
+    parser.add_argument('-d', '--direction', choices=('in', 'out'),
+                        help='only show received (in) or sent (out) frames')
+    args = parser.parse_args()
+
+    def matches(record):
+        return (args.conn is None or record.conn == args.conn) \
+               and (args.opcode is None or record.opcode == args.opcode) \
+               and (args.direction is None
+                    or record.outgoing == (args.direction == 'out'))
+
+    with open(args.file, 'rb') as f:
+        records = (r for r in read_capture(f) if matches(r))
+
+        if args.stats:
+            for line in statistics(records):
+                print line
+        else:
+            start = None
+
+            for record in records:
+                if start is None:
+                    start = record.time
+
+                print format_record(record, start)
@@ -0,0 +1,147 @@
+import json
+import struct
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from frame import OPCODE_TEXT, OPCODE_BINARY
+from message import EncodedMessage
+
+
+__all__ = ['Codec', 'JsonCodec', 'MsgpackCodec', 'StructCodec']
+
+
+class Codec(object):
+    """
+    Converts objects to message payloads and back, for
+    `Connection.send_object` and for received messages with the codec's
+    `opcode`. Payloads are encoded to and decoded from the frame bytes
+    directly, so text payloads do not go through unicode like a
+    `TextMessage`.
+
+    If a `cache_size` is specified, the messages of the last `cache_size`
+    objects are cached by object identity, so that an object which is sent
+    to many connections is only encoded once. With a cache, an object must
+    not be modified after it has been sent, since it would be sent with its
+    old encoding.
+
+    Extending classes implement encode() and decode().
+    """
+    opcode = OPCODE_BINARY
+
+    def __init__(self, cache_size=0):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = Lock()
+
+    def encode(self, obj):
+        """
+        Encode `obj` to a payload string.
+        """
+        raise NotImplementedError
+
+    def decode(self, payload):
+        """
+        Decode a received payload string to an object.
+        """
+        raise NotImplementedError
+
+    def message(self, obj, compress=True):
+        """
+        Get an `EncodedMessage` of `obj`.
+        """
+        if not self.cache_size or not compress:
+            return EncodedMessage(self.opcode, self.encode(obj), obj,
+                                  compress)
+
+        key = id(obj)
+
+        with self.lock:
+            message = self.cache.pop(key, None)
+
+            # The message holds a reference to its object, so an ID is not
+            # reused while it is in the cache
+            if message is not None:
+                self.cache[key] = message
+                return message
+
+        message = EncodedMessage(self.opcode, self.encode(obj), obj)
+
+        with self.lock:
+            self.cache[key] = message
+
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return message
+
+    def decode_message(self, payload):
+        """
+        Create an `EncodedMessage` from a received payload.
+        """
+        return EncodedMessage(self.opcode, payload, self.decode(payload))
+
+
+class JsonCodec(Codec):
+    """
+    Encodes objects as JSON text messages. Non-ASCII characters are escaped,
+    so the encoded JSON is valid UTF-8 without encoding it.
+
+    Example:
+    >>> class JsonServer(wspy.AsyncServer):
+    >>>     def onmessage(self, client, message):
+    >>>         client.send_object({'echo': message.obj})
+
+    >>> JsonServer(('', 8000), codec=wspy.JsonCodec()).run()
+    """
+    opcode = OPCODE_TEXT
+
+    def __init__(self, cache_size=0, **kwargs):
+        """
+        The keyword arguments are passed to json.JSONEncoder.
+        """
+        super(JsonCodec, self).__init__(cache_size)
+        kwargs.setdefault('separators', (',', ':'))
+        self.encode = json.JSONEncoder(**kwargs).encode
+
+    def decode(self, payload):
+        return json.loads(str(payload))
+
+
+class MsgpackCodec(Codec):
+    """
+    Encodes objects as MessagePack binary messages, which requires the
+    msgpack package.
+    """
+    def __init__(self, cache_size=0):
+        if msgpack is None:
+            raise ImportError('msgpack is required for MsgpackCodec')
+
+        super(MsgpackCodec, self).__init__(cache_size)
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(str(payload), raw=False)
+
+
+class StructCodec(Codec):
+    """
+    Encodes tuples of fixed-size values as binary messages with a struct
+    format, such as '!IHd' for a tuple of an unsigned int, an unsigned short
+    and a double in network byte order.
+    """
+    def __init__(self, fmt, cache_size=0):
+        super(StructCodec, self).__init__(cache_size)
+        self.struct = struct.Struct(fmt)
+
+    def encode(self, obj):
+        return self.struct.pack(*obj)
+
+    def decode(self, payload):
+        return self.struct.unpack(str(payload))
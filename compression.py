@@ -0,0 +1,211 @@
+import zlib
+from threading import Lock
+
+
+__all__ = ['CompressionPolicy']
+
+
+class CompressionPolicy(object):
+    """
+    Decides if and how the `DeflateFrame` and `DeflateMessage` extensions
+    compress outgoing frames. A policy is passed to the extension constructor,
+    and is shared by all connections that negotiate the extension.
+
+    For each connection, the policy keeps a rolling compression ratio per
+    opcode and payload size range (powers of two). Compression is turned off
+    for frames of a kind that do not compress well (e.g. already compressed
+    images), except for a probe every `probe_interval` frames to notice when
+    the data changes. Messages can also be excluded individually by creating
+    them with compress=False.
+
+    Example:
+    >>> import wspy, zlib
+    >>> policy = wspy.CompressionPolicy(level=1, strategy=zlib.Z_FILTERED,
+    >>>                                 max_lag=0.05)
+    >>> server = wspy.AsyncServer(('', 8000),
+    >>>                           extensions=[wspy.DeflateMessage(policy)])
+
+    The policy also keeps track of the memory used by the zlib contexts of
+    all connections. Contexts are allocated when they are first used, and
+    the memory usage can be limited by a budget (see `limits`).
+
+    Extend this class and override `should_compress` and `record` to
+    implement a different policy.
+    """
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION,
+                 mem_level=zlib.DEF_MEM_LEVEL,
+                 strategy=zlib.Z_DEFAULT_STRATEGY, threshold=None,
+                 max_ratio=0.9, min_samples=5, probe_interval=50,
+                 smoothing=0.2, max_lag=None, lag_level=1,
+                 memory_budget=None, min_window_bits=9, idle_time=None,
+                 pool_size=8):
+        """
+        `level`, `mem_level` and `strategy` are passed to zlib.compressobj.
+
+        `threshold` is the minimal payload size for compression, it defaults
+        to the `compression_threshold` of the extension (20 bytes).
+
+        `max_ratio` is the compressed/original size ratio above which the
+        compression of similar frames is turned off, after at least
+        `min_samples` frames have been compressed. `smoothing` is the weight
+        of a new ratio in the rolling average.
+
+        `max_lag` is an optional event loop lag (in seconds) of an
+        `AsyncServer`, above which frames are compressed at `lag_level`
+        instead of `level` to save CPU time. Changing the level resets the
+        compression context of a connection.
+
+        `memory_budget` is an optional number of bytes that the zlib
+        contexts of all connections should fit in. When it fills up, new
+        connections negotiate window sizes down to `min_window_bits`, and
+        eventually no context takeover.
+
+        `idle_time` is an optional number of seconds after which an
+        `AsyncServer` releases the compression context of a connection that
+        has not sent or received messages. The context is recreated when
+        needed, at the cost of compression ratio for the next message.
+
+        `pool_size` is the number of unused compression contexts per level
+        and window size that are kept for messages without context takeover.
+        """
+        self.level = level
+        self.mem_level = mem_level
+        self.strategy = strategy
+        self.threshold = threshold
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.probe_interval = probe_interval
+        self.smoothing = smoothing
+        self.max_lag = max_lag
+        self.lag_level = lag_level
+        self.lag = 0.0
+        self.memory_budget = memory_budget
+        self.min_window_bits = min_window_bits
+        self.idle_time = idle_time
+        self.memory_used = 0
+        self.memory_lock = Lock()
+        self.pool_size = pool_size
+        self.compressor_pool = {}
+
+    def compressobj(self, level, window_bits):
+        self.allocate(self.compressor_size(window_bits))
+        return zlib.compressobj(level, zlib.DEFLATED, -window_bits,
+                                self.mem_level, self.strategy)
+
+    def decompressobj(self, window_bits):
+        self.allocate(self.decompressor_size(window_bits))
+        return zlib.decompressobj(-window_bits)
+
+    def acquire_compressor(self, level, window_bits):
+        """
+        Get a compression context for a single message without context
+        takeover, from the pool of unused contexts if possible.
+        """
+        try:
+            return self.compressor_pool[level, window_bits].pop()
+        except (KeyError, IndexError):
+            return self.compressobj(level, window_bits)
+
+    def recycle_compressor(self, defl, level, window_bits):
+        """
+        Return a context obtained from `acquire_compressor` to the pool. The
+        message must have been ended with a Z_FULL_FLUSH, which resets the
+        context so that the next message (possibly of another connection)
+        does not refer to earlier data.
+        """
+        pool = self.compressor_pool.setdefault((level, window_bits), [])
+
+        if len(pool) < self.pool_size:
+            pool.append(defl)
+        else:
+            self.release(self.compressor_size(window_bits))
+
+    def compressor_size(self, window_bits):
+        # Memory usage of deflate and inflate as documented in zconf.h
+        return (1 << (window_bits + 2)) + (1 << (self.mem_level + 9))
+
+    def decompressor_size(self, window_bits):
+        return (1 << window_bits) + 7168
+
+    def allocate(self, nbytes):
+        with self.memory_lock:
+            self.memory_used += nbytes
+
+    def release(self, nbytes):
+        with self.memory_lock:
+            self.memory_used -= nbytes
+
+    def limits(self):
+        """
+        Get the (maximum window bits, no context takeover) to negotiate for
+        a new connection. The window size is reduced step by step from half
+        of the memory budget, down to `min_window_bits` at 90%, from which
+        context takeover is disabled as well.
+        """
+        if not self.memory_budget:
+            return zlib.MAX_WBITS, False
+
+        pressure = self.memory_used / float(self.memory_budget)
+
+        if pressure < 0.5:
+            return zlib.MAX_WBITS, False
+
+        steps = int((pressure - 0.5) * 2.5 * (zlib.MAX_WBITS -
+                                              self.min_window_bits))
+        return max(zlib.MAX_WBITS - steps, self.min_window_bits), \
+               pressure >= 0.9
+
+    def current_level(self):
+        """
+        Get the compression level for new frames.
+        """
+        if self.max_lag is not None and self.lag > self.max_lag:
+            return self.lag_level
+
+        return self.level
+
+    def onloop(self, lag, nevents=0):
+        """
+        Called by an `AsyncServer` after each iteration of its event loop
+        (see `Profiler.onloop`), if `max_lag` is set.
+        """
+        self.lag += (lag - self.lag) * self.smoothing
+
+    def key(self, frame):
+        return frame.opcode, len(frame.payload).bit_length()
+
+    def should_compress(self, inst, frame):
+        """
+        Check if `frame` should be compressed by extension instance `inst`.
+        The per-connection statistics are kept in `inst.policy_state`.
+        """
+        threshold = self.threshold
+
+        if threshold is None:
+            threshold = inst.extension.compression_threshold
+
+        if not frame.compress or len(frame.payload) <= threshold:
+            return False
+
+        entry = inst.policy_state.get(self.key(frame))
+
+        if entry and entry[1] >= self.min_samples and \
+                entry[0] > self.max_ratio:
+            # Compression does not pay off, but probe again now and then
+            entry[2] += 1
+
+            if entry[2] < self.probe_interval:
+                return False
+
+            entry[2] = 0
+
+        return True
+
+    def record(self, inst, frame, compressed_size):
+        """
+        Called after `frame` has been compressed to `compressed_size` bytes.
+        """
+        ratio = compressed_size / float(len(frame.payload))
+        entry = inst.policy_state.setdefault(self.key(frame), [ratio, 0, 0])
+        entry[0] += (ratio - entry[0]) * self.smoothing
+        entry[1] += 1
@@ -1,9 +1,10 @@
 import socket
 
 from frame import ControlFrame, OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG, \
-                  OPCODE_CONTINUATION, create_close_frame
+                  OPCODE_CONTINUATION, CLOSE_MESSAGE_TOOBIG, \
+                  create_close_frame
 from message import create_message
-from errors import SocketClosed, PingError
+from errors import SocketClosed, PingError, MessageTooBig
 
 
 class Connection(object):
@@ -37,9 +38,15 @@ class Connection(object):
     >>>     client, addr = server.accept()
     >>>     EchoConnection(client).receive_forever()
     """
+    # `Codec` with which send_object() encodes objects, and with which
+    # received messages of its opcode are decoded into an `EncodedMessage`
+    codec = None
+
     def __init__(self, sock):
         """
-        `sock` is a websocket instance which has completed its handshake.
+        `sock` is a websocket instance which has completed its handshake, or
+        which is performing its handshake asynchronously (see
+        `websocket.connect_async`).
         """
         self.sock = sock
 
@@ -51,15 +58,23 @@ class Connection(object):
         self.hooks_send = []
         self.hooks_recv = []
 
-        self.onopen()
+        # Fragments received by feed_frame()
+        self.fragments = []
+
+        # A socket that is still connecting asynchronously is opened after
+        # its handshake has completed
+        if sock.client_handshake:
+            sock.handshake_callback = self.onopen
+        else:
+            self.onopen()
 
     def message_to_frames(self, message, fragment_size=None, mask=False):
-        frame = self.sock.apply_send_hooks(message.frame(mask=mask), True)
+        frame = self.sock.message_send_hook(message.frame(mask=mask))
 
         if fragment_size is None:
             yield frame
         else:
-            for fragment in frame.fragment(fragment_size):
+            for fragment in frame.fragment(fragment_size, mask):
                 yield fragment
 
     def send(self, message, fragment_size=None, mask=False):
@@ -68,8 +83,24 @@ class Connection(object):
         fragmented into multiple frames whose payload size does not extend
         `fragment_size`.
         """
-        for frame in self.message_to_frames(message, fragment_size, mask):
-            self.send_frame(frame)
+        # Fragments are sent in a single call so that they are not interleaved
+        # with frames sent by other threads
+        with self.sock.send_lock:
+            entry = self.sock.pack_frames(*self.message_to_frames(
+                message, fragment_size, mask))
+
+        self.sock.write(entry)
+
+    def send_object(self, obj, fragment_size=None, mask=None):
+        """
+        Encode `obj` with the connection's codec and send it (see send()).
+        Frames are masked by default for client sockets. Returns the result
+        of send(), which is a coroutine for an asyncio connection.
+        """
+        if mask is None:
+            mask = self.sock.mask_frames
+
+        return self.send(self.codec.message(obj), fragment_size, mask)
 
     def send_frame(self, frame, callback=None):
         self.sock.send(frame)
@@ -86,7 +117,7 @@ class Connection(object):
         """
         fragments = []
 
-        while not len(fragments) or not fragments[-1].final:
+        while True:
             frame = self.sock.recv()
 
             if isinstance(frame, ControlFrame):
@@ -97,7 +128,45 @@ class Connection(object):
             else:
                 fragments.append(frame)
 
-        return self.concat_fragments(fragments)
+                if frame.final:
+                    message = self.concat_fragments(fragments)
+
+                    if message is not None:
+                        return message
+
+                    fragments = []
+
+    def feed_frame(self, frame):
+        """
+        Handle a single received frame, calling onmessage() when the frame
+        completes a message. This is the non-blocking counterpart of recv(),
+        for frames received by an event loop (see `websocket.recv_callback`).
+        """
+        if isinstance(frame, ControlFrame):
+            self.handle_control_frame(frame)
+            return
+
+        message = self.add_fragment(frame)
+
+        if message is not None:
+            self.onmessage(message)
+
+    def add_fragment(self, frame):
+        """
+        Add a received data frame to the fragments of the current message.
+        Returns the message if the frame completes it, or None otherwise (also
+        if the message has been delivered to a logical channel).
+        """
+        self.fragments.append(frame)
+
+        if frame.final:
+            message = self.concat_fragments(self.fragments)
+            self.fragments = []
+            return message
+
+        if len(self.fragments) > 1 and frame.opcode != OPCODE_CONTINUATION:
+            raise ValueError('expected continuation/control frame, got %s '
+                             'instead' % frame)
 
     def concat_fragments(self, fragments):
         frame = fragments[0]
@@ -106,7 +175,17 @@ class Connection(object):
             frame.payload += f.payload
 
         frame.final = True
-        frame = self.sock.apply_recv_hooks(frame, True)
+        frame = self.sock.message_recv_hook(frame)
+
+        # Messages of logical channels are handled by the channel (see
+        # `Multiplex`)
+        if frame.channel is not None:
+            frame.channel.feed(self, frame)
+            return
+
+        if self.codec and frame.opcode == self.codec.opcode:
+            return self.codec.decode_message(frame.payload)
+
         return create_message(frame.opcode, frame.payload)
 
     def handle_control_frame(self, frame):
@@ -156,13 +235,23 @@ class Connection(object):
             except Exception as e:
                 self.onerror(e)
                 self.onclose(None, 'error: %s' % e)
+                self.fail(e)
+                raise e
 
-                try:
-                    self.sock.close()
-                except socket.error:
-                    pass
+    def fail(self, e):
+        """
+        Close the socket after error `e`. If the error is a MessageTooBig, a
+        CLOSE frame with status CLOSE_MESSAGE_TOOBIG is sent first, without
+        waiting for a response.
+        """
+        try:
+            if isinstance(e, MessageTooBig):
+                self.send_frame(create_close_frame(CLOSE_MESSAGE_TOOBIG,
+                                                   str(e)))
 
-                raise e
+            self.sock.close()
+        except (socket.error, SocketClosed):
+            pass
 
     def send_ping(self, payload=''):
         """
@@ -1,7 +1,14 @@
 import zlib
+import time
 
 from extension import Extension
-from frame import ControlFrame
+from frame import ControlFrame, OPCODE_CONTINUATION
+from errors import MessageTooBig
+from compression import CompressionPolicy
+
+
+# Maximum number of bytes inflated at once
+INFLATE_CHUNK_SIZE = 1 << 16
 
 
 class DeflateFrame(Extension):
@@ -16,7 +23,16 @@ class DeflateFrame(Extension):
 
     Note that the deflate and inflate hooks modify the RSV1 bit and payload of
     existing `Frame` objects.
+
+    The optional `policy` argument is a `CompressionPolicy` which decides if
+    and how frames are compressed.
+
+    The optional `max_message_size` limits the size of inflated messages, to
+    protect against decompression bombs. A MessageTooBig error is raised as
+    soon as it is exceeded, upon which the connection is closed with status
+    CLOSE_MESSAGE_TOOBIG (1009).
     """
+    name = 'deflate-frame'
     names = ('deflate-frame', 'x-webkit-deflate-frame')
     rsv1 = True
     defaults = {
@@ -26,54 +42,194 @@ class DeflateFrame(Extension):
 
     compression_threshold = 20  # minimal payload size for compression
 
+    def __init__(self, policy=None, max_message_size=None, **kwargs):
+        super(DeflateFrame, self).__init__(**kwargs)
+        self.policy = policy or CompressionPolicy()
+        self.max_message_size = max_message_size
+
+    def negotiation_state(self):
+        return self.policy.limits()
+
     def negotiate(self, name, params):
+        # Limit the memory of the compression contexts as the budget fills up
+        max_bits, no_takeover = self.policy.limits()
+
         if 'max_window_bits' in params:
             mwb = int(params['max_window_bits'])
             assert 8 <= mwb <= zlib.MAX_WBITS
-            yield 'max_window_bits', mwb
+            yield 'max_window_bits', min(mwb, max_bits)
+        elif max_bits != zlib.MAX_WBITS:
+            yield 'max_window_bits', max_bits
 
         if 'no_context_takeover' in params:
             assert params['no_context_takeover'] is True
             yield 'no_context_takeover', True
+        elif no_takeover:
+            yield 'no_context_takeover', True
 
     class Instance(Extension.Instance):
         def init(self):
-            if not self.no_context_takeover:
-                self.defl = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                        zlib.DEFLATED, -self.max_window_bits)
-                self.dec = zlib.decompressobj(-self.max_window_bits)
+            self.policy = self.extension.policy
+            self.policy_state = {}
+            self.defl_window_bits = self.max_window_bits
+            self.defl_no_context_takeover = self.no_context_takeover
+            self.dec_window_bits = self.max_window_bits
+            self.dec_no_context_takeover = self.no_context_takeover
+
+            # The zlib contexts are allocated when they are first used
+            self.defl = self.dec = None
+            self.last_used = time.time()
+
+            # Inflated size of the message currently being received
+            self.recv_size = 0
+
+        def reset_compressor(self):
+            self.release_compressor()
+            self.level = self.policy.current_level()
+            self.defl = self.policy.compressobj(self.level,
+                                                self.defl_window_bits)
+
+        def release_compressor(self):
+            if self.defl:
+                self.defl = None
+                self.policy.release(
+                        self.policy.compressor_size(self.defl_window_bits))
+
+        def release_decompressor(self):
+            if self.dec:
+                self.dec = None
+                self.policy.release(
+                        self.policy.decompressor_size(self.dec_window_bits))
+
+        def release(self):
+            self.release_compressor()
+            self.release_decompressor()
+
+        def release_idle(self, now):
+            # A new compression context can be started at any time, but the
+            # decompression context must follow the context of the peer
+            if self.policy.idle_time is not None and \
+                    now - self.last_used >= self.policy.idle_time:
+                self.release_compressor()
+
+        def is_transferable(self):
+            # The compression contexts cannot be serialized
+            return self.no_context_takeover
 
         def onsend(self, frame):
             if not frame.rsv1 and not isinstance(frame, ControlFrame) and \
-                   len(frame.payload) > self.extension.compression_threshold:
+                   self.policy.should_compress(self, frame):
                 deflated = self.deflate(frame.payload)
+                self.policy.record(self, frame, len(deflated))
 
                 if len(deflated) < len(frame.payload):
                     frame.rsv1 = True
                     frame.payload = deflated
+                else:
+                    # The receiver does not know the discarded data, so it
+                    # must not be referenced by the next compressed frame
+                    self.release_compressor()
 
         def onrecv(self, frame):
-            if frame.rsv1:
-                if isinstance(frame, ControlFrame):
+            if isinstance(frame, ControlFrame):
+                if frame.rsv1:
                     raise ValueError('received compressed control frame')
 
-                frame.rsv1 = False
-                frame.payload = self.inflate(frame.payload)
+                return
+
+            if frame.opcode != OPCODE_CONTINUATION:
+                self.recv_size = 0
 
-        def deflate(self, data):
-            if self.no_context_takeover:
-                self.defl = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                        zlib.DEFLATED, -self.max_window_bits)
+            if frame.rsv1:
+                self.inflate_frame(frame, True)
+
+        def inflate_frame(self, frame, final):
+            """
+            Replace the payload of `frame` with its inflated payload, within
+            the maximum message size.
+            """
+            max_length = self.extension.max_message_size
+
+            if max_length is not None:
+                max_length -= self.recv_size
+
+            frame.rsv1 = False
+            frame.payload = self.inflate(frame.payload, final, max_length)
+            self.recv_size += len(frame.payload)
+
+        def deflate(self, data, first=True, final=True):
+            """
+            Compress the payload of a frame. The fragments of a message that
+            is compressed as a whole are passed one by one, `first` and
+            `final` indicate the first and last fragment.
+            """
+            if first:
+                if self.defl_no_context_takeover:
+                    # Borrow a pooled context instead of allocating a new one,
+                    # the full flush at the end of the message resets it
+                    self.level = self.policy.current_level()
+                    self.defl = self.policy.acquire_compressor(
+                            self.level, self.defl_window_bits)
+                elif not self.defl or \
+                        self.policy.current_level() != self.level:
+                    self.reset_compressor()
+
+                self.last_used = time.time()
+
+            compressed = self.defl.compress(buffer(data))
+
+            if not final:
+                # Flush so that the receiver can inflate the fragment as soon
+                # as it arrives
+                return compressed + self.defl.flush(zlib.Z_SYNC_FLUSH)
+
+            if self.defl_no_context_takeover:
+                compressed += self.defl.flush(zlib.Z_FULL_FLUSH)
+                self.policy.recycle_compressor(self.defl, self.level,
+                                               self.defl_window_bits)
+                self.defl = None
+            else:
+                compressed += self.defl.flush(zlib.Z_SYNC_FLUSH)
 
-            compressed = self.defl.compress(data)
-            compressed += self.defl.flush(zlib.Z_SYNC_FLUSH)
             assert compressed[-4:] == '\x00\x00\xff\xff'
             return compressed[:-4]
 
-        def inflate(self, data):
-            data = str(data + '\x00\x00\xff\xff')
-
-            if self.no_context_takeover:
-                self.dec = zlib.decompressobj(-self.max_window_bits)
-
-            return self.dec.decompress(data)
+        def inflate(self, data, final=True, max_length=None):
+            """
+            Decompress the payload of a frame, or of a fragment of a message
+            that is compressed as a whole (see `deflate`). A MessageTooBig
+            error is raised if the output would exceed `max_length` bytes.
+            """
+            return ''.join(self.inflate_chunks(data, final, max_length))
+
+        def inflate_chunks(self, data, final=True, max_length=None,
+                           chunk_size=INFLATE_CHUNK_SIZE):
+            """
+            Generator variant of `inflate`, which yields the decompressed data
+            in chunks of at most `chunk_size` bytes. The output is never
+            larger than the limit, regardless of the compression ratio.
+            """
+            if not self.dec:
+                self.dec = self.policy.decompressobj(self.dec_window_bits)
+
+            self.last_used = time.time()
+            size = 0
+
+            # The sync marker stripped by the sender is passed separately,
+            # rather than appended to a copy of the payload
+            for tail in (buffer(data), '\x00\x00\xff\xff') if final \
+                    else (buffer(data),):
+                while tail:
+                    chunk = self.dec.decompress(tail, chunk_size)
+                    tail = self.dec.unconsumed_tail
+                    size += len(chunk)
+
+                    if max_length is not None and size > max_length:
+                        raise MessageTooBig('inflated message exceeds the '
+                                            'maximum message size')
+
+                    if chunk:
+                        yield chunk
+
+            if final and self.dec_no_context_takeover:
+                self.release_decompressor()
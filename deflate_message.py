@@ -1,7 +1,10 @@
 import zlib
+import time
 
 from extension import Extension
+from frame import ControlFrame, OPCODE_CONTINUATION
 from deflate_frame import DeflateFrame
+from compression import CompressionPolicy
 
 
 class DeflateMessage(Extension):
@@ -9,8 +12,19 @@ class DeflateMessage(Extension):
     Implementation of the "permessage-deflate" extension, as defined by
     http://tools.ietf.org/html/draft-ietf-hybi-permessage-compression-17.
 
-    Note: this implementetion is only eligible for server sockets, client
-    sockets must NOT use it.
+    The extension can be used by both servers and clients. A server
+    compresses with the server_* parameters and inflates with the client_*
+    parameters, and vice versa. The parameters passed to the constructor are
+    requested by a client, which is then bound by the server response.
+
+    The optional `policy` argument is a `CompressionPolicy` which decides if
+    and how messages are compressed.
+
+    Fragmented messages are compressed and inflated one fragment at a time,
+    so that memory usage does not grow with the message size. Only the first
+    fragment has the RSV1 bit set, as required by the RFC. The optional
+    `max_message_size` limits the size of inflated messages (see
+    `DeflateFrame`).
     """
     name = 'permessage-deflate'
     rsv1 = True
@@ -20,33 +34,51 @@ class DeflateMessage(Extension):
         'server_max_window_bits': zlib.MAX_WBITS,
         'server_no_context_takeover': False
     }
-    before_fragmentation = True
 
     compression_threshold = 20  # minimal message payload size for compression
 
+    def __init__(self, policy=None, max_message_size=None, **kwargs):
+        super(DeflateMessage, self).__init__(**kwargs)
+        self.policy = policy or CompressionPolicy()
+        self.max_message_size = max_message_size
+
+    @property
+    def request(self):
+        params = super(DeflateMessage, self).request
+
+        # Let the server limit the window size of the client
+        params.setdefault('client_max_window_bits', True)
+        return params
+
+    def negotiation_state(self):
+        return self.policy.limits()
+
     def negotiate(self, name, params):
+        # Limit the memory of the compression contexts as the budget fills up
+        max_bits, no_takeover = self.policy.limits()
         default = self.defaults['client_max_window_bits']
 
         if 'client_max_window_bits' in params:
             mwb = params['client_max_window_bits']
+            limit = min(default, max_bits)
 
             if mwb is True:
-                if default != zlib.MAX_WBITS:
-                    yield 'client_max_window_bits', default
+                if limit != zlib.MAX_WBITS:
+                    yield 'client_max_window_bits', limit
             else:
                 mwb = int(mwb)
                 assert 8 <= mwb <= zlib.MAX_WBITS
-                yield 'client_max_window_bits', min(mwb, default)
+                yield 'client_max_window_bits', min(mwb, limit)
         elif default != zlib.MAX_WBITS:
             yield 'client_max_window_bits', default
 
         if 'client_no_context_takeover' in params:
             assert params['client_no_context_takeover'] is True
             yield 'client_no_context_takeover', True
-        elif self.defaults['client_no_context_takeover']:
+        elif self.defaults['client_no_context_takeover'] or no_takeover:
             yield 'client_no_context_takeover', True
 
-        default = self.defaults['server_max_window_bits']
+        default = min(self.defaults['server_max_window_bits'], max_bits)
 
         if 'server_max_window_bits' in params:
             mwb = int(params['server_max_window_bits'])
@@ -58,32 +90,127 @@ class DeflateMessage(Extension):
         if 'server_no_context_takeover' in params:
             assert params['server_no_context_takeover'] is True
             yield 'server_no_context_takeover', True
-        elif self.defaults['server_no_context_takeover']:
+        elif self.defaults['server_no_context_takeover'] or no_takeover:
             yield 'server_no_context_takeover', True
 
     class Instance(DeflateFrame.Instance):
         def init(self):
-            if not self.server_no_context_takeover:
-                self.defl = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                        zlib.DEFLATED, -self.server_max_window_bits)
-
-            if not self.client_no_context_takeover:
-                self.dec = zlib.decompressobj(-self.client_max_window_bits)
-
-        def deflate(self, data):
-            if self.server_no_context_takeover:
-                self.defl = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                        zlib.DEFLATED, -self.server_max_window_bits)
-
-            compressed = self.defl.compress(data)
-            compressed += self.defl.flush(zlib.Z_SYNC_FLUSH)
-            assert compressed[-4:] == '\x00\x00\xff\xff'
-            return compressed[:-4]
-
-        def inflate(self, data):
-            data = str(data + '\x00\x00\xff\xff')
-
-            if self.client_no_context_takeover:
-                self.dec = zlib.decompressobj(-self.client_max_window_bits)
-
-            return self.dec.decompress(data)
+            self.policy = self.extension.policy
+            self.policy_state = {}
+
+            if self.client:
+                # The client may always compress with a smaller window, or
+                # without context takeover, than the server allows
+                own = self.extension.defaults
+                self.defl_window_bits = min(self.client_max_window_bits,
+                                            own['client_max_window_bits'])
+                self.defl_no_context_takeover = \
+                        self.client_no_context_takeover or \
+                        own['client_no_context_takeover']
+                self.dec_window_bits = self.server_max_window_bits
+                self.dec_no_context_takeover = self.server_no_context_takeover
+            else:
+                self.defl_window_bits = self.server_max_window_bits
+                self.defl_no_context_takeover = \
+                        self.server_no_context_takeover
+                self.dec_window_bits = self.client_max_window_bits
+                self.dec_no_context_takeover = self.client_no_context_takeover
+
+            self.defl = self.dec = None
+            self.last_used = time.time()
+
+            # Whether the message currently being sent/received is compressed
+            self.send_compressed = False
+            self.recv_compressed = False
+            self.recv_size = 0
+
+        def is_transferable(self):
+            return self.server_no_context_takeover \
+                   and self.client_no_context_takeover \
+                   and not self.recv_compressed
+
+        def onsend(self, frame):
+            if isinstance(frame, ControlFrame):
+                return
+
+            if frame.opcode != OPCODE_CONTINUATION:
+                if frame.final:
+                    # Unfragmented messages are sent uncompressed if that is
+                    # smaller
+                    return DeflateFrame.Instance.onsend(self, frame)
+
+                self.send_compressed = not frame.rsv1 and \
+                        self.policy.should_compress(self, frame)
+
+                if self.send_compressed:
+                    deflated = self.deflate(frame.payload, True, False)
+                    self.policy.record(self, frame, len(deflated))
+                    frame.rsv1 = True
+                    frame.payload = deflated
+            elif self.send_compressed:
+                frame.payload = self.deflate(frame.payload, False,
+                                             frame.final)
+
+        def onsend_batch(self, frames):
+            # The fragments of a message that are sent together are
+            # compressed with a single flush, instead of one per fragment
+            start = 0
+
+            for i, frame in enumerate(frames):
+                if isinstance(frame, ControlFrame) or \
+                        frame.opcode != OPCODE_CONTINUATION and frame.final:
+                    self.deflate_fragments(frames[start:i])
+                    self.onsend(frame)
+                    start = i + 1
+                elif frame.final:
+                    self.deflate_fragments(frames[start:i + 1])
+                    start = i + 1
+
+            self.deflate_fragments(frames[start:])
+            return frames
+
+        def deflate_fragments(self, frames):
+            """
+            Compress consecutive fragments of a message as a whole, and divide
+            the compressed data evenly over the same frames.
+            """
+            if not frames:
+                return
+
+            first = frames[0].opcode != OPCODE_CONTINUATION
+
+            if first:
+                self.send_compressed = not frames[0].rsv1 and \
+                        self.policy.should_compress(self, frames[0])
+
+            if not self.send_compressed:
+                return
+
+            data = ''.join(map(str, (frame.payload for frame in frames)))
+            deflated = self.deflate(data, first, frames[-1].final)
+
+            if first:
+                # Record the ratio of all fragments for the first one
+                size = len(frames[0].payload)
+                self.policy.record(self, frames[0],
+                                   len(deflated) * size / len(data))
+                frames[0].rsv1 = True
+
+            size = -(-len(deflated) // len(frames))
+
+            for i, frame in enumerate(frames):
+                frame.payload = deflated[i * size:(i + 1) * size]
+
+        def onrecv(self, frame):
+            if isinstance(frame, ControlFrame):
+                return DeflateFrame.Instance.onrecv(self, frame)
+
+            if frame.opcode != OPCODE_CONTINUATION:
+                self.recv_compressed = frame.rsv1
+                self.recv_size = 0
+            elif frame.rsv1:
+                raise ValueError('RSV1 set on continuation frame')
+
+            if self.recv_compressed:
+                self.inflate_frame(frame, frame.final)
+                self.recv_compressed = not frame.final
@@ -20,5 +20,34 @@ class PingError(Exception):
     pass
 
 
+class MessageTooBig(Exception):
+    pass
+
+
 class SSLError(Exception):
     pass
+
+
+class NonUpgradeRequest(Exception):
+    def __init__(self, sock, response):
+        self.sock = sock
+        self.response = response
+
+    @property
+    def message(self):
+        return 'non-upgrade request for "%s"' % self.sock.location
+
+
+class RpcError(Exception):
+    def __init__(self, message, code=-32000, data=None):
+        """
+        Error response to a remote procedure call (see `Rpc`), with a
+        JSON-RPC error `code` and optional `data`.
+        """
+        super(RpcError, self).__init__(message)
+        self.code = code
+        self.data = data
+
+
+class RpcTimeout(RpcError):
+    pass
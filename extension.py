@@ -1,3 +1,29 @@
+def identity(frame):
+    return frame
+
+
+def chain(hooks):
+    """
+    Compose a list of hooks, which each take and return a frame (or a list of
+    frames), into a single callable.
+    """
+    if not hooks:
+        return identity
+
+    if len(hooks) == 1:
+        return hooks[0]
+
+    hooks = tuple(hooks)
+
+    def chained(frame):
+        for hook in hooks:
+            frame = hook(frame)
+
+        return frame
+
+    return chained
+
+
 class Extension(object):
     name = ''
     rsv1 = False
@@ -20,6 +46,17 @@ class Extension(object):
         return '<Extension "%s" defaults=%s request=%s>' \
                % (self.name, self.defaults, self.request)
 
+    @property
+    def request(self):
+        """
+        Parameters offered by a client in its request: those that were set to
+        a non-default value in the constructor.
+        """
+        defaults = self.__class__.defaults
+        return dict((param, value)
+                    for param, value in self.defaults.iteritems()
+                    if value != defaults[param])
+
     @property
     def names(self):
         return (self.name,) if self.name else ()
@@ -48,6 +85,15 @@ class Extension(object):
         """
         raise NotImplementedError
 
+    def negotiation_state(self):
+        """
+        Get a hashable value of the state that `negotiate` depends on, apart
+        from the offered parameters. Negotiations are cached per offer and
+        state by servers (see `NegotiationCache`), so the value must change
+        whenever the negotiation would have a different outcome.
+        """
+        return None
+
     def negotiate_safe(self, name, params):
         """
         `name` and `params` are sent in the HTTP request by the client. Check
@@ -65,12 +111,22 @@ class Extension(object):
             pass
 
     class Instance:
-        def __init__(self, extension, name, params):
+        def __init__(self, extension, name, params, client=False):
+            """
+            `params` are the parameters accepted by the server. `client`
+            indicates that the instance belongs to the client end point.
+            """
             self.extension = extension
             self.name = name
             self.params = params
+            self.client = client
+
+            # The server response is binding for the client, instead of the
+            # parameters it requested
+            defaults = extension.__class__.defaults if client \
+                       else extension.defaults
 
-            for param, value in extension.defaults.iteritems():
+            for param, value in defaults.iteritems():
                 setattr(self, param, value)
 
             for param, value in params.iteritems():
@@ -81,6 +137,28 @@ class Extension(object):
         def init(self):
             return NotImplemented
 
+        def is_transferable(self):
+            """
+            Check if the instance can be recreated from its parameters in
+            another process (see `AsyncServer` upgrades), which is not the
+            case if it keeps state between frames.
+            """
+            return True
+
+        def release(self):
+            """
+            Called when the socket is closed, to free resources such as
+            compression contexts.
+            """
+            return NotImplemented
+
+        def release_idle(self, now):
+            """
+            Called periodically by an `AsyncServer` with the current time, to
+            free resources that are not in use and can be recreated later.
+            """
+            return NotImplemented
+
         def handle_send(self, frame):
             if self.extension.before_fragmentation:
                 assert not frame.is_fragmented()
@@ -95,8 +173,69 @@ class Extension(object):
             replacement = self.onrecv(frame)
             return frame if replacement is None else replacement
 
+        def send_hook(self):
+            """
+            Get a callable that applies onsend() to a frame, for the pipeline
+            compiled by `websocket.compile_hooks`.
+            """
+            onsend = self.onsend
+
+            def hook(frame):
+                replacement = onsend(frame)
+                return frame if replacement is None else replacement
+
+            return hook
+
+        def recv_hook(self):
+            onrecv = self.onrecv
+
+            def hook(frame):
+                replacement = onrecv(frame)
+                return frame if replacement is None else replacement
+
+            return hook
+
+        def send_batch_hook(self):
+            """
+            Get a callable that applies onsend_batch() to a list of frames.
+            Unless the method is overridden, the frames are passed to onsend()
+            one by one.
+            """
+            if self.overrides('onsend_batch'):
+                return self.onsend_batch
+
+            hook = self.send_hook()
+            return lambda frames: map(hook, frames)
+
+        def recv_batch_hook(self):
+            if self.overrides('onrecv_batch'):
+                return self.onrecv_batch
+
+            hook = self.recv_hook()
+            return lambda frames: map(hook, frames)
+
+        def overrides(self, method):
+            return getattr(self.__class__, method).im_func is not \
+                   getattr(Extension.Instance, method).im_func
+
         def onsend(self, frame):
             raise NotImplementedError
 
         def onrecv(self, frame):
             raise NotImplementedError
+
+        def onsend_batch(self, frames):
+            """
+            Called instead of onsend() with a list of frames that are sent
+            together, such as the fragments of a message. Returns the list of
+            frames to send. Extensions may override this to process the frames
+            at once, e.g. to compress them with a single flush.
+            """
+            return map(self.handle_send, frames)
+
+        def onrecv_batch(self, frames):
+            """
+            Called instead of onrecv() with a list of frames that were
+            received together. Returns the list of received frames.
+            """
+            return map(self.handle_recv, frames)
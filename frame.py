@@ -34,6 +34,12 @@ class Frame(object):
     To encoding a frame for sending it over a socket, use Frame.pack(). To
     receive and decode a frame from a socket, use receive_frame().
     """
+    # Set to False to exclude the frame from compression by extensions
+    compress = True
+
+    # Logical channel of the message, set by the `Multiplex` extension
+    channel = None
+
     def __init__(self, opcode, payload, masking_key='', mask=False, final=True,
             rsv1=False, rsv2=False, rsv3=False):
         """
@@ -141,6 +147,9 @@ class Frame(object):
         frames[0].opcode = self.opcode
         frames[-1].final = True
 
+        for frame in frames:
+            frame.compress = self.compress
+
         return frames
 
     def is_fragmented(self):
@@ -304,15 +313,21 @@ def contains_frame(data):
     payload_start = 2
 
     if payload_len == 126:
-        if len(data) > 4:
-            payload_len = struct.unpack('!H', data[2:4])[0]
+        if len(data) < 4:
+            return False
 
+        payload_len = struct.unpack('!H', data[2:4])[0]
         payload_start = 4
     elif payload_len == 127:
-        if len(data) > 12:
-            payload_len = struct.unpack('!Q', data[4:12])[0]
+        if len(data) < 10:
+            return False
+
+        payload_len = struct.unpack('!Q', data[2:10])[0]
+        payload_start = 10
 
-        payload_start = 12
+    # The masking key precedes the payload
+    if b2 & 0x80:
+        payload_start += 4
 
     return len(data) >= payload_len + payload_start
 
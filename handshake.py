@@ -5,8 +5,10 @@ import time
 from base64 import b64encode
 from hashlib import sha1
 from urlparse import urlparse
+from collections import OrderedDict
+from threading import Lock
 
-from errors import HandshakeError
+from errors import HandshakeError, NonUpgradeRequest
 from python_digest import build_authorization_request
 
 
@@ -15,6 +17,12 @@ WS_VERSION = '13'
 MAX_REDIRECTS = 10
 HDR_TIMEOUT = 5
 MAX_HDR_LEN = 1024
+NEGOTIATION_CACHE_SIZE = 64
+
+# Static part of the server handshake response, rendered once
+SWITCHING_PROTOCOLS = 'HTTP/1.1 101 Switching Protocols\r\n' \
+                      'Upgrade: websocket\r\n' \
+                      'Connection: Upgrade'
 
 
 class Handshake(object):
@@ -28,7 +36,9 @@ class Handshake(object):
 
     def receive_request(self):
         raw, headers = self.receive_headers()
+        return self.parse_location(raw), headers
 
+    def parse_location(self, raw):
         # Request must be HTTP (at least 1.1) GET request, find the location
         # (without trailing slash)
         match = re.search(r'^GET (.*?)/* HTTP/1.1\r\n', raw)
@@ -36,20 +46,20 @@ class Handshake(object):
         if match is None:
             self.fail('not a valid HTTP 1.1 GET request')
 
-        location = match.group(1)
-        return location, headers
+        return match.group(1)
 
     def receive_response(self):
         raw, headers = self.receive_headers()
+        return self.parse_status(raw), headers
 
+    def parse_status(self, raw):
         # Response must be HTTP (at least 1.1) with status 101
         match = re.search(r'^HTTP/1\.1 (\d{3})', raw)
 
         if match is None:
             self.fail('not a valid HTTP 1.1 response')
 
-        status = int(match.group(1))
-        return status, headers
+        return int(match.group(1))
 
     def receive_headers(self):
         # Receive entire HTTP header
@@ -83,26 +93,11 @@ class Handshake(object):
 
         self.sock.settimeout(sock_timeout)
 
-        hdr = hdr.decode('utf-8', 'ignore')
-        headers = {}
-
-        for key, value in re.findall(r'(.*?): ?(.*?)\r\n', hdr):
-            if key in headers:
-                headers[key] += ', ' + value
-            else:
-                headers[key] = value
-
-        return hdr, headers
+        return parse_headers(hdr)
 
     def send_headers(self, headers):
-        # Send request
-        for hdr in list(headers):
-            if isinstance(hdr, tuple):
-                hdr = '%s: %s' % hdr
-
-            self.sock.sendall(hdr + '\r\n')
-
-        self.sock.sendall('\r\n')
+        # Send request or response in a single write
+        self.sock.sendall(format_headers(headers))
 
     def perform(self):
         raise NotImplementedError
@@ -117,12 +112,45 @@ class ServerHandshake(Handshake):
     def perform(self, ssock):
         # Receive and validate client handshake
         location, headers = self.receive_request()
+        self.handle_request(location, headers, ssock)
+
+    def handle_raw_request(self, raw, ssock):
+        """
+        Handle a complete request that has already been received, for
+        transports that receive data themselves.
+        """
+        hdr, headers = parse_headers(raw)
+        self.handle_request(self.parse_location(hdr), headers, ssock)
+
+    def handle_request(self, location, headers, ssock):
         self.wsock.location = location
         self.wsock.request_headers = headers
 
+        # Regular HTTP requests for the statistics are answered directly
+        if ssock.stats_location is not None \
+                and location == ssock.stats_location \
+                and 'Upgrade' not in headers:
+            raise NonUpgradeRequest(self.wsock, self.stats_response(ssock))
+
         # Send server handshake in response
         self.send_headers(self.response_headers(ssock))
 
+    def stats_response(self, ssock):
+        body = ''
+
+        if ssock.stats:
+            ssock.stats.incr('stats_requests')
+            body = ssock.stats.format()
+
+        headers = [
+            'HTTP/1.1 200 OK',
+            'Content-Type: text/plain; version=0.0.4',
+            'Content-Length: %d' % len(body),
+            'Connection: close',
+        ]
+
+        return '\r\n'.join(headers) + '\r\n\r\n' + body
+
     def response_headers(self, ssock):
         headers = self.wsock.request_headers
 
@@ -170,19 +198,11 @@ class ServerHandshake(Handshake):
                 break
 
         # Only supported extensions are returned
-        if 'Sec-WebSocket-Extensions' in headers:
-            self.wsock.extension_instances = []
-
-            for hdr in split_stripped(headers['Sec-WebSocket-Extensions']):
-                name, params = parse_param_hdr(hdr)
+        extensions_hdr = None
 
-                for ext in ssock.extensions:
-                    if ext.is_supported(name, self.wsock.extension_instances):
-                        accept_params = ext.negotiate_safe(name, params)
-
-                        if accept_params is not None:
-                            instance = ext.Instance(ext, name, accept_params)
-                            self.wsock.extension_instances.append(instance)
+        if 'Sec-WebSocket-Extensions' in headers:
+            extensions_hdr = self.negotiate_extensions(
+                    ssock, headers['Sec-WebSocket-Extensions'])
 
         # Check if requested resource location is served by this server
         if ssock.locations:
@@ -209,9 +229,7 @@ class ServerHandshake(Handshake):
         location = '%s://%s%s' % (scheme, host, self.wsock.location)
 
         # Construct HTTP response header
-        yield 'HTTP/1.1 101 Switching Protocols'
-        yield 'Upgrade', 'websocket'
-        yield 'Connection', 'Upgrade'
+        yield SWITCHING_PROTOCOLS
         yield 'Sec-WebSocket-Origin', origin
         yield 'Sec-WebSocket-Location', location
         yield 'Sec-WebSocket-Accept', accept
@@ -219,10 +237,85 @@ class ServerHandshake(Handshake):
         if self.wsock.protocol:
             yield 'Sec-WebSocket-Protocol', self.wsock.protocol
 
-        if self.wsock.extension_instances:
-            values = [format_param_hdr(i.name, i.params)
-                      for i in self.wsock.extension_instances]
-            yield 'Sec-WebSocket-Extensions', ', '.join(values)
+        if extensions_hdr:
+            yield 'Sec-WebSocket-Extensions', extensions_hdr
+
+    def negotiate_extensions(self, ssock, offer):
+        """
+        Create instances of the extensions in `offer` (the value of the
+        "Sec-WebSocket-Extensions" request header) that are supported by
+        server socket `ssock`, and return the response header value. Since
+        most clients send one of a few identical offers, the outcome is
+        cached in `ssock.negotiation_cache`.
+        """
+        cache = ssock.negotiation_cache
+        key = offer, tuple(ext.negotiation_state() for ext in ssock.extensions)
+        cached = cache.get(key) if cache is not None else None
+
+        if cached:
+            accepted, hdr = cached
+            self.wsock.extension_instances = [
+                    ext.Instance(ext, name, dict(params))
+                    for ext, name, params in accepted]
+        else:
+            self.wsock.extension_instances = []
+
+            for value in split_stripped(offer):
+                name, params = parse_param_hdr(value)
+
+                for ext in ssock.extensions:
+                    if ext.is_supported(name, self.wsock.extension_instances):
+                        accept_params = ext.negotiate_safe(name, params)
+
+                        if accept_params is not None:
+                            instance = ext.Instance(ext, name, accept_params)
+                            self.wsock.extension_instances.append(instance)
+
+            accepted = [(i.extension, i.name, dict(i.params))
+                        for i in self.wsock.extension_instances]
+            hdr = ', '.join(format_param_hdr(name, params)
+                            for ext, name, params in accepted)
+
+            if cache is not None:
+                cache.put(key, (accepted, hdr))
+
+        self.wsock.compile_hooks()
+        return hdr
+
+
+class NegotiationCache(object):
+    """
+    Bounded LRU cache for `ServerHandshake.negotiate_extensions`, which maps
+    extension offers to the accepted extensions and parameters, and the
+    formatted response header. The key also contains the state of the
+    extensions that the negotiation depends on (see
+    `Extension.negotiation_state`), so that changes in that state lead to a
+    new negotiation.
+    """
+    def __init__(self, size=NEGOTIATION_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+
+            if value is not None:
+                self.entries[key] = value
+
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
 
 
 class ClientHandshake(Handshake):
@@ -239,6 +332,29 @@ class ClientHandshake(Handshake):
         self.send_headers(self.request_headers())
         self.handle_response(*self.receive_response())
 
+    def request(self):
+        """
+        Format the request headers into a string, for non-blocking sockets
+        that send the request in the background (see
+        `websocket.connect_async`).
+        """
+        return format_headers(self.request_headers())
+
+    def handle_raw_response(self, raw):
+        """
+        Handle a complete response received by a non-blocking socket. Only
+        successful handshakes are supported, authentication and redirects
+        require blocking sockets.
+        """
+        hdr, headers = parse_headers(raw)
+        status = self.parse_status(hdr)
+
+        if status != 101:
+            self.fail('invalid HTTP response status %d for non-blocking '
+                      'handshake' % status)
+
+        self.handle_handshake(headers)
+
     def handle_response(self, status, headers):
         if status == 101:
             self.handle_handshake(headers)
@@ -270,9 +386,6 @@ class ClientHandshake(Handshake):
 
         # Compare extensions, add hooks only for those returned by server
         if 'Sec-WebSocket-Extensions' in headers:
-            # FIXME: there is no distinction between server/client extension
-            # instances, while the extension instance may assume it belongs to
-            # a server, leading to undefined behavior
             self.wsock.extension_instances = []
 
             for hdr in split_stripped(headers['Sec-WebSocket-Extensions']):
@@ -280,13 +393,21 @@ class ClientHandshake(Handshake):
 
                 for ext in self.wsock.extensions:
                     if name in ext.names:
-                        instance = ext.Instance(ext, name, accept_params)
+                        for param in accept_params.iterkeys():
+                            if param not in ext.defaults:
+                                self.fail('unsupported parameter "%s" for '
+                                          'extension "%s"' % (param, name))
+
+                        instance = ext.Instance(ext, name, accept_params,
+                                                client=True)
                         self.wsock.extension_instances.append(instance)
                         break
                 else:
                     raise HandshakeError('server handshake contains '
                                          'unsupported extension "%s"' % name)
 
+            self.wsock.compile_hooks()
+
         # Assert that returned protocol (if any) is supported
         if 'Sec-WebSocket-Protocol' in headers:
             protocol = headers['Sec-WebSocket-Protocol']
@@ -349,7 +470,10 @@ class ClientHandshake(Handshake):
 
         # Send client handshake
         yield 'GET %s HTTP/1.1' % self.wsock.location
-        yield 'Host', '%s:%d' % self.sock.getpeername()
+
+        # Unix domain sockets (e.g. of a socketpair) have no host address
+        peer = self.sock.getpeername()
+        yield 'Host', '%s:%d' % peer[:2] if peer else 'localhost'
         yield 'Upgrade', 'websocket'
         yield 'Connection', 'keep-alive, Upgrade'
         yield 'Sec-WebSocket-Key', self.key
@@ -391,6 +515,31 @@ class ClientHandshake(Handshake):
                                 password=password.encode('utf-8'))
 
 
+def parse_headers(hdr):
+    hdr = hdr.decode('utf-8', 'ignore')
+    headers = {}
+
+    for key, value in re.findall(r'(.*?): ?(.*?)\r\n', hdr):
+        if key in headers:
+            headers[key] += ', ' + value
+        else:
+            headers[key] = value
+
+    return hdr, headers
+
+
+def format_headers(headers):
+    lines = []
+
+    for hdr in headers:
+        if isinstance(hdr, tuple):
+            hdr = '%s: %s' % hdr
+
+        lines.append(hdr + '\r\n')
+
+    return ''.join(lines) + '\r\n'
+
+
 def split_stripped(value, delim=',', maxsplits=-1):
     return map(str.strip, str(value).split(delim, maxsplits)) if value else []
 
@@ -404,9 +553,10 @@ def parse_param_hdr(hdr):
 
     params = {}
 
-    for param in split_stripped(paramstr):
+    for param in split_stripped(paramstr, ';'):
         if '=' in param:
             key, value = split_stripped(param, '=', 1)
+            value = value.strip('"')
 
             if value.isdigit():
                 value = int(value)
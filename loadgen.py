@@ -0,0 +1,342 @@
+import time
+import struct
+import socket
+import random
+import logging
+from heapq import heappush, heappop
+from select import epoll, EPOLLIN, EPOLLOUT, EPOLLHUP, EPOLLERR
+
+from websocket import websocket
+from frame import Frame, ControlFrame, OPCODE_BINARY, OPCODE_TEXT, \
+                  OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG, CLOSE_NORMAL
+from stats import percentiles
+
+
+__all__ = ['LoadGenerator']
+
+
+TIMESTAMP = struct.Struct('!d')
+MAX_LATENCIES = 100000
+
+
+def close_frame():
+    return ControlFrame(OPCODE_CLOSE, struct.pack('!H', CLOSE_NORMAL),
+                        mask=True)
+
+
+class LoadGenerator(object):
+    """
+    Load generator that simulates many websocket clients using a single EPOLL
+    loop. Connections are opened (without blocking) at a constant rate during
+    the ramp-up period, after which each connection sends masked binary
+    messages at the configured rate until the end of the test. Each message
+    payload starts with the time at which it was sent, so that the latency of
+    the server's response can be computed when the server echoes messages.
+
+    Example:
+    >>> import wspy
+    >>> gen = wspy.LoadGenerator(('localhost', 8000), nconns=10000, rate=0.5,
+    >>>                          size=lambda: random.randint(8, 4096),
+    >>>                          ramp_up=10, duration=60)
+    >>> print gen.run()
+    """
+    def __init__(self, address, nconns=100, rate=1.0, size=64, ramp_up=0.0,
+                 duration=10.0, drain=2.0, poisson=True, sources=(),
+                 recvbuf_size=4096, **kwargs):
+        """
+        `address` is the (host, port) tuple of the server.
+
+        `nconns` is the number of client connections to open.
+
+        `rate` is the number of messages per second sent by each connection.
+        If `poisson` is True (default), the intervals between messages are
+        exponentially distributed, otherwise they are constant.
+
+        `size` is the payload size of each message, or a callable that
+        returns the size of the next message. Sizes smaller than 8 bytes are
+        rounded up because the payload contains a timestamp.
+
+        `ramp_up` is the time (in seconds) over which the connections are
+        opened, and `duration` is the time during which messages are sent
+        after the ramp-up period. `drain` is the maximum time to wait for
+        outstanding responses afterwards.
+
+        `sources` is an optional list of local IP addresses to bind the
+        connections to (round-robin), to open more connections than the
+        number of ephemeral ports of a single address allows.
+
+        Any additional keyword arguments are passed to the websocket
+        constructor.
+        """
+        self.address = address
+        self.nconns = nconns
+        self.rate = rate
+        self.size = size if callable(size) else lambda: size
+        self.ramp_up = ramp_up
+        self.duration = duration
+        self.drain = drain
+        self.poisson = poisson
+        self.sources = sources
+        self.recvbuf_size = recvbuf_size
+        self.sock_args = kwargs
+
+        self.filler = ''
+
+    def interval(self):
+        if self.poisson:
+            return random.expovariate(self.rate)
+
+        return 1.0 / self.rate
+
+    def schedule(self, when, func, *args):
+        self.counter += 1
+        heappush(self.timers, (when, self.counter, func, args))
+
+    def run_timers(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            when, counter, func, args = heappop(self.timers)
+            func(*args)
+
+    def open(self, i):
+        sock = websocket(**self.sock_args)
+
+        if self.sources:
+            sock.bind((self.sources[i % len(self.sources)], 0))
+
+        sock.recv_callback = lambda frame: self.onframe(sock, frame)
+
+        try:
+            sock.connect_async(self.address, lambda: self.onopen(sock))
+        except socket.error as e:
+            logging.error('Could not connect: %s', e)
+            self.failed += 1
+            sock.close()
+            return
+
+        sock.fno = sock.fileno()
+        self.socks[sock.fno] = sock
+        self.epoll.register(sock.fno, EPOLLOUT)
+
+    def onopen(self, sock):
+        self.opened += 1
+
+        # Spread the first messages to avoid synchronized bursts
+        when = time.time() + random.uniform(0, 1.0 / self.rate)
+        self.schedule(when, self.send, sock)
+
+    def send(self, sock):
+        if self.socks.get(sock.fno) is not sock:
+            return
+
+        now = time.time()
+
+        if now >= self.stop_time:
+            return
+
+        size = max(self.size(), TIMESTAMP.size)
+
+        if len(self.filler) < size:
+            self.filler = 'x' * size
+
+        payload = TIMESTAMP.pack(now) + self.filler[:size - TIMESTAMP.size]
+        sock.queue_send(Frame(OPCODE_BINARY, payload, mask=True))
+        self.update_mask(sock)
+        self.sent += 1
+        self.bytes_sent += size
+        self.schedule(now + self.interval(), self.send, sock)
+
+    def onframe(self, sock, frame):
+        if frame.opcode in (OPCODE_BINARY, OPCODE_TEXT):
+            latency = time.time() - TIMESTAMP.unpack(str(frame.payload[:8]))[0]
+            self.received += 1
+            self.bytes_received += len(frame.payload)
+
+            # Keep a uniform sample of the latencies to bound memory usage
+            if len(self.latencies) < MAX_LATENCIES:
+                self.latencies.append(latency)
+            else:
+                i = random.randint(0, self.received - 1)
+
+                if i < MAX_LATENCIES:
+                    self.latencies[i] = latency
+
+        elif frame.opcode == OPCODE_PING:
+            sock.queue_send(ControlFrame(OPCODE_PONG, frame.payload,
+                                         mask=True))
+
+        elif frame.opcode == OPCODE_CLOSE:
+            if self.closing:
+                self.remove(sock)
+            else:
+                sock.queue_send(close_frame(), lambda: self.remove(sock))
+
+    def remove(self, sock):
+        if self.socks.get(sock.fno) is sock:
+            self.epoll.unregister(sock.fno)
+            del self.socks[sock.fno]
+
+        sock.close()
+
+    def update_mask(self, sock):
+        mask = 0
+
+        if sock.can_send():
+            mask |= EPOLLOUT
+
+        if sock.can_recv():
+            mask |= EPOLLIN
+
+        self.epoll.modify(sock.fno, mask)
+
+    def handle_events(self, timeout):
+        for fileno, event in self.epoll.poll(timeout):
+            sock = self.socks.get(fileno)
+
+            if sock is None:
+                continue
+
+            try:
+                if event & EPOLLOUT:
+                    sock.do_async_send()
+                elif event & EPOLLIN:
+                    sock.do_async_recv(self.recvbuf_size)
+                elif event & (EPOLLHUP | EPOLLERR):
+                    raise socket.error('connection hung up')
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                if not sock.handshake_sent:
+                    self.failed += 1
+
+                logging.error('Connection error: %s', e)
+                self.remove(sock)
+                continue
+
+            if self.socks.get(fileno) is sock:
+                self.update_mask(sock)
+
+    def loop(self, until):
+        while time.time() < until:
+            now = time.time()
+            self.run_timers(now)
+            timeout = until - now
+
+            if self.timers:
+                timeout = min(timeout, self.timers[0][0] - now)
+
+            self.handle_events(max(timeout, 0))
+
+    def run(self):
+        """
+        Run the load test and return a dictionary with results.
+        """
+        self.epoll = epoll()
+        self.socks = {}
+        self.timers = []
+        self.counter = 0
+        self.closing = False
+
+        self.opened = self.failed = 0
+        self.sent = self.received = 0
+        self.bytes_sent = self.bytes_received = 0
+        self.latencies = []
+
+        start = time.time()
+        self.stop_time = start + self.ramp_up + self.duration
+
+        for i in xrange(self.nconns):
+            self.schedule(start + self.ramp_up * i / self.nconns, self.open, i)
+
+        try:
+            self.loop(self.stop_time)
+
+            # Wait for outstanding responses
+            deadline = time.time() + self.drain
+
+            while self.received < self.sent and time.time() < deadline:
+                self.loop(min(deadline, time.time() + 0.1))
+
+            self.close()
+        finally:
+            for sock in self.socks.values():
+                self.remove(sock)
+
+            self.epoll.close()
+
+        return self.results(self.stop_time - start)
+
+    def close(self):
+        self.closing = True
+
+        for sock in self.socks.values():
+            if sock.handshake_sent:
+                sock.queue_send(close_frame())
+                self.update_mask(sock)
+
+        deadline = time.time() + self.drain
+
+        while self.socks and time.time() < deadline:
+            self.loop(min(deadline, time.time() + 0.1))
+
+    def results(self, duration):
+        results = {
+            'connections': self.nconns,
+            'connections_opened': self.opened,
+            'connections_failed': self.failed,
+            'duration': duration,
+            'messages_sent': self.sent,
+            'messages_received': self.received,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'send_rate': self.sent / duration if duration else 0,
+            'receive_rate': self.received / duration if duration else 0,
+        }
+
+        if self.latencies:
+            results['latency'] = percentiles(self.latencies,
+                                             (50, 90, 99, 99.9))
+
+        return results
+
+
+if __name__ == '__main__':
+    import json
+    from argparse import ArgumentParser
+
+    def size_arg(value):
+        if '-' in value:
+            low, high = map(int, value.split('-', 1))
+            return lambda: random.randint(low, high)
+
+        return int(value)
+
+    parser = ArgumentParser(description='Generate load on a websocket server '
+                                        'that echoes messages.')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('-n', '--connections', type=int, default=100,
+                        help='number of connections (default 100)')
+    parser.add_argument('-r', '--rate', type=float, default=1.0,
+                        help='messages per second per connection (default 1)')
+    parser.add_argument('-s', '--size', type=size_arg, default=64,
+                        help='payload size, or a MIN-MAX range for uniformly '
+                             'distributed sizes (default 64)')
+    parser.add_argument('-c', '--constant', action='store_true',
+                        help='send at constant intervals instead of using '
+                             'exponentially distributed intervals')
+    parser.add_argument('-u', '--ramp-up', type=float, default=0.0,
+                        help='time over which the connections are opened')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='duration of the test after the ramp-up')
+    parser.add_argument('-b', '--bind', action='append', default=[],
+                        help='local address to bind connections to (can be '
+                             'repeated)')
+    parser.add_argument('-l', '--location', default='/',
+                        help='requested resource location')
+    args = parser.parse_args()
+
+    gen = LoadGenerator((args.host, args.port), args.connections, args.rate,
+                        args.size, args.ramp_up, args.duration,
+                        poisson=not args.constant, sources=args.bind,
+                        location=args.location)
+    print json.dumps(gen.run(), indent=4, sort_keys=True)
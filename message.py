@@ -1,16 +1,24 @@
 from frame import Frame, OPCODE_TEXT, OPCODE_BINARY
 
 
-__all__ = ['Message', 'TextMessage', 'BinaryMessage']
+__all__ = ['Message', 'TextMessage', 'BinaryMessage', 'EncodedMessage']
 
 
 class Message(object):
-    def __init__(self, opcode, payload):
+    def __init__(self, opcode, payload, compress=True):
+        """
+        `compress` may be set to False to send the message uncompressed when
+        a compression extension is used, e.g. for data that is already
+        compressed.
+        """
         self.opcode = opcode
         self.payload = payload
+        self.compress = compress
 
     def frame(self, mask=False):
-        return Frame(self.opcode, self.payload, mask=mask)
+        frame = Frame(self.opcode, self.payload, mask=mask)
+        frame.compress = self.compress
+        return frame
 
     def fragment(self, fragment_size, mask=False):
         return self.frame().fragment(fragment_size, mask)
@@ -21,11 +29,14 @@ class Message(object):
 
 
 class TextMessage(Message):
-    def __init__(self, payload):
-        super(TextMessage, self).__init__(OPCODE_TEXT, unicode(payload))
+    def __init__(self, payload, compress=True):
+        super(TextMessage, self).__init__(OPCODE_TEXT, unicode(payload),
+                                          compress)
 
     def frame(self, mask=False):
-        return Frame(self.opcode, self.payload.encode('utf-8'), mask=mask)
+        frame = Frame(self.opcode, self.payload.encode('utf-8'), mask=mask)
+        frame.compress = self.compress
+        return frame
 
     def __str__(self):
         if len(self.payload) > 30:
@@ -36,8 +47,19 @@ class TextMessage(Message):
 
 
 class BinaryMessage(Message):
-    def __init__(self, payload):
-        super(BinaryMessage, self).__init__(OPCODE_BINARY, bytearray(payload))
+    def __init__(self, payload, compress=True):
+        super(BinaryMessage, self).__init__(OPCODE_BINARY, bytearray(payload),
+                                            compress)
+
+
+class EncodedMessage(Message):
+    def __init__(self, opcode, payload, obj, compress=True):
+        """
+        Message whose `payload` is the encoding of `obj` by a `Codec`. The
+        payload is sent as is, also for text messages.
+        """
+        super(EncodedMessage, self).__init__(opcode, payload, compress)
+        self.obj = obj
 
 
 def create_message(opcode, payload):
@@ -0,0 +1,476 @@
+import struct
+import logging
+from threading import Lock
+from collections import deque
+
+from extension import Extension
+from frame import ControlFrame
+from message import Message, BinaryMessage, create_message
+
+
+__all__ = ['Multiplex', 'Channel', 'multiplexer']
+
+
+CONTROL_CHANNEL = 0
+DEFAULT_CHANNEL = 1
+
+ADD_CHANNEL_REQUEST = 0
+ADD_CHANNEL_RESPONSE = 1
+FLOW_CONTROL = 2
+DROP_CHANNEL = 3
+
+DEFAULT_QUOTA = 1 << 16
+
+
+class Multiplex(Extension):
+    """
+    Multiplexing extension in the spirit of the "mux" draft
+    (http://tools.ietf.org/html/draft-ietf-hybi-websocket-multiplexing-11).
+    Many logical channels share a single websocket, and thus a single TCP
+    connection, handshake and compression context.
+
+    The payload of each message starts with the ID of its channel. Messages
+    sent and received by the `Connection` of the websocket itself belong to
+    the default channel, so it works as usual. Channel 0 carries control
+    messages that open and close channels, and replenish send quotas.
+
+    Each channel has its own flow control window of `quota` bytes. Messages
+    are sent on a channel as long as less than `quota` bytes of earlier
+    messages have not been handled by the receiver, so the window is
+    exceeded by at most one message. More messages are queued by the sender
+    until the receiver reports that it has handled earlier messages.
+
+    Channels are `Channel` instances. Channels opened by the other end point
+    are instances of `channel_class`, at most `max_channels` at a time.
+
+    Example server:
+    >>> class EchoChannel(wspy.Channel):
+    >>>     def onmessage(self, message):
+    >>>         self.send(message)
+
+    >>> server = wspy.AsyncServer(('', 8000),
+    >>>                           extensions=[wspy.Multiplex(EchoChannel)])
+
+    Example client, with an `EchoConnection` as in the `Connection` example:
+    >>> sock = wspy.websocket(extensions=[wspy.Multiplex()])
+    >>> sock.connect(('', 8000))
+    >>> conn = EchoConnection(sock)
+    >>> channel = wspy.multiplexer(conn).open(MyChannel)
+    >>> channel.send(wspy.TextMessage('Hello, Channel!'))
+    """
+    name = 'mux'
+    before_fragmentation = True
+    defaults = {
+        'quota': DEFAULT_QUOTA
+    }
+
+    def __init__(self, channel_class=None, max_channels=256, **kwargs):
+        super(Multiplex, self).__init__(**kwargs)
+        self.channel_class = channel_class or Channel
+        self.max_channels = max_channels
+
+    def negotiate(self, name, params):
+        quota = self.defaults['quota']
+
+        if 'quota' in params:
+            assert params['quota'] is not True
+            requested = int(params['quota'])
+            assert requested > 0
+            yield 'quota', min(requested, quota)
+        elif quota != DEFAULT_QUOTA:
+            yield 'quota', quota
+
+    class Instance(Extension.Instance):
+        def init(self):
+            self.connection = None
+            self.lock = Lock()
+            self.control = ControlChannel(self)
+            self.channels = {CONTROL_CHANNEL: self.control}
+
+            # Clients allocate even channel IDs and servers odd ones, so that
+            # both can open channels at the same time
+            self.next_id = 2 if self.client else 3
+
+        def is_transferable(self):
+            return len(self.channels) == 1
+
+        def open(self, channel_class=None, location=''):
+            """
+            Open a new channel, which is an instance of `channel_class` (the
+            `channel_class` of the extension by default). The optional
+            `location` is passed to the other end point, which may use it to
+            select a service. The channel can be used immediately, messages
+            are queued until the other end point has accepted the channel.
+            """
+            channel_class = channel_class or self.extension.channel_class
+
+            with self.lock:
+                channel_id = self.next_id
+                self.next_id += 2
+                channel = channel_class(self, channel_id, location)
+                self.channels[channel_id] = channel
+
+            self.control.send_block(ADD_CHANNEL_REQUEST, channel_id,
+                                    location.encode('utf-8'))
+            return channel
+
+        def release(self):
+            with self.lock:
+                channels = [channel for channel in self.channels.itervalues()
+                            if channel is not self.control]
+                self.channels = {CONTROL_CHANNEL: self.control}
+
+            for channel in channels:
+                channel.handle_close(None, 'connection closed')
+
+        def onsend(self, frame):
+            if not isinstance(frame, ControlFrame):
+                channel_id = DEFAULT_CHANNEL if frame.channel is None \
+                             else frame.channel.id
+                frame.payload = encode_channel_id(channel_id) + frame.payload
+
+        def onrecv(self, frame):
+            if isinstance(frame, ControlFrame):
+                return
+
+            channel_id, length = decode_channel_id(frame.payload)
+            frame.payload = frame.payload[length:]
+
+            # The message is delivered to the channel instead of the
+            # connection (see `Connection.concat_fragments`)
+            if channel_id != DEFAULT_CHANNEL:
+                with self.lock:
+                    frame.channel = self.channels.get(channel_id)
+
+                if frame.channel is None:
+                    raise ValueError('received message for unknown channel '
+                                     '%d' % channel_id)
+
+
+class Channel(object):
+    """
+    A logical channel of a websocket on which the `Multiplex` extension has
+    been negotiated. The API is similar to that of `Connection`: extend this
+    class and implement the on*() event handlers, and use send() and close()
+    to send messages and close the channel.
+
+    The event handlers are called by the thread or event loop that receives
+    the messages of the websocket.
+    """
+    def __init__(self, mux, channel_id, location=''):
+        """
+        `mux` is the `Multiplex.Instance` of the websocket, and `location` is
+        the location passed to `Multiplex.Instance.open`.
+        """
+        self.mux = mux
+        self.id = channel_id
+        self.location = location
+
+        self.opened = False
+        self.closed = False
+        self.close_params = None
+        self.drop_sent = False
+
+        # Queued messages, which are sent by one thread at a time in order
+        self.pending = deque()
+        self.flushing = False
+        self.send_quota = mux.quota
+        self.recv_handled = 0
+
+    def __str__(self):
+        return '<%s %d on %s>' \
+               % (self.__class__.__name__, self.id, self.mux.connection)
+
+    def send(self, message, fragment_size=None, mask=None):
+        """
+        Send a message (see `Connection.send`). Frames are masked by default
+        for client sockets. The message is queued if the channel has not been
+        opened yet, or if the send quota has been used up.
+        """
+        if mask is None:
+            mask = self.mux.client
+
+        message = ChannelMessage(self, message, mask)
+
+        with self.mux.lock:
+            if self.closed or self.close_params is not None:
+                logging.debug('Dropped %s to closing %s', message, self)
+                return
+
+            self.pending.append((message, fragment_size, mask))
+
+        self.flush()
+
+    def flush(self):
+        """
+        Send queued messages in order, as long as the send quota has not been
+        used up.
+        """
+        while True:
+            with self.mux.lock:
+                if self.flushing or not self.opened or self.closed:
+                    return
+
+                if self.pending:
+                    if self.send_quota <= 0:
+                        return
+
+                    message, fragment_size, mask = self.pending.popleft()
+                    self.send_quota -= len(message.payload)
+                elif self.close_params is not None and not self.drop_sent:
+                    message = None
+                    self.drop_sent = True
+                else:
+                    return
+
+                self.flushing = True
+
+            try:
+                if message:
+                    self.mux.connection.send(message, fragment_size, mask)
+                else:
+                    code, reason = self.close_params
+                    self.mux.control.send_drop(self.id, code, reason)
+            finally:
+                with self.mux.lock:
+                    self.flushing = False
+
+    def close(self, code=None, reason=''):
+        """
+        Close the channel after the queued messages have been sent. The
+        onclose() handler is called when the other end point has confirmed
+        that the channel is closed.
+        """
+        with self.mux.lock:
+            if self.close_params is None:
+                self.close_params = code, reason
+
+        self.flush()
+
+    def feed(self, connection, frame):
+        """
+        Handle a message received by `connection`, whose payload has been
+        stripped of the channel ID by the `Multiplex` extension.
+        """
+        if self.closed:
+            return
+
+        self.onmessage(create_message(frame.opcode, frame.payload))
+
+        # Replenish the send quota of the other end point when half of it
+        # has been used up
+        self.recv_handled += len(frame.payload)
+
+        if self.recv_handled >= self.mux.quota / 2:
+            self.mux.control.send_block(FLOW_CONTROL, self.id,
+                                        struct.pack('!Q', self.recv_handled))
+            self.recv_handled = 0
+
+    def handle_open(self):
+        with self.mux.lock:
+            self.opened = True
+
+        self.onopen()
+        self.flush()
+
+    def handle_quota(self, quota):
+        with self.mux.lock:
+            self.send_quota += quota
+
+        self.flush()
+
+    def handle_close(self, code, reason):
+        with self.mux.lock:
+            if self.closed:
+                return
+
+            self.closed = True
+            self.pending.clear()
+
+        self.onclose(code, reason)
+
+    def onopen(self):
+        """
+        Called when the channel has been opened by either end point.
+        """
+        return NotImplemented
+
+    def onmessage(self, message):
+        """
+        Called when a message is received on the channel.
+        """
+        return NotImplemented
+
+    def onclose(self, code, reason):
+        """
+        Called when the channel has been closed by either end point, or when
+        the websocket is closed.
+        """
+        return NotImplemented
+
+
+class ControlChannel(Channel):
+    """
+    Channel 0, on which control messages (blocks) are exchanged. A control
+    block consists of an opcode byte, a channel ID and opcode-specific data.
+    """
+    def __init__(self, mux):
+        Channel.__init__(self, mux, CONTROL_CHANNEL)
+        self.opened = True
+
+    def send_block(self, opcode, channel_id, data=''):
+        payload = chr(opcode) + encode_channel_id(channel_id) + data
+        message = ChannelMessage(self, BinaryMessage(payload, compress=False),
+                                 self.mux.client)
+        self.mux.connection.send(message, mask=self.mux.client)
+
+    def send_drop(self, channel_id, code, reason):
+        self.send_block(DROP_CHANNEL, channel_id,
+                        struct.pack('!H', code or 0) + reason.encode('utf-8'))
+
+    def feed(self, connection, frame):
+        mux = self.mux
+
+        if mux.connection is None:
+            mux.connection = connection
+
+        payload = str(frame.payload)
+
+        if not payload:
+            raise ValueError('empty control block')
+
+        opcode = ord(payload[0])
+        channel_id, length = decode_channel_id(payload[1:])
+        data = payload[1 + length:]
+
+        with mux.lock:
+            channel = mux.channels.get(channel_id)
+
+        if opcode == ADD_CHANNEL_REQUEST:
+            if channel is not None or channel_id <= DEFAULT_CHANNEL or \
+                    channel_id % 2 == mux.next_id % 2:
+                raise ValueError('invalid channel ID %d requested'
+                                 % channel_id)
+
+            with mux.lock:
+                accept = len(mux.channels) <= mux.extension.max_channels
+
+                if accept:
+                    channel = mux.extension.channel_class(
+                            mux, channel_id, data.decode('utf-8'))
+                    mux.channels[channel_id] = channel
+
+            self.send_block(ADD_CHANNEL_RESPONSE, channel_id,
+                            chr(not accept))
+
+            if accept:
+                channel.handle_open()
+            else:
+                logging.debug('Rejected channel %d, the maximum number of '
+                              'channels is reached', channel_id)
+        elif channel is None:
+            # The channel may have been closed concurrently
+            logging.debug('Ignored control block %d for unknown channel %d',
+                          opcode, channel_id)
+        elif opcode == ADD_CHANNEL_RESPONSE:
+            if data[:1] == '\x00':
+                channel.handle_open()
+            else:
+                with mux.lock:
+                    mux.channels.pop(channel_id, None)
+
+                channel.handle_close(None, 'rejected')
+        elif opcode == FLOW_CONTROL:
+            quota, = struct.unpack('!Q', data)
+            channel.handle_quota(quota)
+        elif opcode == DROP_CHANNEL:
+            code, = struct.unpack('!H', data[:2])
+            reason = data[2:].decode('utf-8')
+
+            with mux.lock:
+                mux.channels.pop(channel_id, None)
+                confirm = not channel.drop_sent
+                channel.drop_sent = True
+
+            # Confirm that the channel is closed, unless we closed it
+            if confirm:
+                self.send_drop(channel_id, code, reason)
+
+            channel.handle_close(code or None, reason)
+        else:
+            raise ValueError('invalid control block opcode %d' % opcode)
+
+
+class ChannelMessage(Message):
+    """
+    A message of a channel, which is sent on the websocket. The frame is
+    created in advance, so that the size of its payload is known.
+    """
+    def __init__(self, channel, message, mask):
+        frame = message.frame(mask=mask)
+        frame.channel = channel
+        super(ChannelMessage, self).__init__(frame.opcode, frame.payload,
+                                             message.compress)
+        self.channel_frame = frame
+
+    def frame(self, mask=False):
+        return self.channel_frame
+
+
+def multiplexer(connection):
+    """
+    Get the `Multiplex.Instance` of the websocket of `connection`, through
+    which channels are opened (see `Multiplex.Instance.open`).
+    """
+    for inst in connection.sock.extension_instances:
+        if isinstance(inst, Multiplex.Instance):
+            inst.connection = connection
+            return inst
+
+    raise ValueError('the "mux" extension has not been negotiated')
+
+
+def encode_channel_id(channel_id):
+    """
+    Encode a channel ID of up to 29 bits in 1 to 4 bytes, the number of
+    leading ones in the first byte indicates the number of extra bytes.
+    """
+    if channel_id < 1 << 7:
+        return chr(channel_id)
+
+    if channel_id < 1 << 14:
+        return struct.pack('!H', 0x8000 | channel_id)
+
+    if channel_id < 1 << 21:
+        return struct.pack('!I', 0xc00000 | channel_id)[1:]
+
+    if channel_id < 1 << 29:
+        return struct.pack('!I', 0xe0000000 | channel_id)
+
+    raise ValueError('channel ID %d is too large' % channel_id)
+
+
+def decode_channel_id(data):
+    """
+    Decode the channel ID at the start of `data`. Returns a (channel ID,
+    number of bytes) tuple.
+    """
+    head = bytearray(data[:4])
+
+    if not head:
+        raise ValueError('missing channel ID')
+
+    if head[0] < 0x80:
+        return head[0], 1
+
+    length = 2 if head[0] < 0xc0 else 3 if head[0] < 0xe0 else 4
+
+    if len(head) < length:
+        raise ValueError('incomplete channel ID')
+
+    channel_id = head[0] & (0x3f, 0x1f, 0x1f)[length - 2]
+
+    for byte in head[1:length]:
+        channel_id = channel_id << 8 | byte
+
+    return channel_id, length
@@ -0,0 +1,64 @@
+import logging
+from Queue import Queue
+from threading import Thread
+from traceback import format_exc
+
+
+__all__ = ['ThreadPool']
+
+
+class ThreadPool(object):
+    """
+    Fixed-size pool of worker threads, with the submit() and shutdown() methods
+    of a concurrent.futures executor (but submit() does not return a future).
+    Servers use it when no executor is specified, since concurrent.futures is
+    not part of the Python 2 standard library.
+
+    Example:
+    >>> import wspy
+    >>> pool = wspy.ThreadPool(64)
+    >>> server = wspy.Server(('', 8000), io_threads=2, executor=pool)
+    """
+    def __init__(self, nthreads=32):
+        """
+        `nthreads` is the number of worker threads, which are started
+        immediately.
+        """
+        self.queue = Queue()
+        self.threads = [Thread(target=self.work) for i in xrange(nthreads)]
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+
+            if task is None:
+                break
+
+            func, args, kwargs = task
+
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logging.error(format_exc(e).rstrip())
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedule a call of `func` with the given arguments in a worker thread.
+        """
+        self.queue.put((func, args, kwargs))
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads after the already submitted calls have been
+        made, and wait for them to finish if `wait` is True.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+
+        if wait:
+            for thread in self.threads:
+                thread.join()
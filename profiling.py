@@ -0,0 +1,123 @@
+import time
+from heapq import heappush, heapreplace
+from threading import Lock
+
+
+__all__ = ['Profiler', 'HandlerProfiler']
+
+
+class Profiler(object):
+    """
+    Hook interface for profiling the event loop of an `AsyncServer`. Pass an
+    instance to the server constructor using the `profiler` argument, and
+    overwrite onloop() and/or onhandler() to feed the measurements into a
+    custom profiler. When no profiler is passed, the event handlers are not
+    wrapped, so profiling does not cost anything.
+    """
+    def timed(self, name, func, client=None):
+        """
+        Wrap `func` so that its duration is reported to onhandler() after each
+        call. If `client` is None, it is assumed to be the first argument
+        passed to `func` (as is the case for the server's event handlers).
+        """
+        def wrapper(*args):
+            start = time.time()
+
+            try:
+                return func(*args)
+            finally:
+                who = args[0] if client is None else client
+                self.onhandler(name, who, time.time() - start)
+
+        return wrapper
+
+    def onloop(self, lag, nevents):
+        """
+        Called after each poll of the event loop. `lag` is the time (in
+        seconds) by which the poll returned later than scheduled: the time
+        spent handling the events of the previous poll (during which newly
+        ready events had to wait), plus the time by which the poll exceeded its
+        timeout. `nevents` is the number of events returned by the poll.
+        """
+        return NotImplemented
+
+    def onhandler(self, name, client, duration):
+        """
+        Called after an event handler has returned. `name` is the name of the
+        handler (e.g. "onmessage" or "permessage-deflate.onsend"), `client` is
+        the client for which it was called, and `duration` is the time (in
+        seconds) spent in the handler.
+        """
+        return NotImplemented
+
+
+class HandlerProfiler(Profiler):
+    """
+    Profiler that keeps loop lag statistics, the total time spent per handler
+    and the `nslowest` slowest handler calls with the identity of the client.
+    Use report() to get a summary.
+
+    Handlers that are run by the worker threads of an executor report their
+    durations from those threads, so the statistics are guarded by a lock.
+    """
+    def __init__(self, nslowest=10):
+        self.nslowest = nslowest
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.npolls = 0
+            self.total_lag = 0.0
+            self.max_lag = 0.0
+            self.handlers = {}
+            self.slowest = []
+
+    def onloop(self, lag, nevents):
+        with self.lock:
+            self.npolls += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def onhandler(self, name, client, duration):
+        with self.lock:
+            if name in self.handlers:
+                calls, total, maximum = self.handlers[name]
+                self.handlers[name] = calls + 1, total + duration, \
+                                      max(maximum, duration)
+            else:
+                self.handlers[name] = 1, duration, duration
+
+            # Only format the client when the call is among the slowest calls
+            if len(self.slowest) < self.nslowest:
+                heappush(self.slowest, (duration, name, str(client)))
+            elif duration > self.slowest[0][0]:
+                heapreplace(self.slowest, (duration, name, str(client)))
+
+    def report(self):
+        """
+        Summarize the measurements in a multi-line string.
+        """
+        with self.lock:
+            return self.format_report()
+
+    def format_report(self):
+        lines = []
+
+        if self.npolls:
+            lines.append('loop lag: avg %.3f ms, max %.3f ms (%d polls)'
+                         % (self.total_lag / self.npolls * 1000,
+                            self.max_lag * 1000, self.npolls))
+
+        for name, (calls, total, maximum) in sorted(self.handlers.items()):
+            lines.append('%s: %d calls, avg %.3f ms, max %.3f ms'
+                         % (name, calls, total / calls * 1000, maximum * 1000))
+
+        if self.slowest:
+            lines.append('slowest handler calls:')
+
+            for duration, name, client in sorted(self.slowest, reverse=True):
+                lines.append('  %.3f ms %s %s' % (duration * 1000, name,
+                                                   client))
+
+        return '\n'.join(lines)
@@ -0,0 +1,287 @@
+import zlib
+import time
+import socket
+import logging
+from base64 import b64decode
+from collections import deque
+from threading import Thread, Lock
+
+from websocket import websocket
+from connection import Connection
+from message import Message
+from frame import OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY
+from capture import MAGIC, read_capture
+from errors import SocketClosed
+from stats import percentiles
+
+
+__all__ = ['load_records', 'Replay']
+
+
+def load_records(filename, outgoing=False):
+    """
+    Load the messages to replay from `filename`, returning a list of
+    (timestamp, opcode, payload) tuples. The file is either a capture file
+    (see `Capture`), or a text file with one "timestamp direction opcode
+    payload" line per message, where direction is "in" or "out" and the
+    payload is base64-encoded.
+
+    Only messages in the given direction are loaded: by default the messages
+    received by the server (`outgoing=False`), which are the messages a client
+    should send during the replay. Captured payloads are truncated, so they
+    are padded to the recorded length.
+
+    Frames are captured as they are sent over the wire, so the payloads of
+    messages compressed by permessage-deflate (RSV1 set on the first frame)
+    are inflated. This requires the complete compressed payload, and with
+    context takeover also the preceding messages of the connection: such
+    messages can only be replayed from a capture of all frames
+    (`sample_rate` 1.0) with a `max_payload` of at least the message size.
+    Compressed messages that cannot be inflated are skipped with a warning.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return list(parse_text_records(f, outgoing))
+
+        f.seek(0)
+        return list(capture_to_messages(read_capture(f), outgoing))
+
+
+def parse_text_records(f, outgoing):
+    for line in f:
+        line = line.strip()
+
+        if not line or line.startswith('#'):
+            continue
+
+        parts = line.split(None, 3)
+        timestamp, direction, opcode = parts[:3]
+        payload = b64decode(parts[3]) if len(parts) > 3 else ''
+
+        if (direction == 'out') == outgoing:
+            yield float(timestamp), int(opcode, 0), payload
+
+
+def capture_to_messages(records, outgoing):
+    # Fragments are merged into the last message of the same connection,
+    # whose captured payloads are kept for inflating
+    messages = []
+    last = {}
+
+    for record in records:
+        if record.outgoing != outgoing:
+            continue
+
+        if record.opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            last[record.conn] = len(messages)
+            messages.append([record, record.length, [record.payload], True])
+        elif record.opcode == OPCODE_CONTINUATION and record.conn in last:
+            message = messages[last[record.conn]]
+            message[1] += record.length
+            message[2].append(record.payload)
+
+            # Fragments may have been lost
+            if record.gap:
+                message[3] = False
+
+    # Inflaters by connection, which are dropped when a message could not be
+    # inflated so that later messages do not refer to missing history
+    inflaters = {}
+    skipped = 0
+
+    for first, length, fragments, complete in messages:
+        if first.gap:
+            inflaters.clear()
+
+        if not first.rsv1:
+            yield first.time, first.opcode, \
+                  pad_payload(first.opcode, fragments[0], length)
+            continue
+
+        inflater = inflaters.pop(first.conn, None) or \
+                   zlib.decompressobj(-zlib.MAX_WBITS)
+        compressed = ''.join(fragments)
+        payload = None
+
+        if complete and len(compressed) == length:
+            try:
+                payload = inflater.decompress(compressed + '\x00\x00\xff\xff')
+            except zlib.error:
+                pass
+
+        if payload is None:
+            skipped += 1
+            continue
+
+        inflaters[first.conn] = inflater
+        yield first.time, first.opcode, payload
+
+    if skipped:
+        logging.warning('Skipped %d compressed messages that could not be '
+                        'inflated, because their payloads or earlier frames '
+                        'were not captured', skipped)
+
+
+def pad_payload(opcode, captured, length):
+    if opcode == OPCODE_TEXT:
+        # The captured prefix may end halfway an UTF-8 sequence
+        captured = captured.decode('utf-8', 'ignore').encode('utf-8')
+        filler = 'x'
+    else:
+        filler = '\x00'
+
+    captured = captured[:length]
+    return captured + filler * (length - len(captured))
+
+
+class Replay(object):
+    """
+    Replays recorded messages over `nconns` client connections, distributing
+    the messages round-robin over the connections while preserving the
+    recorded timing (divided by `speed`). Responses are assumed to be echoed
+    in order, so the latency of each response is measured from the time the
+    corresponding message was sent.
+    """
+    def __init__(self, address, records, nconns=1, speed=1.0, location='/',
+                 **kwargs):
+        """
+        `address` is the (host, port) tuple of the server to connect to, and
+        `records` is a list of (timestamp, opcode, payload) tuples as
+        returned by load_records(). Any additional keyword arguments are
+        passed to the websocket constructor.
+        """
+        self.address = address
+        self.records = sorted(records)
+        self.nconns = nconns
+        self.speed = speed
+        self.location = location
+        self.sock_args = kwargs
+
+        self.lock = Lock()
+        self.latencies = []
+        self.nreceived = 0
+        self.bytes_received = 0
+
+    def connect(self):
+        self.conns = []
+
+        for i in xrange(self.nconns):
+            sock = websocket(location=self.location, **self.sock_args)
+            sock.connect(self.address)
+            conn = Connection(sock)
+            conn.pending = deque()
+            self.conns.append(conn)
+
+    def receive(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (SocketClosed, socket.error):
+                break
+
+            now = time.time()
+
+            with self.lock:
+                self.nreceived += 1
+                self.bytes_received += len(message.payload)
+
+                if conn.pending:
+                    self.latencies.append(now - conn.pending.popleft())
+
+    def run(self, wait=2.0):
+        """
+        Connect, replay all messages and wait at most `wait` seconds for
+        outstanding responses. Returns a dictionary with results.
+        """
+        self.connect()
+
+        receivers = [Thread(target=self.receive, args=(conn,))
+                     for conn in self.conns]
+
+        for thread in receivers:
+            thread.daemon = True
+            thread.start()
+
+        bytes_sent = 0
+        start = time.time()
+        first = self.records[0][0] if self.records else 0
+
+        for i, (timestamp, opcode, payload) in enumerate(self.records):
+            delay = start + (timestamp - first) / self.speed - time.time()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            conn = self.conns[i % self.nconns]
+
+            with self.lock:
+                conn.pending.append(time.time())
+
+            conn.send(Message(opcode, payload), mask=True)
+            bytes_sent += len(payload)
+
+        duration = time.time() - start
+        deadline = time.time() + wait
+
+        while time.time() < deadline and self.nreceived < len(self.records):
+            time.sleep(0.010)
+
+        for conn in self.conns:
+            try:
+                conn.sock.close()
+            except socket.error:
+                pass
+
+        return self.results(duration, bytes_sent)
+
+    def results(self, duration, bytes_sent):
+        with self.lock:
+            latencies = list(self.latencies)
+
+            results = {
+                'connections': self.nconns,
+                'speed': self.speed,
+                'duration': duration,
+                'messages_sent': len(self.records),
+                'bytes_sent': bytes_sent,
+                'messages_received': self.nreceived,
+                'bytes_received': self.bytes_received,
+            }
+
+        if duration:
+            results['send_rate'] = len(self.records) / duration
+            results['receive_rate'] = results['messages_received'] / duration
+
+        if latencies:
+            results['latency'] = percentiles(latencies)
+
+        return results
+
+
+if __name__ == '__main__':
+    import json
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Replay recorded messages against a '
+                                        'websocket server.')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('file', help='capture file or text recording')
+    parser.add_argument('-n', '--connections', type=int, default=1,
+                        help='number of client connections (default 1)')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='speedup factor of the recorded timing')
+    parser.add_argument('-l', '--location', default='/',
+                        help='requested resource location')
+    parser.add_argument('-o', '--outgoing', action='store_true',
+                        help='replay messages sent by the recording server '
+                             'instead of those it received')
+    parser.add_argument('-w', '--wait', type=float, default=2.0,
+                        help='time to wait for outstanding responses')
+    args = parser.parse_args()
+
+    records = load_records(args.file, args.outgoing)
+    replay = Replay((args.host, args.port), records, args.connections,
+                    args.speed, args.location)
+    print json.dumps(replay.run(args.wait), indent=4, sort_keys=True)
@@ -0,0 +1,386 @@
+import json
+import logging
+from itertools import count
+from threading import Lock, Event
+
+from frame import OPCODE_TEXT
+from message import Message, EncodedMessage
+from errors import RpcError, RpcTimeout
+from timer import timer_thread
+
+
+__all__ = ['Rpc', 'Future']
+
+
+# JSON-RPC 2.0 error codes
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+class Rpc(object):
+    """
+    Remote procedure calls over a connection, in the format of JSON-RPC 2.0.
+    Each call has an ID with which its response is matched, so that any
+    number of calls can be outstanding at the same time, and responses may
+    arrive in any order.
+
+    A call returns a `Future` whose result() waits for the response, or it
+    is answered by a callback if one is specified, which is the way to use
+    calls in an event loop. Calls that are not answered within `timeout`
+    seconds fail with an `RpcTimeout`. Timeouts are driven by the event loop
+    of an `AsyncServer` for its clients and outbound connections, and by a
+    shared `TimerThread` for other connections, unless a `scheduler` with a
+    call_later() method (such as an asyncio loop) is specified.
+
+    If a `flush_window` is specified, calls and responses are not sent right
+    away, but are collected for at most `flush_window` seconds and sent
+    together as a JSON array in a single message, until `max_batch_size`
+    bytes have been collected. The responses to such a batch are sent as a
+    batch as well.
+
+    `methods` is a dict with the functions that the other end point may
+    call. A function is passed the params of the call, and its return value
+    is the result. An exception raised by the function is returned as an
+    error response, with the code of an `RpcError` or -32000 otherwise.
+
+    The functions are called by the thread that calls feed(). For the
+    clients of an `AsyncServer`, this is the event loop thread unless the
+    server has an `executor`, so a function that blocks stalls all other
+    connections of the server. Servers with blocking methods should
+    therefore be created with an executor, which runs the onmessage()
+    handlers (and thus the methods) in its worker threads.
+
+    The connection passes its received messages to feed(), and close() when
+    it is closed.
+
+    Example client:
+    >>> class RpcClient(wspy.Connection):
+    >>>     def onopen(self):
+    >>>         self.rpc = wspy.Rpc(self, timeout=5, flush_window=0.001)
+
+    >>>     def onmessage(self, message):
+    >>>         self.rpc.feed(message)
+
+    >>>     def onclose(self, code, reason):
+    >>>         self.rpc.close()
+
+    >>> sock = wspy.websocket()
+    >>> sock.connect(('', 8000))
+    >>> conn = RpcClient(sock)
+    >>> threading.Thread(target=conn.receive_forever).start()
+    >>> futures = [conn.rpc.call('add', i, 1) for i in xrange(100)]
+    >>> print [future.result() for future in futures]
+
+    Example server:
+    >>> class RpcServer(wspy.AsyncServer):
+    >>>     def onopen(self, client):
+    >>>         client.rpc = wspy.Rpc(client, {'add': operator.add})
+
+    >>>     def onmessage(self, client, message):
+    >>>         client.rpc.feed(message)
+
+    >>>     def onclose(self, client, code, reason):
+    >>>         client.rpc.close()
+    """
+    def __init__(self, conn, methods=None, timeout=30, flush_window=None,
+                 max_batch_size=4096, scheduler=None):
+        self.conn = conn
+        self.methods = methods or {}
+        self.timeout = timeout
+        self.flush_window = flush_window
+        self.max_batch_size = max_batch_size
+
+        if scheduler is None:
+            server = getattr(conn, 'server', None)
+            scheduler = server if hasattr(server, 'call_later') \
+                        else timer_thread()
+
+        self.scheduler = scheduler
+
+        self.lock = Lock()
+        self.ids = count(1)
+        self.closed = False
+
+        # Callbacks and timeout timers of outstanding calls by ID
+        self.pending = {}
+
+        # Encoded calls and responses that are waiting to be flushed
+        self.batch = []
+        self.batch_size = 0
+        self.flush_timer = None
+
+        # Nesting depth of received batches, whose responses are flushed
+        # together
+        self.deferred = 0
+
+    def call(self, method, *params, **kwargs):
+        """
+        Call `method` with the positional `params`. Returns a `Future`,
+        unless a `callback` keyword argument is specified, which is called as
+        callback(result, error) instead. `error` is None for a successful
+        call, or an `RpcError` otherwise. The `timeout` keyword argument
+        overrides the default timeout (None disables it).
+        """
+        callback = kwargs.pop('callback', None)
+        timeout = kwargs.pop('timeout', self.timeout)
+        future = None
+
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s'
+                            % ', '.join(kwargs))
+
+        if callback is None:
+            future = Future()
+            callback = future.set
+
+        with self.lock:
+            if self.closed:
+                closed = True
+            else:
+                closed = False
+                call_id = next(self.ids)
+                timer = None
+
+                if timeout is not None:
+                    timer = self.scheduler.call_later(timeout, self.expire,
+                                                      call_id, timeout)
+
+                self.pending[call_id] = callback, timer
+
+        if closed:
+            callback(None, RpcError('connection closed'))
+        else:
+            self.queue({'jsonrpc': '2.0', 'id': call_id, 'method': method,
+                        'params': params})
+
+        return future
+
+    def notify(self, method, *params):
+        """
+        Call `method` with the positional `params` without expecting a
+        response (a JSON-RPC notification).
+        """
+        self.queue({'jsonrpc': '2.0', 'method': method, 'params': params})
+
+    def queue(self, obj):
+        data = json.dumps(obj, separators=(',', ':'))
+
+        with self.lock:
+            if self.closed:
+                return
+
+            self.batch.append(data)
+            self.batch_size += len(data)
+
+            if self.batch_size < self.max_batch_size:
+                if self.deferred:
+                    return
+
+                if self.flush_window:
+                    if self.flush_timer is None:
+                        self.flush_timer = self.scheduler.call_later(
+                            self.flush_window, self.flush)
+
+                    return
+
+            batch = self.take_batch()
+
+        self.send_batch(batch)
+
+    def flush(self):
+        """
+        Send the calls and responses that are waiting for the flush window
+        to end.
+        """
+        with self.lock:
+            batch = self.take_batch()
+
+        self.send_batch(batch)
+
+    def take_batch(self):
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        batch = self.batch
+        self.batch = []
+        self.batch_size = 0
+        return batch
+
+    def send_batch(self, batch):
+        if not batch:
+            return
+
+        payload = batch[0] if len(batch) == 1 else '[%s]' % ','.join(batch)
+
+        # The payload is already encoded, so it bypasses TextMessage
+        self.conn.send(Message(OPCODE_TEXT, payload),
+                       mask=self.conn.sock.mask_frames)
+
+    def feed(self, message):
+        """
+        Handle a received message. Returns True if it contains calls or
+        responses, or False if it is not an RPC message (so that it may be
+        handled otherwise).
+        """
+        if message.opcode != OPCODE_TEXT:
+            return False
+
+        if isinstance(message, EncodedMessage):
+            # Already decoded by the `JsonCodec` of the connection
+            data = message.obj
+        else:
+            try:
+                data = json.loads(message.payload)
+            except ValueError:
+                return False
+
+        if isinstance(data, dict):
+            return self.handle(data)
+
+        if not isinstance(data, list) or not data:
+            return False
+
+        with self.lock:
+            self.deferred += 1
+
+        try:
+            for entry in data:
+                if not isinstance(entry, dict) or not self.handle(entry):
+                    logging.debug('Ignored invalid RPC entry %r', entry)
+        finally:
+            with self.lock:
+                self.deferred -= 1
+                batch = [] if self.deferred else self.take_batch()
+
+            self.send_batch(batch)
+
+        return True
+
+    def handle(self, entry):
+        if 'method' in entry:
+            self.handle_call(entry)
+        elif 'id' in entry and ('result' in entry or 'error' in entry):
+            self.handle_response(entry)
+        else:
+            return False
+
+        return True
+
+    def handle_call(self, entry):
+        call_id = entry.get('id')
+        method = self.methods.get(entry['method'])
+        params = entry.get('params', [])
+
+        try:
+            if method is None:
+                raise RpcError('method not found', METHOD_NOT_FOUND)
+
+            if isinstance(params, dict):
+                result = method(**params)
+            elif isinstance(params, list):
+                result = method(*params)
+            else:
+                raise RpcError('invalid params', INVALID_PARAMS)
+
+            response = {'jsonrpc': '2.0', 'id': call_id, 'result': result}
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            if not isinstance(e, RpcError):
+                e = RpcError(str(e))
+
+            error = {'code': e.code, 'message': str(e)}
+
+            if e.data is not None:
+                error['data'] = e.data
+
+            response = {'jsonrpc': '2.0', 'id': call_id, 'error': error}
+
+        # Notifications are not answered
+        if call_id is not None:
+            self.queue(response)
+
+    def handle_response(self, entry):
+        with self.lock:
+            callback, timer = self.pending.pop(entry['id'], (None, None))
+
+        if callback is None:
+            logging.debug('Dropped response to unknown or expired call %r',
+                          entry['id'])
+            return
+
+        if timer:
+            timer.cancel()
+
+        if 'error' in entry:
+            error = entry['error']
+
+            if not isinstance(error, dict):
+                error = {'message': error}
+
+            callback(None, RpcError(error.get('message'),
+                                    error.get('code', SERVER_ERROR),
+                                    error.get('data')))
+        else:
+            callback(entry['result'], None)
+
+    def expire(self, call_id, timeout):
+        with self.lock:
+            callback, timer = self.pending.pop(call_id, (None, None))
+
+        if callback:
+            callback(None, RpcTimeout('no response after %s seconds'
+                                      % timeout))
+
+    def close(self, reason='connection closed'):
+        """
+        Fail the outstanding calls with an `RpcError`, and drop calls and
+        responses that have not been sent yet. Later calls fail immediately.
+        """
+        with self.lock:
+            self.closed = True
+            self.take_batch()
+            pending = self.pending
+            self.pending = {}
+
+        for callback, timer in pending.itervalues():
+            if timer:
+                timer.cancel()
+
+            callback(None, RpcError(reason))
+
+
+class Future(object):
+    """
+    Result of a call made with `Rpc.call`, which can be waited for by a
+    thread.
+    """
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.error = None
+
+    def set(self, result, error):
+        self.value = result
+        self.error = error
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the response for at most `timeout` seconds (None waits until
+        the call is answered or has timed out), and return the result.
+        Raises the `RpcError` of an error response, or an `RpcTimeout` if no
+        response has been received in time.
+        """
+        if not self.event.wait(timeout):
+            raise RpcTimeout('no response after %s seconds' % timeout)
+
+        if self.error:
+            raise self.error
+
+        return self.value
@@ -1,13 +1,22 @@
 import socket
 import logging
 import time
+from collections import deque
+from select import epoll, EPOLLIN
 from traceback import format_exc
-from threading import Thread
+from threading import Thread, Lock, Condition
 from ssl import SSLError
 
 from websocket import websocket
 from connection import Connection
-from errors import HandshakeError
+from frame import CLOSE_GOING_AWAY
+from errors import HandshakeError, NonUpgradeRequest, SocketClosed
+from stats import Stats
+from pool import ThreadPool
+
+
+RECVBUF_SIZE = 4096
+CLOSE_BATCH_SIZE = 1000
 
 
 class Server(object):
@@ -32,7 +41,8 @@ class Server(object):
     """
 
     def __init__(self, address, loglevel=logging.INFO, ssl_args=None,
-                 max_join_time=2.0, backlog_size=32, **kwargs):
+                 max_join_time=2.0, backlog_size=32, io_threads=0,
+                 executor=None, **kwargs):
         """
         Constructor for a simple web socket server.
 
@@ -52,9 +62,27 @@ class Server(object):
         `websocket.enable_ssl` for a server socket.
 
         `max_join_time` is the maximum time (in seconds) to wait for client
-        responses after sending CLOSE frames, it defaults to 2 seconds.
+        responses after sending CLOSE frames when the server stops, it
+        defaults to 2 seconds (see `quit_gracefully`).
 
         `backlog_size` is directly passed to `websocket.listen`.
+
+        `io_threads` is the number of I/O threads that receive frames for all
+        clients. By default (0), a thread is started for each client instead,
+        which is simple but costs a lot of memory for many (idle) clients.
+        With I/O threads, the handlers are called in the worker threads of
+        `executor` (a `ThreadPool` of 32 threads if omitted), in order for
+        each client. Handlers may block and send as usual.
+
+        `executor` is an executor with a submit() method, such as a
+        `ThreadPool` or a concurrent.futures.ThreadPoolExecutor.
+
+        `stats_location` is passed to the websocket constructor, the server's
+        statistics (see `Stats`) are served at that location.
+
+        `codec` is an optional `Codec` for the client connections, with which
+        they decode received messages and encode objects passed to
+        `Connection.send_object`.
         """
         logging.basicConfig(level=loglevel,
                 format='%(asctime)s: %(levelname)s: %(message)s',
@@ -64,37 +92,67 @@ class Server(object):
         hostname, port = address
         logging.info('Starting server at %s://%s:%d', scheme, hostname, port)
 
+        self.codec = kwargs.pop('codec', None)
         self.sock = websocket(**kwargs)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         if ssl_args:
             self.sock.enable_ssl(server_side=True, **ssl_args)
 
-        self.sock.bind(address)
-        self.sock.listen(backlog_size)
+        # A listening socket may be inherited from another process (passed
+        # as `sock`), which is already bound
+        if not self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+            self.sock.bind(address)
+            self.sock.listen(backlog_size)
 
         self.max_join_time = max_join_time
+        self.clients_changed = Condition()
+        self.io_threads = io_threads
+        self.executor = executor
+
+        if io_threads:
+            self.executor = executor or ThreadPool()
+
+            for name in ('onopen', 'onmessage', 'onclose'):
+                setattr(self, name, self.offload(getattr(self, name)))
+
+        self.stats = Stats()
+        self.stats.add_gauge('connections_open', 'Number of open websocket '
+                             'connections.', lambda: len(self.clients))
+        self.sock.stats = self.stats
 
     def run(self):
         self.clients = []
         self.client_threads = []
+        self.io_thread_list = [IOThread() for i in xrange(self.io_threads)]
+
+        for thread in self.io_thread_list:
+            thread.start()
 
         while True:
             try:
                 sock, address = self.sock.accept()
 
+                self.stats.incr('connections_accepted')
                 client = Client(self, sock)
                 self.clients.append(client)
                 logging.debug('Registered client %s', client)
 
-                thread = Thread(target=client.receive_forever)
-                thread.daemon = True
-                thread.start()
-                self.client_threads.append(thread)
+                if self.io_threads:
+                    n = sock.fileno() % self.io_threads
+                    self.io_thread_list[n].add(client)
+                else:
+                    thread = Thread(target=client.receive_forever)
+                    thread.daemon = True
+                    thread.start()
+                    self.client_threads.append(thread)
             except SSLError as e:
                 logging.error('SSL error: %s', e)
             except HandshakeError as e:
+                self.stats.incr('handshake_errors')
                 logging.error('Invalid request: %s', e.message)
+            except NonUpgradeRequest as e:
+                self.respond(e.sock, e.response)
             except KeyboardInterrupt:
                 logging.info('Received interrupt, stopping server...')
                 break
@@ -104,37 +162,124 @@ class Server(object):
         self.quit_gracefully()
 
     def quit_gracefully(self):
-        # Send a CLOSE frame so that the client connection will receive a
-        # response CLOSE frame
-        for client in self.clients:
-            client.send_close_frame()
-
-        # Wait for the CLOSE frames to be received. Wait for all threads in one
-        # loop instead of joining separately, so that timeouts are not
-        # propagated
-        start_time = time.time()
-
-        while time.time() - start_time <= self.max_join_time \
-                and any(t.is_alive() for t in self.client_threads):
-            time.sleep(0.050)
-
-        # Close remaining sockets, this will trigger a socket.error in the
-        # receive_forever() thread, causing the Connection.onclose() handler to
-        # be invoked
-        for client in self.clients:
-            try:
-                client.sock.close()
-            except socket.error:
-                pass
+        """
+        Stop accepting connections, send CLOSE frames to all clients in
+        batches of `CLOSE_BATCH_SIZE`, and wait at most `max_join_time`
+        seconds for their responses. Connections that have not been closed by
+        then are aborted. Returns a (closed cleanly, aborted) tuple of
+        connection counts.
+        """
+        self.stop_accepting()
+
+        clients = list(self.clients)
+        deadline = time.time() + self.max_join_time
+
+        for i in xrange(0, len(clients), CLOSE_BATCH_SIZE):
+            for client in clients[i:i + CLOSE_BATCH_SIZE]:
+                self.send_close(client, deadline)
+
+            self.close_batch_sent()
+
+        self.wait_closed(deadline)
+
+        for client in list(self.clients):
+            self.abort(client)
+
+        self.wait_closed(time.time() + self.max_join_time)
+
+        nclean = sum(1 for client in clients if client.close_frame_received)
+        naborted = len(clients) - nclean
+        logging.info('Closed %d connections cleanly, aborted %d', nclean,
+                     naborted)
+        return nclean, naborted
+
+    def stop_accepting(self):
+        self.sock.close()
+
+    def send_close(self, client, deadline):
+        # Sending blocks, but not beyond the deadline. The timeout also
+        # applies to the receiving thread of the client, which gives up at
+        # the deadline as well.
+        try:
+            client.sock.settimeout(max(deadline - time.time(), 0.001))
+            client.send_close_frame(CLOSE_GOING_AWAY, 'server shutting down')
+        except (socket.error, SocketClosed):
+            pass
+
+    def close_batch_sent(self):
+        # Responses are received by the client threads in the meantime
+        pass
+
+    def wait_closed(self, deadline):
+        with self.clients_changed:
+            while self.clients:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    break
+
+                self.clients_changed.wait(remaining)
+
+    def abort(self, client):
+        # The receiving thread notices the shutdown, and calls onclose()
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def respond(self, sock, response):
+        """
+        Write the response to a non-upgrade request and close the socket.
+        """
+        try:
+            sock.sock.sendall(response)
+        except socket.error as e:
+            logging.error('Could not respond to %s: %s', sock.location, e)
+        finally:
+            sock.close()
+
+    def offload(self, handler):
+        # Wrap an event handler so that it is called by a worker thread of
+        # the executor, in order for each client
+        def dispatch(client, *args):
+            with client.tasks_lock:
+                client.tasks.append((handler, args))
+
+                if client.tasks_running:
+                    return
 
-        # Wait for the onclose() handlers to finish
-        for thread in self.client_threads:
-            thread.join()
+                client.tasks_running = True
+
+            self.executor.submit(self.run_tasks, client)
+
+        return dispatch
+
+    def run_tasks(self, client):
+        # Called in a worker thread, runs the queued handlers of a client
+        # until its queue is empty, so that at most one worker handles a
+        # client at any time
+        while True:
+            with client.tasks_lock:
+                if not client.tasks:
+                    client.tasks_running = False
+                    return
+
+                handler, args = client.tasks.popleft()
+
+            try:
+                handler(client, *args)
+            except Exception as e:
+                logging.error(format_exc(e).rstrip())
+                self.stats.incr('errors')
 
     def remove_client(self, client, code, reason):
         self.clients.remove(client)
+        self.stats.incr('connections_closed')
         self.onclose(client, code, reason)
 
+        with self.clients_changed:
+            self.clients_changed.notify_all()
+
     def onopen(self, client):
         return NotImplemented
 
@@ -157,8 +302,19 @@ class Server(object):
 class Client(Connection):
     def __init__(self, server, sock):
         self.server = server
+        self.init_tasks()
+
+        if server.codec:
+            self.codec = server.codec
+
         super(Client, self).__init__(sock)
 
+    def init_tasks(self):
+        # Handlers that are queued for the server's executor
+        self.tasks = deque()
+        self.tasks_lock = Lock()
+        self.tasks_running = False
+
     def __str__(self):
         try:
             return '<Client at %s:%d>' % self.sock.getpeername()
@@ -166,15 +322,29 @@ class Client(Connection):
             return '<Client on closed socket>'
 
     def send(self, message, fragment_size=None, mask=False):
+        # No data frames may follow a CLOSE frame (RFC 6455, section 5.5.1)
+        if self.close_frame_sent:
+            logging.debug('Dropped %s to closing %s', message, self)
+            return
+
         logging.debug('Sending %s to %s', message, self)
+        self.server.stats.incr('messages_sent')
         Connection.send(self, message, fragment_size=fragment_size, mask=mask)
 
+    def close(self, code=None, reason=''):
+        if self.server.io_threads:
+            # The response is received by the I/O thread
+            self.send_close_frame(code, reason)
+        else:
+            Connection.close(self, code, reason)
+
     def onopen(self):
         logging.debug('Opened socket to %s', self)
         self.server.onopen(self)
 
     def onmessage(self, message):
         logging.debug('Received %s from %s', message, self)
+        self.server.stats.incr('messages_received')
         self.server.onmessage(self, message)
 
     def onping(self, payload):
@@ -196,9 +366,73 @@ class Client(Connection):
 
     def onerror(self, e):
         logging.error(format_exc(e))
+        self.server.stats.incr('errors')
         self.server.onerror(self, e)
 
 
+class IOThread(Thread):
+    """
+    Thread that receives the frames of many clients using a single EPOLL
+    object, for servers with `io_threads`. Client sockets stay in blocking
+    mode, so that handlers can send as usual: a single recv() call after a
+    read event does not block. Received frames are passed to
+    `Connection.feed_frame`.
+    """
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.epoll = epoll()
+        self.clients = {}
+
+    def add(self, client):
+        client.fno = client.sock.fileno()
+        client.sock.recv_callback = client.feed_frame
+        self.clients[client.fno] = client
+        self.epoll.register(client.fno, EPOLLIN)
+
+    def forget(self, client):
+        # Closing a socket has already removed it from the EPOLL object, and
+        # its file descriptor may have been reused for a new client
+        if self.clients.get(client.fno) is client:
+            del self.clients[client.fno]
+
+    def run(self):
+        while True:
+            for fileno, event in self.epoll.poll(1):
+                client = self.clients.get(fileno)
+
+                if client:
+                    self.receive(client)
+
+    def receive(self, client):
+        try:
+            client.sock.do_async_recv(RECVBUF_SIZE)
+
+            # SSL sockets may buffer decrypted data that EPOLL does not see
+            pending = getattr(client.sock.sock, 'pending', None)
+
+            while pending and pending():
+                client.sock.do_async_recv(RECVBUF_SIZE)
+        except SocketClosed:
+            self.forget(client)
+        except Exception as e:
+            self.epoll.unregister(client.fno)
+            self.forget(client)
+
+            # An end of file (a socket error without an error number) means
+            # that the client disconnected without a closing handshake
+            if isinstance(e, socket.error) and e.errno is None:
+                client.onclose(None, 'connection closed')
+            else:
+                client.onerror(e)
+                client.onclose(None, 'error: %s' % e)
+
+            try:
+                client.sock.close()
+            except socket.error:
+                pass
+
+
 if __name__ == '__main__':
     import sys
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
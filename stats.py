@@ -0,0 +1,88 @@
+from threading import Lock
+
+
+__all__ = ['Stats']
+
+
+class Stats(object):
+    """
+    Counters kept by a server, which can be exported in the Prometheus text
+    exposition format using format(). Counters are incremented using incr(),
+    gauges are callables that are evaluated each time the statistics are
+    formatted.
+
+    Example of a server that exposes its statistics at /metrics:
+    >>> import wspy
+    >>> wspy.AsyncServer(('', 8000), stats_location='/metrics').run()
+    """
+    counters = [
+        ('connections_accepted', 'Number of accepted websocket connections.'),
+        ('connections_closed', 'Number of closed websocket connections.'),
+        ('handshake_errors', 'Number of failed websocket handshakes.'),
+        ('messages_received', 'Number of received messages.'),
+        ('messages_sent', 'Number of sent messages.'),
+        ('errors', 'Number of errors raised while handling a connection.'),
+        ('stats_requests', 'Number of requests for these statistics.'),
+    ]
+
+    def __init__(self, prefix='wspy'):
+        """
+        `prefix` is prepended to the name of each metric.
+        """
+        self.prefix = prefix
+        self.values = dict((name, 0) for name, help in self.counters)
+        self.gauges = []
+        self.lock = Lock()
+
+    def incr(self, name, n=1):
+        """
+        Increment counter `name` by `n`. This is safe to call from multiple
+        threads.
+        """
+        with self.lock:
+            self.values[name] += n
+
+    def add_gauge(self, name, help, func):
+        """
+        Add a gauge `name`, whose value is the result of calling `func`.
+        """
+        self.gauges.append((name, help, func))
+
+    def format(self):
+        """
+        Format all counters and gauges according to the Prometheus text
+        exposition format.
+        """
+        lines = []
+
+        def add(name, help, metric_type, value):
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.append('%s %s' % (name, value))
+
+        for name, help in self.counters:
+            add(name + '_total', help, 'counter', self.values[name])
+
+        for name, help, func in self.gauges:
+            add(name, help, 'gauge', func())
+
+        return '\n'.join(lines) + '\n'
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    """
+    Get a dictionary with the percentiles `ps` of `values` (such as message
+    latencies) by names like "p50", and the maximum value by "max". Returns
+    an empty dictionary if there are no values.
+    """
+    values = sorted(values)
+
+    if not values:
+        return {}
+
+    result = dict(('p%s' % p, values[min(len(values) - 1,
+                                         int(len(values) * p / 100))])
+                  for p in ps)
+    result['max'] = values[-1]
+    return result
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import os
+import sys
+import fcntl
+import struct
+import socket
+import termios
+from threading import Thread
+from os.path import abspath, dirname
+
+basepath = abspath(dirname(abspath(__file__)) + '/..')
+sys.path.insert(0, basepath)
+
+from websocket import websocket
+from connection import Connection
+from message import TextMessage, BinaryMessage
+from handshake import ServerHandshake, ClientHandshake
+from deflate_message import DeflateMessage
+from deflate_frame import DeflateFrame
+
+
+# Parameters of the server and client extensions, and the negotiated
+# (window bits, no context takeover) of the client for compressing and
+# inflating. The server inflates with the client's compression parameters
+# and vice versa, although a client may choose a smaller window or no
+# context takeover for its own messages.
+CASES = [
+    ({}, {},
+     (15, False), (15, False)),
+    ({}, {'client_no_context_takeover': True},
+     (15, True), (15, False)),
+    ({'server_max_window_bits': 10}, {'server_no_context_takeover': True},
+     (15, False), (10, True)),
+    ({'client_max_window_bits': 9}, {},
+     (9, False), (15, False)),
+    ({'client_no_context_takeover': True,
+      'server_no_context_takeover': True}, {'client_max_window_bits': 12},
+     (12, True), (15, True)),
+    ({'client_max_window_bits': 11}, {'client_max_window_bits': 13},
+     (11, False), (15, False)),
+]
+
+
+def handshake(server_extensions, client_extensions):
+    """
+    Perform a handshake over a socketpair, and return the server and client
+    websockets.
+    """
+    a, b = socket.socketpair()
+    server = websocket(a, extensions=server_extensions)
+    client = websocket(b, extensions=client_extensions)
+    t = Thread(target=ServerHandshake(server).perform, args=(server,))
+    t.start()
+    ClientHandshake(client).perform()
+    t.join()
+    return server, client
+
+
+def pending(sock):
+    size = fcntl.ioctl(sock.fileno(), termios.FIONREAD, '\0' * 4)
+    return struct.unpack('I', size)[0]
+
+
+def exchange(server, client):
+    """
+    Send messages of which every other one is fragmented in both directions,
+    and check that they are compressed and received intact.
+    """
+    sconn = Connection(server)
+    cconn = Connection(client)
+
+    for i in xrange(4):
+        fragment_size = 10000 if i % 2 else None
+        text = u'{"seq": %d, "text": "%s"}' % (i, u'\xe9t\xe9 ' * 10000)
+        cconn.send(TextMessage(text), fragment_size, mask=True)
+        assert pending(server) < len(text) / 10
+        assert sconn.recv().payload == text
+
+        data = os.urandom(100) + 'compressible ' * 10000
+        sconn.send(BinaryMessage(data), fragment_size)
+        assert pending(client) < len(data) / 10
+        assert cconn.recv().payload == data
+
+
+if __name__ == '__main__':
+    for sparams, cparams, defl, dec in CASES:
+        server, client = handshake([DeflateMessage(**sparams)],
+                                   [DeflateMessage(**cparams)])
+        sinst = server.extension_instances[0]
+        cinst = client.extension_instances[0]
+
+        print 'server %r, client %r: %s' % (sparams, cparams, cinst.params)
+        got = ((cinst.defl_window_bits, cinst.defl_no_context_takeover),
+               (cinst.dec_window_bits, cinst.dec_no_context_takeover))
+        assert got == (defl, dec), 'client uses %s, expected %s' \
+                                   % (got, (defl, dec))
+        assert sinst.dec_window_bits >= cinst.defl_window_bits
+        assert (sinst.defl_window_bits, sinst.defl_no_context_takeover) \
+               == dec
+
+        exchange(server, client)
+        server.close()
+        client.close()
+
+    server, client = handshake([DeflateFrame()],
+                               [DeflateFrame(no_context_takeover=True)])
+    print 'deflate-frame: %s' % client.extension_instances[0].params
+    exchange(server, client)
+    server.close()
+    client.close()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import sys
+import logging
+from threading import Thread
+from os.path import abspath, dirname
+
+basepath = abspath(dirname(abspath(__file__)) + '/..')
+sys.path.insert(0, basepath)
+
+from websocket import websocket
+from connection import Connection
+from message import TextMessage
+from errors import SocketClosed
+from async import AsyncServer
+from profiling import HandlerProfiler
+from deflate_message import DeflateMessage
+
+ADDR = ('localhost', 8000)
+
+
+class EchoServer(AsyncServer):
+    def onmessage(self, client, message):
+        client.send(message)
+
+
+def talk(nmessages):
+    sock = websocket(extensions=[DeflateMessage()])
+    sock.connect(ADDR)
+    conn = Connection(sock)
+
+    for i in xrange(nmessages):
+        conn.send(TextMessage(u'message %d ' % i * 100), mask=True)
+        conn.recv()
+
+    # The server may close the socket before the CLOSE frame is answered
+    try:
+        conn.close()
+    except SocketClosed:
+        pass
+
+
+if __name__ == '__main__':
+    profiler = HandlerProfiler()
+    server = EchoServer(ADDR, extensions=[DeflateMessage()],
+                        profiler=profiler, loglevel=logging.WARNING)
+    client = Thread(target=talk, args=(10,))
+    client.start()
+
+    while client.is_alive():
+        server.handle_events(0.1)
+
+    report = profiler.report()
+    print report
+
+    # Extension hooks are only timed if the compiled hooks use the wrappers
+    for name in ('onsend', 'onrecv'):
+        entry = 'permessage-deflate.%s:' % name
+        assert entry in report, 'missing "%s" in report' % entry
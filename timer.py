@@ -0,0 +1,181 @@
+import heapq
+import time
+import logging
+from itertools import count
+from threading import Thread, Lock, Condition
+from traceback import format_exc
+
+
+__all__ = ['TimerQueue', 'TimerThread']
+
+
+class Timer(object):
+    """
+    A call scheduled by `TimerQueue.call_later`, which is not made if the
+    timer is cancelled before its deadline.
+    """
+    def __init__(self, queue, deadline, func, args):
+        self.queue = queue
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        with self.queue.lock:
+            if not self.cancelled:
+                self.cancelled = True
+                self.queue.ncancelled += 1
+
+
+class TimerQueue(object):
+    """
+    Heap of scheduled calls, which are made by run_due() once their deadline
+    has passed. call_later() has the same signature as that of an asyncio
+    event loop, so that code which needs timeouts can be driven by an
+    `AsyncServer`, a `TimerThread` or an asyncio loop alike.
+    """
+    def __init__(self):
+        self.heap = []
+        self.lock = Lock()
+        self.seq = count()
+        self.ncancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.ncancelled
+
+    def call_later(self, delay, func, *args):
+        """
+        Schedule a call of `func` with `args` in `delay` seconds. Returns a
+        timer object whose cancel() method cancels the call.
+        """
+        timer = Timer(self, time.time() + delay, func, args)
+
+        with self.lock:
+            # Most timers are cancelled long before their deadline (e.g.
+            # timeouts of calls that have been answered)
+            if self.ncancelled > 64 and self.ncancelled > len(self.heap) / 2:
+                self.heap = [entry for entry in self.heap
+                             if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.ncancelled = 0
+
+            heapq.heappush(self.heap, (timer.deadline, next(self.seq), timer))
+
+        return timer
+
+    def pop_cancelled(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.ncancelled -= 1
+
+    def first(self):
+        """
+        Get the timer of the scheduled call with the earliest deadline, or
+        None if no calls are scheduled.
+        """
+        with self.lock:
+            self.pop_cancelled()
+            return self.heap[0][2] if self.heap else None
+
+    def timeout(self, default=None):
+        """
+        Get the number of seconds until the first deadline, at most `default`
+        (if not None or negative, which means no limit). Returns `default` if
+        no calls are scheduled.
+        """
+        with self.lock:
+            self.pop_cancelled()
+
+            if not self.heap:
+                return default
+
+            remaining = max(0.0, self.heap[0][0] - time.time())
+
+        if default is None or default < 0:
+            return remaining
+
+        return min(default, remaining)
+
+    def run_due(self):
+        """
+        Make the scheduled calls whose deadline has passed.
+        """
+        now = time.time()
+
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0][0] > now:
+                    return
+
+                deadline, seq, timer = heapq.heappop(self.heap)
+
+                if timer.cancelled:
+                    self.ncancelled -= 1
+                    continue
+
+                # A call that has been made can no longer be cancelled
+                timer.cancelled = True
+
+            try:
+                timer.func(*timer.args)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                logging.error(format_exc(e).rstrip())
+
+
+class TimerThread(TimerQueue):
+    """
+    `TimerQueue` whose calls are made by a daemon thread, which is started
+    when the first call is scheduled. This drives the timeouts of
+    connections that are not handled by an event loop.
+
+    Example:
+    >>> timers = wspy.TimerThread()
+    >>> timer = timers.call_later(10, conn.close)
+    >>> timer.cancel()
+    """
+    def __init__(self):
+        super(TimerThread, self).__init__()
+        self.lock = Condition()
+        self.thread = None
+
+    def call_later(self, delay, func, *args):
+        timer = super(TimerThread, self).call_later(delay, func, *args)
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+            # Wake up the thread in case the deadline is earlier than the one
+            # it is waiting for
+            self.lock.notify()
+
+        return timer
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.lock.wait(self.timeout())
+
+            self.run_due()
+
+
+default_timers = None
+default_timers_lock = Lock()
+
+
+def timer_thread():
+    """
+    Get the `TimerThread` shared by all threaded connections.
+    """
+    global default_timers
+
+    with default_timers_lock:
+        if default_timers is None:
+            default_timers = TimerThread()
+
+    return default_timers
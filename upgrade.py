@@ -0,0 +1,183 @@
+import os
+import json
+import errno
+import socket
+import struct
+from base64 import b64encode, b64decode
+from _multiprocessing import sendfd, recvfd
+
+from frame import Frame
+
+
+__all__ = ['listen_upgrade', 'receive_handoff']
+
+
+# Each message is a JSON-encoded state, preceded by its length and a flag
+# indicating whether a file descriptor follows the state
+HEADER = struct.Struct('!I?')
+
+
+def send_state(conn, state, fd=None):
+    data = json.dumps(state)
+    conn.sendall(HEADER.pack(len(data), fd is not None) + data)
+
+    if fd is not None:
+        sendfd(conn.fileno(), fd)
+
+
+def recv_exactly(conn, n):
+    data = ''
+
+    while len(data) < n:
+        received = conn.recv(n - len(data))
+
+        if not received:
+            raise socket.error('handoff connection closed prematurely')
+
+        data += received
+
+    return data
+
+
+def recv_state(conn):
+    length, has_fd = HEADER.unpack(recv_exactly(conn, HEADER.size))
+    state = json.loads(recv_exactly(conn, length))
+    fd = recvfd(conn.fileno()) if has_fd else None
+    return state, fd
+
+
+def listen_upgrade(path):
+    """
+    Create the Unix socket at `path` on which a new process can request a
+    handoff. A socket file left by a previous process is replaced.
+    """
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    return sock
+
+
+def receive_handoff(path):
+    """
+    Request a handoff from the process listening at Unix socket `path`.
+    Returns None if no process is listening, or a (listener, clients) tuple
+    where `listener` is the listening socket of the old process and `clients`
+    is a list of (state, socket) tuples for the transferred connections.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        conn.connect(path)
+    except socket.error as e:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            conn.close()
+            return None
+
+        raise
+
+    listener = None
+    clients = []
+
+    try:
+        while True:
+            state, fd = recv_state(conn)
+
+            if state['type'] == 'done':
+                break
+
+            sock = socket.fromfd(fd, state['family'], socket.SOCK_STREAM)
+            os.close(fd)
+
+            if state['type'] == 'listener':
+                listener = sock
+            else:
+                clients.append((state, sock))
+    finally:
+        conn.close()
+
+    return listener, clients
+
+
+def is_transferable(client):
+    """
+    Check if the state of `client` can be restored in another process. This
+    is not the case for SSL connections, closing connections, connections
+    whose handlers are still running in an executor or whose messages are
+    being (de)compressed by a worker thread, and connections with extensions
+    that keep state between frames (e.g. deflate context takeover).
+    """
+    return not client.sock.secure \
+           and not client.close_frame_sent \
+           and not client.close_frame_received \
+           and not client.tasks_running and not client.tasks \
+           and not client.send_pipeline.steps \
+           and not client.recv_pipeline.steps \
+           and all(inst.is_transferable()
+                   for inst in client.sock.extension_instances)
+
+
+def client_state(client):
+    sock = client.sock
+
+    return {
+        'type': 'client',
+        'family': sock.family,
+        'location': sock.location,
+        'protocol': sock.protocol,
+        'request_headers': sock.request_headers,
+        'extensions': [(inst.name, inst.params)
+                       for inst in sock.extension_instances],
+        'recvbuf': b64encode(sock.recvbuf),
+        'sendbuf': b64encode(str(sock.sendbuf)),
+        'fragments': [(f.opcode, f.final, f.rsv1, f.rsv2, f.rsv3,
+                       b64encode(str(f.payload))) for f in client.fragments],
+        'ping_payload': b64encode(client.ping_payload)
+                        if client.ping_sent else None,
+    }
+
+
+def restore_socket(wsock, state, extensions):
+    """
+    Restore the handshake results and buffers of websocket `wsock` from
+    `state`. `extensions` are the supported extensions of the new process,
+    a KeyError is raised if a negotiated extension is no longer supported.
+    """
+    wsock.location = str(state['location'])
+    wsock.protocol = state['protocol'] and str(state['protocol'])
+    wsock.request_headers = state['request_headers']
+    wsock.handshake_sent = True
+
+    for name, params in state['extensions']:
+        for ext in extensions:
+            if name in ext.names:
+                params = dict((str(k), v) for k, v in params.iteritems())
+                wsock.extension_instances.append(ext.Instance(ext, name,
+                                                              params))
+                break
+        else:
+            raise KeyError('extension "%s" is not supported' % name)
+
+    wsock.compile_hooks()
+
+    wsock.recvbuf = b64decode(state['recvbuf'])
+    wsock.sendbuf = b64decode(state['sendbuf'])
+
+    if wsock.sendbuf:
+        wsock.sendbuf_frames = [[None, len(wsock.sendbuf), None]]
+
+
+def restore_connection(conn, state):
+    conn.fragments = [Frame(opcode, b64decode(payload), final=final,
+                            rsv1=rsv1, rsv2=rsv2, rsv3=rsv3)
+                      for opcode, final, rsv1, rsv2, rsv3, payload
+                      in state['fragments']]
+
+    if state['ping_payload'] is not None:
+        conn.ping_sent = True
+        conn.ping_payload = b64decode(state['ping_payload'])
@@ -1,12 +1,18 @@
+import os
+import errno
 import socket
 import ssl
+from threading import Lock, RLock
+from contextlib import contextmanager
 
 from frame import receive_frame, pop_frame, contains_frame
-from handshake import ServerHandshake, ClientHandshake
-from errors import SSLError
+from handshake import ServerHandshake, ClientHandshake, NegotiationCache, \
+                      MAX_HDR_LEN
+from errors import SSLError, HandshakeError
+from extension import chain
 
 
-INHERITED_ATTRS = ['bind', 'close', 'listen', 'fileno', 'getpeername',
+INHERITED_ATTRS = ['bind', 'listen', 'fileno', 'getpeername',
                    'getsockname', 'getsockopt', 'setsockopt', 'setblocking',
                    'settimeout', 'gettimeout', 'shutdown', 'family', 'type',
                    'proto']
@@ -37,7 +43,8 @@ class websocket(object):
     """
     def __init__(self, sock=None, origin=None, protocols=[], extensions=[],
                  location='/', trusted_origins=[], locations=[], auth=None,
-                 recv_callback=None, sfamily=socket.AF_INET, sproto=0):
+                 recv_callback=None, stats_location=None, capture=None,
+                 sfamily=socket.AF_INET, sproto=0):
         """
         Create a regular TCP socket of family `family` and protocol
 
@@ -50,7 +57,8 @@ class websocket(object):
         `protocols` is a list of supported protocol names.
 
         `extensions` (for server sockets) is a list of supported extensions
-        (`Extension` instances).
+        (`Extension` instances). The outcome of negotiations is cached per
+        extension offer in `negotiation_cache` (see `NegotiationCache`).
 
         `location` (for client sockets) is optional, used to request a
         particular resource in the HTTP handshake. In a URL, this would show as
@@ -77,28 +85,62 @@ class websocket(object):
         behaviour for the next received message. Can be set when calling
         `queue_send`.
 
+        `stats_location` (for server sockets) is an optional resource location
+        (without trailing slash, e.g. '/metrics') at which regular HTTP GET
+        requests are answered with the statistics in the `stats` attribute
+        instead of being upgraded to a websocket. The response is not sent by
+        `accept`, but a NonUpgradeRequest exception containing it is raised
+        instead, so that the caller can write it in a (non-)blocking manner.
+
+        `capture` is an optional `Capture` instance in which sent and received
+        frames are recorded. Accepted client sockets inherit the capture of
+        the server socket.
+
         `sfamily` and `sproto` are used for the regular socket constructor.
         """
         self.protocols = protocols
         self.extensions = extensions
         self.extension_instances = []
+        self.negotiation_cache = NegotiationCache() if extensions else None
         self.origin = origin
         self.location = location
         self.trusted_origins = trusted_origins
         self.locations = locations
         self.auth = auth
+        self.stats_location = stats_location
+        self.stats = None
+        self.capture = capture
 
         self.secure = False
 
         self.handshake_sent = False
+        self.client_handshake = None
+        self.handshake_frames = []
+        self.connecting = False
+        self.mask_frames = False
 
         self.sendbuf_frames = []
         self.sendbuf = ''
         self.recvbuf = ''
         self.recv_callback = recv_callback
+        self.defer_recv_hooks = False
+
+        # Frames packed by concurrent senders in blocking mode, which are
+        # written by a single thread at a time (see `send`)
+        self.send_lock = RLock()
+        self.write_lock = Lock()
+        self.write_queue = []
+
+        # Threads that use the extension instances outside of the thread
+        # that may close the socket (see `using_extensions`)
+        self.extensions_users = 0
+        self.extensions_lock = Lock()
+        self.extensions_closed = False
 
         self.sock = sock or socket.socket(sfamily, socket.SOCK_STREAM, sproto)
 
+        self.compile_hooks()
+
     def __getattr__(self, name):
         if name in INHERITED_ATTRS:
             return getattr(self.sock, name)
@@ -106,16 +148,60 @@ class websocket(object):
         raise AttributeError("'%s' has no attribute '%s'"
                              % (self.__class__.__name__, name))
 
+    def close(self):
+        """
+        Equivalent to socket.close(), but also releases the resources of the
+        negotiated extensions (e.g. compression contexts), or defers that
+        until they are no longer used by another thread.
+        """
+        with self.extensions_lock:
+            self.extensions_closed = True
+            release = not self.extensions_users
+
+        if release:
+            self.release_extensions()
+
+        self.sock.close()
+
+    def release_extensions(self):
+        for inst in self.extension_instances:
+            inst.release()
+
+    @contextmanager
+    def using_extensions(self):
+        """
+        Context in which the extension instances are used by a thread other
+        than the one that closes the socket, such as a worker thread that
+        compresses a message. The resources of the instances are released
+        when the last such context is exited after close(), also if they were
+        allocated after it.
+        """
+        with self.extensions_lock:
+            self.extensions_users += 1
+
+        try:
+            yield
+        finally:
+            with self.extensions_lock:
+                self.extensions_users -= 1
+                release = self.extensions_closed and \
+                          not self.extensions_users
+
+            if release:
+                self.release_extensions()
+
     def accept(self):
         """
         Equivalent to socket.accept(), but transforms the socket into a
         websocket instance and sends a server handshake (after receiving a
         client handshake). Note that the handshake may raise a HandshakeError
-        exception.
+        exception, or a NonUpgradeRequest exception for requests at
+        `stats_location`.
         """
         sock, address = self.sock.accept()
         wsock = websocket(sock)
         wsock.secure = self.secure
+        wsock.capture = self.capture
         ServerHandshake(wsock).perform(self)
         wsock.handshake_sent = True
         return wsock, address
@@ -131,33 +217,169 @@ class websocket(object):
         ClientHandshake(self).perform()
         self.handshake_sent = True
 
+    def connect_async(self, address, handshake_callback=None):
+        """
+        Non-blocking variant of connect(). The socket is set to non-blocking
+        mode and starts connecting to `address`. When the socket becomes
+        writable, do_async_send() sends the handshake request, and
+        do_async_recv() handles the response after which the optional
+        `handshake_callback` is called. Frames queued using `queue_send`
+        before the handshake has completed are sent after the handshake. All
+        queued frames are masked, as required for client sockets.
+        """
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(address)
+
+        if err not in (0, errno.EINPROGRESS):
+            raise socket.error(err, os.strerror(err))
+
+        self.client_handshake = ClientHandshake(self)
+        self.handshake_callback = handshake_callback
+        self.connecting = True
+        self.mask_frames = True
+
+    def finish_connect(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if err:
+            raise socket.error(err, os.strerror(err))
+
+        self.connecting = False
+        self.sendbuf = self.client_handshake.request()
+
+    def finish_handshake(self):
+        end = self.recvbuf.find('\r\n\r\n')
+
+        if end == -1:
+            if len(self.recvbuf) > MAX_HDR_LEN:
+                raise HandshakeError('response exceeds maximum header length '
+                                     'of %d' % MAX_HDR_LEN)
+
+            return False
+
+        raw = self.recvbuf[:end + 4]
+        self.recvbuf = self.recvbuf[end + 4:]
+        self.client_handshake.handle_raw_response(raw)
+        self.client_handshake = None
+        self.handshake_sent = True
+
+        # Frames queued during the handshake can only be sent now, because
+        # the negotiated extensions apply to them
+        for args in self.handshake_frames:
+            self.queue_send(*args)
+
+        self.handshake_frames = []
+
+        if self.handshake_callback:
+            self.handshake_callback()
+
+        return True
+
+    def compile_hooks(self):
+        """
+        Compile the hooks of the extension instances into a single callable
+        per direction and stage, so that they are not looked up for every
+        frame. Frames are passed to `send_hook` and `recv_hook`, lists of
+        frames that are sent or received together to `send_batch_hook` and
+        `recv_batch_hook`, and unfragmented messages to `message_send_hook`
+        and `message_recv_hook` (for extensions that are applied before
+        fragmentation). Without extensions, the hooks return their argument.
+
+        This is done after the handshake, and must be repeated when
+        `extension_instances` is changed.
+        """
+        instances = [inst for inst in self.extension_instances
+                     if not inst.extension.before_fragmentation]
+        self.send_hook = chain([inst.send_hook() for inst in instances])
+        self.send_batch_hook = chain([inst.send_batch_hook()
+                                      for inst in instances])
+        instances.reverse()
+        self.recv_hook = chain([inst.recv_hook() for inst in instances])
+        self.recv_batch_hook = chain([inst.recv_batch_hook()
+                                      for inst in instances])
+
+        instances = [inst for inst in self.extension_instances
+                     if inst.extension.before_fragmentation]
+        self.message_send_hook = chain([inst.send_hook()
+                                        for inst in instances])
+        instances.reverse()
+        self.message_recv_hook = chain([inst.recv_hook()
+                                        for inst in instances])
+
     def apply_send_hooks(self, frame, before_fragmentation):
-        for inst in self.extension_instances:
-            if inst.extension.before_fragmentation == before_fragmentation:
-                frame = inst.handle_send(frame)
+        if before_fragmentation:
+            return self.message_send_hook(frame)
 
-        return frame
+        return self.send_hook(frame)
 
     def apply_recv_hooks(self, frame, before_fragmentation):
-        for inst in reversed(self.extension_instances):
-            if inst.extension.before_fragmentation == before_fragmentation:
-                frame = inst.handle_recv(frame)
+        if before_fragmentation:
+            return self.message_recv_hook(frame)
 
-        return frame
+        return self.recv_hook(frame)
 
     def send(self, *args):
         """
-        Send a number of frames.
+        Send a number of frames. This is safe to call from multiple threads:
+        the frames of a single call are sent contiguously, and frames of
+        calls that arrive while another thread is writing are combined into a
+        single write by the next writing thread. Returns after the frames
+        have been written.
+        """
+        self.write(self.pack_frames(*args))
+
+    def pack_frames(self, *args):
         """
-        for frame in args:
-            self.sock.sendall(self.apply_send_hooks(frame, False).pack())
+        Apply the send hooks to the frames and append them to the write queue,
+        returning the queue entry to pass to write(). Holding `send_lock`
+        across multiple calls (as `Connection.send` does) guarantees that the
+        hooks are applied in the same order as the frames are written.
+        """
+        with self.send_lock:
+            packed = []
+
+            for frame in self.send_batch_hook(list(args)):
+                if self.capture:
+                    self.capture.record(self, frame, True)
+
+                packed.append(frame.pack())
+
+            entry = [packed, None]
+            self.write_queue.append(entry)
+            return entry
+
+    def write(self, entry):
+        with self.write_lock:
+            with self.send_lock:
+                batch, self.write_queue = self.write_queue, []
+
+            # An empty batch means that another thread has written our frames
+            if batch:
+                buffers = [b for packed, error in batch for b in packed]
+
+                try:
+                    if len(buffers) == 1:
+                        self.sock.sendall(buffers[0])
+                    else:
+                        self.sock.sendall(''.join(map(str, buffers)))
+                except Exception as e:
+                    for other in batch:
+                        other[1] = e
+
+        if entry[1]:
+            raise entry[1]
 
     def recv(self):
         """
         Receive a single frames. This can be either a data frame or a control
         frame.
         """
-        return self.apply_recv_hooks(receive_frame(self.sock), False)
+        frame = receive_frame(self.sock)
+
+        if self.capture:
+            self.capture.record(self, frame, False)
+
+        return self.recv_hook(frame)
 
     def recvn(self, n):
         """
@@ -173,18 +395,37 @@ class websocket(object):
         frame has been fully written. `recv_callback` is an optional callable
         to quickly set the `recv_callback` attribute to.
         """
-        frame = self.apply_send_hooks(frame, False)
-        self.sendbuf += frame.pack()
-        self.sendbuf_frames.append([frame, len(self.sendbuf), callback])
+        if self.client_handshake:
+            self.handshake_frames.append((frame, callback, recv_callback))
+            return
+
+        self.queue_frame(self.send_hook(frame), callback)
 
         if recv_callback:
             self.recv_callback = recv_callback
 
+    def queue_frame(self, frame, callback=None):
+        """
+        Same as `queue_send`, but for a frame to which the send hooks have
+        already been applied (e.g. by a worker thread).
+        """
+        if self.mask_frames and not frame.masking_key:
+            frame.masking_key = os.urandom(4)
+
+        if self.capture:
+            self.capture.record(self, frame, True)
+
+        self.sendbuf += frame.pack()
+        self.sendbuf_frames.append([frame, len(self.sendbuf), callback])
+
     def do_async_send(self):
         """
         Send any queued data. This function should only be called after a write
         event on a file descriptor.
         """
+        if self.connecting:
+            self.finish_connect()
+
         assert len(self.sendbuf)
 
         nwritten = self.sock.send(self.sendbuf)
@@ -214,22 +455,48 @@ class websocket(object):
         if len(data) == 0:
             raise socket.error('no data to receive')
 
+        self.feed(data)
+
+    def feed(self, data):
+        """
+        Handle received data, passing any completed frames to the
+        `recv_callback`. This is used by do_async_recv(), and by transports
+        that receive data themselves. If `defer_recv_hooks` is set, the
+        receive hooks are not applied to the frames, the callback applies
+        them instead (e.g. in a worker thread).
+        """
         self.recvbuf += data
 
+        if self.client_handshake and not self.finish_handshake():
+            return
+
+        frames = []
+
         while contains_frame(self.recvbuf):
             frame, self.recvbuf = pop_frame(self.recvbuf)
-            frame = self.apply_recv_hooks(frame, False)
 
+            if self.capture:
+                self.capture.record(self, frame, False)
+
+            frames.append(frame)
+
+        # The frames of a single read are passed through the receive hooks at
+        # once
+        if frames and not self.defer_recv_hooks:
+            frames = self.recv_batch_hook(frames)
+
+        for frame in frames:
             if not self.recv_callback:
                 raise ValueError('no callback installed for %s' % frame)
 
             self.recv_callback(frame)
 
     def can_send(self):
-        return len(self.sendbuf) > 0
+        return len(self.sendbuf) > 0 or self.connecting
 
     def can_recv(self):
-        return self.recv_callback is not None
+        return self.recv_callback is not None \
+               or self.client_handshake is not None
 
     def enable_ssl(self, *args, **kwargs):
         """